@@ -0,0 +1,571 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Analytic energy changes of titration trials, for Coulomb and OBC2 generalized Born energies at a fixed configuration.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import abc
+
+import numpy
+
+import simtk.openmm as openmm
+
+from constphutils import _strip_units
+
+#=============================================================================================
+# MODULE CONSTANTS
+#=============================================================================================
+
+_ONE_4PI_EPS0 = None # Coulomb constant of the OpenMM version in use, measured by _getCoulombConstant()
+
+#=============================================================================================
+# SUBROUTINES
+#=============================================================================================
+
+def _getCoulombConstant():
+    """
+    Return the Coulomb constant used by the OpenMM version in use, in kJ/mol nm / elementary_charge**2.
+
+    RETURNS
+
+    one_4pi_eps0 (float) - the Coulomb constant
+
+    NOTE
+
+    The constant is measured once, as the energy of two unit charges 1 nm apart in a NonbondedForce without cutoff, so that
+    analytic energies and Custom force expressions agree with the NonbondedForce to the last digit of the platform.
+
+    """
+    global _ONE_4PI_EPS0
+    if _ONE_4PI_EPS0 is None:
+        system = openmm.System()
+        force = openmm.NonbondedForce()
+        force.setNonbondedMethod(openmm.NonbondedForce.NoCutoff)
+        for particle_index in range(2):
+            system.addParticle(1.0)
+            force.addParticle(1.0, 1.0, 0.0)
+        system.addForce(force)
+        context = openmm.Context(system, openmm.VerletIntegrator(1.0), openmm.Platform.getPlatformByName('Reference'))
+        context.setPositions([openmm.Vec3(0.0, 0.0, 0.0), openmm.Vec3(1.0, 0.0, 0.0)])
+        _ONE_4PI_EPS0 = _strip_units(context.getState(getEnergy=True).getPotentialEnergy())
+        del context
+    return _ONE_4PI_EPS0
+
+#=============================================================================================
+# Analytic energy changes for titration trials.
+#=============================================================================================
+
+class AnalyticChargeEnergy(object):
+    """
+    Base class for exact energy changes due to changes in the charges of titratable atoms, at a fixed configuration.
+
+    For energies that are quadratic forms E = 1/2 sum_ij q_i q_j K_ij in the charges, if the charges of a set S of
+    titratable atoms change by dq, the energy changes by
+
+    dE = sum_{i in S} dq_i phi_i + 1/2 sum_{i,j in S} dq_i dq_j K_ij
+
+    where phi_i = sum_j K_ij q_j is the potential at titratable atom i.  Subclasses compute self.potentials and the kernel
+    between titratable atoms self.kernel once per configuration in setConfiguration(), after which every trial costs
+    O(|S|^2) and an accepted change O(|S| ntitratable).
+
+    Energies are reported relative to the charges at the time setConfiguration() was last called.
+
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self):
+        self.energy = 0.0
+        self.potentials = None
+        self.kernel = None
+
+        return
+
+    @abc.abstractmethod
+    def setConfiguration(self, positions, titratable_charges):
+        """
+        Compute the potentials at, and the kernel between, titratable atoms for a new configuration, and reset the energy to zero.
+
+        ARGUMENTS
+
+        positions (numpy array of shape [natoms, 3]) - unit-free positions, in nm
+        titratable_charges (numpy array) - current charges of the titratable atoms
+
+        """
+        return
+
+    def getEnergy(self):
+        """
+        Return the energy of the current charges, relative to those at the last call to setConfiguration().
+
+        """
+        return self.energy
+
+    def getEnergyChange(self, indices, delta_charges):
+        """
+        Return the exact energy change for a change in the charges of some titratable atoms.
+
+        ARGUMENTS
+
+        indices (numpy array of int) - titratable-local indices of the atoms whose charges change
+        delta_charges (numpy array) - the charge changes
+
+        RETURNS
+
+        delta_energy (float) - the energy change, in kJ/mol
+
+        """
+        if len(indices) == 0:
+            return 0.0
+        return delta_charges.dot(self.potentials[indices]) + 0.5 * delta_charges.dot(self.kernel[numpy.ix_(indices,indices)].dot(delta_charges))
+
+    def applyChange(self, indices, delta_charges):
+        """
+        Apply a change in the charges of some titratable atoms, updating the potentials at all titratable atoms.
+
+        ARGUMENTS
+
+        indices (numpy array of int) - titratable-local indices of the atoms whose charges change
+        delta_charges (numpy array) - the charge changes
+
+        """
+        if len(indices) == 0:
+            return
+        self.energy += self.getEnergyChange(indices, delta_charges)
+        self.potentials += self.kernel[:,indices].dot(delta_charges)
+
+        return
+
+class AnalyticCoulombEnergy(AnalyticChargeEnergy):
+    """
+    Exact Coulomb energy changes for changes in the charges of titratable atoms, for NoCutoff electrostatics.
+
+    The potentials are those due to all other atoms, and the kernel is the Coulomb interaction between titratable atoms,
+    with exception pairs scaled (1,4 interactions) or removed (exclusions).
+
+    """
+
+    def __init__(self, charges, titratable_atoms, exception_pairs, exception_weights):
+        """
+        ARGUMENTS
+
+        charges (numpy array of shape [natoms]) - unit-free charges of all atoms; entries of titratable atoms are replaced in setConfiguration()
+        titratable_atoms (numpy array of int) - indices of titratable atoms, in the order used for charge changes
+        exception_pairs (numpy array of shape [nexceptions, 2]) - particle pairs of all exceptions involving at least one titratable atom
+        exception_weights (numpy array of shape [nexceptions]) - factor by which the Coulomb interaction of each exception pair is scaled
+                                                                  (coulomb14scale for 1,4 interactions, 0 for exclusions)
+
+        """
+        self.charges = numpy.array(charges, numpy.float64)
+        self.titratable_atoms = numpy.array(titratable_atoms, numpy.int64)
+        self.exception_pairs = numpy.array(exception_pairs, numpy.int64).reshape([-1,2])
+        self.exception_weights = numpy.array(exception_weights, numpy.float64)
+
+        # Titratable-local index of each exception particle, or -1 if it is not titratable.
+        local_indices = - numpy.ones([len(self.charges)], numpy.int64)
+        local_indices[self.titratable_atoms] = numpy.arange(len(self.titratable_atoms))
+        self.exception_local_indices = local_indices[self.exception_pairs]
+
+        AnalyticChargeEnergy.__init__(self)
+
+        return
+
+    def setConfiguration(self, positions, titratable_charges):
+        positions = numpy.asarray(positions, numpy.float64)
+        charges = self.charges.copy()
+        charges[self.titratable_atoms] = titratable_charges
+        ntitratable = len(self.titratable_atoms)
+        natoms = len(charges)
+        one_4pi_eps0 = _getCoulombConstant()
+
+        # Full Coulomb interactions of each titratable atom with all other atoms, in blocks of rows to bound memory use.
+        potentials = numpy.zeros([ntitratable], numpy.float64)
+        kernel = numpy.zeros([ntitratable, ntitratable], numpy.float64)
+        block_size = max(1, 2**20 // max(natoms, 1))
+        for start in range(0, ntitratable, block_size):
+            rows = numpy.arange(start, min(start+block_size, ntitratable))
+            delta = positions[self.titratable_atoms[rows],numpy.newaxis,:] - positions[numpy.newaxis,:,:]
+            r2 = (delta**2).sum(axis=2)
+            r2[numpy.arange(len(rows)), self.titratable_atoms[rows]] = numpy.inf # no self-interaction
+            inverse_r = one_4pi_eps0 / numpy.sqrt(r2)
+            potentials[rows] = inverse_r.dot(charges)
+            kernel[rows,:] = inverse_r[:,self.titratable_atoms]
+
+        # Replace full interactions of exception pairs by scaled ones.
+        if len(self.exception_pairs) > 0:
+            (particle1, particle2) = (self.exception_pairs[:,0], self.exception_pairs[:,1])
+            (local1, local2) = (self.exception_local_indices[:,0], self.exception_local_indices[:,1])
+            r = numpy.sqrt(((positions[particle1,:] - positions[particle2,:])**2).sum(axis=1))
+            correction = one_4pi_eps0 * (self.exception_weights - 1.0) / r
+            mask = (local1 >= 0)
+            numpy.add.at(potentials, local1[mask], correction[mask] * charges[particle2[mask]])
+            mask = (local2 >= 0)
+            numpy.add.at(potentials, local2[mask], correction[mask] * charges[particle1[mask]])
+            mask = (local1 >= 0) & (local2 >= 0)
+            numpy.add.at(kernel, (local1[mask], local2[mask]), correction[mask])
+            numpy.add.at(kernel, (local2[mask], local1[mask]), correction[mask])
+
+        self.potentials = potentials
+        self.kernel = kernel
+        self.energy = 0.0
+
+        return
+
+class AnalyticGBEnergy(AnalyticChargeEnergy):
+    """
+    Exact generalized Born energy changes for changes in the charges of titratable atoms, for the OBC2 model without cutoff.
+
+    Born radii are computed once per configuration.  As long as they do not depend on the charges, the polarization energy
+
+    E = 1/2 sum_ij q_i q_j K_ij,  K_ij = - (1/(4 pi eps0)) (1/soluteDielectric - 1/solventDielectric) / f_ij
+
+    with f_ij = sqrt(r_ij^2 + B_i B_j exp(-r_ij^2 / (4 B_i B_j))) (and f_ii = B_i) is a quadratic form in the charges.
+
+    NOTE
+
+    In the cnstphgbforces variants (exclude_uncharged), atoms with zero charge are excluded from the Born radius integrals, so a
+    charge change to or from zero changes the Born radii of all atoms.  The Born radius integrals are updated exactly with the
+    contributions of the toggled atoms, at O(natoms) cost per toggled atom, but the energy is only corrected for the atoms whose
+    radii change significantly: with dE/dB_i the derivative of the energy with respect to the Born radius of atom i, the radius
+    changes dB_i of the other atoms are neglected as long as the sum of |dE/dB_i dB_i| over them does not exceed energy_tolerance.
+    The correction then costs O(natoms) per atom whose charge or radius changes.  Neglected radius changes are carried over, so
+    they are included in later corrections once they have grown, and the error of the energy stays bounded by energy_tolerance
+    to first order.  With energy_tolerance = 0, energies are exact.
+
+    """
+
+    def __init__(self, charges, radii, scales, titratable_atoms, solvent_dielectric, solute_dielectric, offset=0.009, surface_area_factor=28.3919551, engulfment=True, exclude_uncharged=False, energy_tolerance=0.01):
+        """
+        ARGUMENTS
+
+        charges (numpy array of shape [natoms]) - unit-free charges of all atoms; entries of titratable atoms are replaced in setConfiguration()
+        radii (numpy array of shape [natoms]) - atomic radii, in nm
+        scales (numpy array of shape [natoms]) - overlap scale factors
+        titratable_atoms (numpy array of int) - indices of titratable atoms, in the order used for charge changes
+        solvent_dielectric (float) - solvent dielectric constant
+        solute_dielectric (float) - solute dielectric constant
+
+        OPTIONAL ARGUMENTS
+
+        offset (float) - dielectric offset subtracted from the radii, in nm (default: 0.009)
+        surface_area_factor (float) - prefactor of the ACE surface area term, in kJ/mol/nm^2, or 0 for none (default: 28.3919551)
+        engulfment (boolean) - if True, the integral is corrected for atoms engulfed by the scaled radius of another atom, as in GBSAOBCForce (default: True)
+        exclude_uncharged (boolean) - if True, atoms with zero charge are excluded from the Born radius integrals, as in cnstphgbforces (default: False)
+        energy_tolerance (float) - bound, in kJ/mol, on the first-order energy error of neglected Born radius changes when atoms are
+                                   excluded from or included in the integrals by a charge change; 0 for exact energies (default: 0.01)
+
+        """
+        self.charges = numpy.array(charges, numpy.float64)
+        self.radii = numpy.array(radii, numpy.float64)
+        self.offset_radii = self.radii - offset
+        self.scaled_radii = numpy.array(scales, numpy.float64) * self.offset_radii
+        self.titratable_atoms = numpy.array(titratable_atoms, numpy.int64)
+        self.prefactor = - _getCoulombConstant() * (1.0/solute_dielectric - 1.0/solvent_dielectric)
+        self.surface_area_factor = surface_area_factor
+        self.engulfment = engulfment
+        self.exclude_uncharged = exclude_uncharged
+        self.energy_tolerance = energy_tolerance
+
+        self.positions = None
+        self.born_integrals = None # sums of integrals over all included atoms, before exclusion of the atom itself
+        self.born_radii = None # Born radii in use, which may lag behind those of the integrals by neglected changes
+        self.radius_derivatives = None # derivative of the energy with respect to each Born radius in use, if exclude_uncharged
+        self.total_energy = None # absolute energy of the current charges
+        self._changed = None # (key, change) of the last evaluated change of Born radii, as returned by _getChangedBornRadii()
+
+        AnalyticChargeEnergy.__init__(self)
+
+        return
+
+    def _getBlockSize(self):
+        """
+        Return the number of rows of pair matrices to process at once, bounding memory use.
+
+        """
+        return max(1, 2**20 // max(len(self.charges), 1))
+
+    def _getIncluded(self, charges):
+        """
+        Return 1 for atoms included in the Born radius integrals and 0 otherwise, for the given charges.
+
+        """
+        if not self.exclude_uncharged:
+            return numpy.ones([len(charges)], numpy.float64)
+        return (numpy.abs(charges) >= 0.00000001).astype(numpy.float64)
+
+    def _getBornIntegrals(self, rows, columns):
+        """
+        Return the contributions of the atoms in columns to the Born radius integrals of the atoms in rows.
+
+        ARGUMENTS
+
+        rows (numpy array of int) - atom indices
+        columns (numpy array of int) - atom indices
+
+        RETURNS
+
+        integrals (numpy array of shape [len(rows), len(columns)]) - the integral contributions, zero for an atom with itself
+
+        """
+        delta = self.positions[rows,numpy.newaxis,:] - self.positions[numpy.newaxis,columns,:]
+        r = numpy.sqrt((delta**2).sum(axis=2))
+        same = (rows[:,numpy.newaxis] == columns[numpy.newaxis,:])
+        r[same] = 1.0
+        or1 = self.offset_radii[rows][:,numpy.newaxis]
+        sr2 = self.scaled_radii[columns][numpy.newaxis,:]
+        U = r + sr2
+        L = numpy.maximum(or1, numpy.abs(r - sr2))
+        integrals = 0.5*(1/L - 1/U + 0.25*(r - sr2**2/r)*(1/(U**2) - 1/(L**2)) + 0.5*numpy.log(L/U)/r)
+        if self.engulfment:
+            integrals += (1/or1 - 1/L) * (sr2 - r - or1 >= 0)
+        integrals *= (r + sr2 - or1 >= 0)
+        integrals[same] = 0.0
+
+        return integrals
+
+    def _getBornRadii(self, born_integrals, included):
+        """
+        Return the OBC2 Born radii for the given integrals and included atoms.
+
+        """
+        if self.exclude_uncharged:
+            born_integrals = born_integrals * included
+        psi = born_integrals * self.offset_radii
+        return 1.0 / (1.0/self.offset_radii - numpy.tanh(psi - 0.8*psi**2 + 4.85*psi**3)/self.radii)
+
+    def _getSurfaceAreaEnergies(self, atoms, born_radii):
+        """
+        Return the surface area energy of each of the specified atoms, and its derivative with respect to the Born radius of the atom.
+
+        """
+        if not self.surface_area_factor:
+            return (numpy.zeros([len(atoms)], numpy.float64), numpy.zeros([len(atoms)], numpy.float64))
+        energies = self.surface_area_factor * (self.radii[atoms] + 0.14)**2 * (self.radii[atoms]/born_radii)**6
+        return (energies, -6.0 * energies / born_radii)
+
+    def _getPairTerms(self, rows, charges, born_radii):
+        """
+        Return the polarization pair terms of the atoms in rows with all atoms, and their derivatives with respect to the Born radii.
+
+        ARGUMENTS
+
+        rows (numpy array of int) - atom indices
+        charges (numpy array of shape [natoms]) - charges of all atoms
+        born_radii (numpy array of shape [natoms]) - Born radii of all atoms
+
+        RETURNS
+
+        terms (numpy array of shape [len(rows), natoms]) - q_i q_j / f_ij for atom i in rows and atom j
+        derivatives (numpy array of shape [len(rows), natoms]) - q_i q_j B_j d(1/f_ij)/d(B_i B_j), so that the derivative of the term
+                                                                 with respect to B_i is derivatives[i,j], and with respect to B_j it is
+                                                                 derivatives[i,j] B_i / B_j
+
+        """
+        r2 = ((self.positions[rows,numpy.newaxis,:] - self.positions[numpy.newaxis,:,:])**2).sum(axis=2)
+        BB = born_radii[rows,numpy.newaxis] * born_radii[numpy.newaxis,:]
+        expterm = numpy.exp(-r2/(4*BB))
+        f = numpy.sqrt(r2 + BB*expterm)
+        charge_products = charges[rows,numpy.newaxis] * charges[numpy.newaxis,:]
+        terms = charge_products / f
+        derivatives = - charge_products * born_radii[numpy.newaxis,:] * expterm * (1 + r2/(4*BB)) / (2*f**3)
+
+        return (terms, derivatives)
+
+    def _getTotalEnergy(self, charges, born_radii):
+        """
+        Return the absolute GB energy for the given charges and Born radii, and its derivative with respect to each Born radius.
+
+        """
+        natoms = len(charges)
+        energy = 0.0
+        radius_derivatives = numpy.zeros([natoms], numpy.float64)
+        block_size = self._getBlockSize()
+        for start in range(0, natoms, block_size):
+            rows = numpy.arange(start, min(start+block_size, natoms))
+            (terms, derivatives) = self._getPairTerms(rows, charges, born_radii)
+            energy += 0.5 * self.prefactor * terms.sum()
+            radius_derivatives[rows] = self.prefactor * derivatives.sum(axis=1)
+        (surface_area_energies, surface_area_derivatives) = self._getSurfaceAreaEnergies(numpy.arange(natoms), born_radii)
+        energy += surface_area_energies.sum()
+        radius_derivatives += surface_area_derivatives
+
+        return (energy, radius_derivatives)
+
+    def _getLocalChange(self, atoms, charges, born_radii):
+        """
+        Return the change in energy, and in its derivatives with respect to the Born radii, when the charges and Born radii of the
+        specified atoms are changed, at O(len(atoms) natoms) cost.
+
+        ARGUMENTS
+
+        atoms (numpy array of int) - the atoms whose charges or Born radii change; all other atoms keep theirs
+        charges (numpy array of shape [natoms]) - the new charges of all atoms
+        born_radii (numpy array of shape [natoms]) - the new Born radii of all atoms
+
+        RETURNS
+
+        delta_energy (float) - the energy change
+        radius_derivatives (numpy array of shape [natoms]) - the new derivatives of the energy with respect to the Born radii
+
+        """
+        radius_derivatives = self.radius_derivatives.copy() if (self.radius_derivatives is not None) else None
+        delta_energy = 0.0
+        block_size = self._getBlockSize()
+        column_changes = numpy.zeros([len(charges)], numpy.float64)
+        for start in range(0, len(atoms), block_size):
+            rows = atoms[start:start+block_size]
+            (old_terms, old_derivatives) = self._getPairTerms(rows, self.charges, self.born_radii)
+            (new_terms, new_derivatives) = self._getPairTerms(rows, charges, born_radii)
+            # Pairs with at least one changed atom, counting pairs of two changed atoms once.
+            delta_terms = new_terms - old_terms
+            delta_energy += self.prefactor * (delta_terms.sum() - 0.5 * delta_terms[:,atoms].sum())
+            if radius_derivatives is not None:
+                radius_derivatives[rows] = self.prefactor * new_derivatives.sum(axis=1)
+                column_changes += (new_derivatives * (born_radii[rows,numpy.newaxis] / born_radii[numpy.newaxis,:])).sum(axis=0)
+                column_changes -= (old_derivatives * (self.born_radii[rows,numpy.newaxis] / self.born_radii[numpy.newaxis,:])).sum(axis=0)
+
+        (old_energies, old_derivatives) = self._getSurfaceAreaEnergies(atoms, self.born_radii[atoms])
+        (new_energies, new_derivatives) = self._getSurfaceAreaEnergies(atoms, born_radii[atoms])
+        delta_energy += (new_energies - old_energies).sum()
+        if radius_derivatives is not None:
+            # Unchanged atoms only see the changes of their pair terms with the changed atoms.
+            unchanged = numpy.ones([len(charges)], numpy.bool_)
+            unchanged[atoms] = False
+            radius_derivatives[unchanged] += self.prefactor * column_changes[unchanged]
+            radius_derivatives[atoms] += new_derivatives
+
+        return (delta_energy, radius_derivatives)
+
+    def _updateKernel(self):
+        """
+        Compute the potentials at, and the kernel between, titratable atoms for the current charges and Born radii.
+
+        """
+        ntitratable = len(self.titratable_atoms)
+        self.potentials = numpy.zeros([ntitratable], numpy.float64)
+        self.kernel = numpy.zeros([ntitratable, ntitratable], numpy.float64)
+        block_size = self._getBlockSize()
+        for start in range(0, ntitratable, block_size):
+            rows = numpy.arange(start, min(start+block_size, ntitratable))
+            atoms = self.titratable_atoms[rows]
+            r2 = ((self.positions[atoms,numpy.newaxis,:] - self.positions[numpy.newaxis,:,:])**2).sum(axis=2)
+            BB = self.born_radii[atoms,numpy.newaxis] * self.born_radii[numpy.newaxis,:]
+            kernel = self.prefactor / numpy.sqrt(r2 + BB*numpy.exp(-r2/(4*BB)))
+            self.potentials[rows] = kernel.dot(self.charges)
+            self.kernel[rows,:] = kernel[:,self.titratable_atoms]
+
+        return
+
+    def setConfiguration(self, positions, titratable_charges):
+        self.positions = numpy.asarray(positions, numpy.float64)
+        self.charges[self.titratable_atoms] = titratable_charges
+        natoms = len(self.charges)
+
+        # Born radius integrals, in blocks of rows to bound memory use.
+        included = self._getIncluded(self.charges)
+        self.born_integrals = numpy.zeros([natoms], numpy.float64)
+        block_size = self._getBlockSize()
+        for start in range(0, natoms, block_size):
+            rows = numpy.arange(start, min(start+block_size, natoms))
+            self.born_integrals[rows] = self._getBornIntegrals(rows, numpy.arange(natoms)).dot(included)
+        self.born_radii = self._getBornRadii(self.born_integrals, included)
+
+        (self.total_energy, radius_derivatives) = self._getTotalEnergy(self.charges, self.born_radii)
+        self.radius_derivatives = radius_derivatives if self.exclude_uncharged else None
+        self._updateKernel()
+        self._changed = None
+        self.energy = 0.0
+
+        return
+
+    def _getToggledAtoms(self, indices, delta_charges):
+        """
+        Return the atoms whose inclusion in the Born radius integrals changes with the given charge changes.
+
+        """
+        if not self.exclude_uncharged:
+            return numpy.zeros([0], numpy.int64)
+        atoms = self.titratable_atoms[indices]
+        changed = (self._getIncluded(self.charges[atoms]) != self._getIncluded(self.charges[atoms] + delta_charges))
+        return atoms[changed]
+
+    def _getChangedBornRadii(self, indices, delta_charges, toggled_atoms):
+        """
+        Return the state after a change that toggles the inclusion of some atoms.
+
+        RETURNS
+
+        change (tuple) - (charges, born_integrals, born_radii, delta_energy, radius_derivatives), where born_radii are the Born radii in
+                         use after the change, which only differ from the current ones for the atoms whose changes are not neglected
+
+        """
+        key = (tuple(indices), tuple(delta_charges))
+        if (self._changed is not None) and (self._changed[0] == key):
+            return self._changed[1]
+
+        charges = self.charges.copy()
+        charged_atoms = self.titratable_atoms[indices]
+        charges[charged_atoms] += delta_charges
+        included = self._getIncluded(charges)
+        signs = included[toggled_atoms] - self._getIncluded(self.charges)[toggled_atoms]
+        born_integrals = self.born_integrals + self._getBornIntegrals(numpy.arange(len(charges)), toggled_atoms).dot(signs)
+        exact_born_radii = self._getBornRadii(born_integrals, included)
+
+        # Neglect the radius changes of the atoms with the smallest estimated energy changes, up to energy_tolerance in total.
+        changed = numpy.zeros([len(charges)], numpy.bool_)
+        changed[charged_atoms] = True
+        estimates = numpy.abs(self.radius_derivatives * (exact_born_radii - self.born_radii))
+        estimates[changed] = 0.0
+        order = numpy.argsort(estimates)
+        neglected = numpy.cumsum(estimates[order]) <= self.energy_tolerance
+        changed[order[~neglected]] = True
+        atoms = numpy.where(changed)[0]
+        born_radii = self.born_radii.copy()
+        born_radii[atoms] = exact_born_radii[atoms]
+
+        (delta_energy, radius_derivatives) = self._getLocalChange(atoms, charges, born_radii)
+        self._changed = (key, (charges, born_integrals, born_radii, delta_energy, radius_derivatives))
+
+        return self._changed[1]
+
+    def getEnergyChange(self, indices, delta_charges):
+        toggled_atoms = self._getToggledAtoms(indices, delta_charges)
+        if len(toggled_atoms) == 0:
+            return AnalyticChargeEnergy.getEnergyChange(self, indices, delta_charges)
+
+        (charges, born_integrals, born_radii, delta_energy, radius_derivatives) = self._getChangedBornRadii(indices, delta_charges, toggled_atoms)
+        return delta_energy
+
+    def applyChange(self, indices, delta_charges):
+        if len(indices) == 0:
+            return
+        toggled_atoms = self._getToggledAtoms(indices, delta_charges)
+        if len(toggled_atoms) == 0:
+            delta_energy = AnalyticChargeEnergy.getEnergyChange(self, indices, delta_charges)
+            AnalyticChargeEnergy.applyChange(self, indices, delta_charges)
+            charges = self.charges.copy()
+            charges[self.titratable_atoms[indices]] += delta_charges
+            if self.radius_derivatives is not None:
+                (local_delta_energy, self.radius_derivatives) = self._getLocalChange(numpy.unique(self.titratable_atoms[indices]), charges, self.born_radii)
+            self.charges = charges
+            self.total_energy += delta_energy
+            self._changed = None
+            return
+
+        (charges, born_integrals, born_radii, delta_energy, radius_derivatives) = self._getChangedBornRadii(indices, delta_charges, toggled_atoms)
+        self.energy += delta_energy
+        (self.charges, self.born_integrals, self.born_radii, self.radius_derivatives) = (charges, born_integrals, born_radii, radius_derivatives)
+        self.total_energy += delta_energy
+        self._updateKernel()
+        self._changed = None
+
+        return
@@ -226,3 +226,140 @@ def register():
     other.GBSAOBC2Force = GBSAOBC2Force
     other.GBSAGBnForce = GBSAGBnForce
     other.GBSAGBn2Force = GBSAGBn2Force
+
+"""
+Stock GBSAOBCForce (OBC2 parameters) as a CustomGBForce
+"""
+def GBSAOBCForceAsCustomGBForce(force):
+    """
+    Returns a CustomGBForce equivalent to the given GBSAOBCForce, with the same
+    per-particle parameters (q, radius, scale). Unlike the variants above,
+    uncharged atoms are not excluded from the Born radius integral, and the
+    engulfment correction of the native OBC implementation is included. The
+    surface area term follows the force's surface area energy where the OpenMM
+    version reports it, and the default of 2.25936 kJ/mol/nm^2 otherwise.
+    """
+    from simtk import unit as u
+    from math import pi
+    if force.getNonbondedMethod() != force.NoCutoff:
+        raise ValueError('Only NoCutoff GBSAOBCForce objects can be converted')
+
+    custom = CustomGBForce()
+
+    custom.addPerParticleParameter("q")
+    custom.addPerParticleParameter("radius")
+    custom.addPerParticleParameter("scale")
+    custom.addGlobalParameter("solventDielectric", force.getSolventDielectric())
+    custom.addGlobalParameter("soluteDielectric", force.getSoluteDielectric())
+    custom.addGlobalParameter("offset", 0.009)
+    custom.addComputedValue("I",  "step(r+sr2-or1)*0.5*(1/L-1/U+0.25*(r-sr2^2/r)*(1/(U^2)-1/(L^2))+0.5*log(L/U)/r+C);"
+                                  "C=2*(1/or1-1/L)*step(sr2-r-or1);" # engulfment correction
+                                  "U=r+sr2;"
+                                  "L=max(or1, D);"
+                                  "D=abs(r-sr2);"
+                                  "sr2 = scale2*or2;"
+                                  "or1 = radius1-offset; or2 = radius2-offset", CustomGBForce.ParticlePairNoExclusions)
+
+    custom.addComputedValue("B", "1/(1/or-tanh(psi-0.8*psi^2+4.85*psi^3)/radius);"
+                                  "psi=I*or; or=radius-offset", CustomGBForce.SingleParticle)
+    surface_area_energy = 2.25936
+    if hasattr(force, 'getSurfaceAreaEnergy'):
+        surface_area_energy = force.getSurfaceAreaEnergy()
+        if u.is_quantity(surface_area_energy):
+            surface_area_energy = surface_area_energy.value_in_unit(
+                    u.kilojoule_per_mole / u.nanometer**2)
+    if abs(surface_area_energy - 2.25936) < 1e-6:
+        # The default, for which the standard ACE term is used
+        _createEnergyTerms(custom, 'ACE', None)
+    else:
+        _createEnergyTerms(custom, None, None)
+        if surface_area_energy != 0:
+            custom.addEnergyTerm("%r*(radius+0.14)^2*(radius/B)^6" %
+                                 (4 * pi * surface_area_energy),
+                                 CustomGBForce.SingleParticle)
+
+    for index in range(force.getNumParticles()):
+        charge, radius, scale = force.getParticleParameters(index)
+        if u.is_quantity(charge): charge = charge.value_in_unit(u.elementary_charge)
+        if u.is_quantity(radius): radius = radius.value_in_unit(u.nanometer)
+        custom.addParticle([charge, radius, scale])
+    return custom
+
+def ComputedChargeGBForce(force, charge_expression, parameter_names,
+                          parameter_values, global_parameters=()):
+    """
+    Returns a copy of a CustomGBForce in which the per-particle charge "q" is
+    replaced by a SingleParticle computed value. charge_expression(suffix)
+    returns the expression for the charge, in terms of the per-particle
+    parameters named in parameter_names with the given suffix appended ('' for
+    single particles, '1' or '2' for pairs). The values of these parameters for
+    each particle are given by parameter_values; the global parameters named in
+    global_parameters are added with a default of 0.
+
+    The CUDA and OpenCL platforms require the first computed value to be a
+    ParticlePair value, so the charge is computed right after it. Computed
+    ParticlePair values that use q1 or q2 (such as the Born radius integrals
+    that exclude uncharged atoms) get their own definitions of the charges of
+    both particles. Energy terms are copied verbatim, so they now see the
+    computed charge wherever they used "q".
+    """
+    import re
+    custom = CustomGBForce()
+
+    # Per-particle parameters, dropping the charge
+    names = [force.getPerParticleParameterName(i)
+             for i in range(force.getNumPerParticleParameters())]
+    if 'q' not in names:
+        raise ValueError('CustomGBForce has no per-particle parameter "q"')
+    charge_index = names.index('q')
+    for name in names:
+        if name != 'q': custom.addPerParticleParameter(name)
+    for name in parameter_names:
+        custom.addPerParticleParameter(name)
+    for i in range(force.getNumParticles()):
+        params = list(force.getParticleParameters(i))
+        del params[charge_index]
+        custom.addParticle(params + list(parameter_values[i]))
+
+    # Global parameters, including those referenced by the charge expression
+    existing = []
+    for i in range(force.getNumGlobalParameters()):
+        existing.append(force.getGlobalParameterName(i))
+        custom.addGlobalParameter(force.getGlobalParameterName(i),
+                                  force.getGlobalParameterDefaultValue(i))
+    for name in global_parameters:
+        if name not in existing:
+            custom.addGlobalParameter(name, 0.0)
+
+    # Tabulated functions (the API changed between OpenMM versions)
+    if hasattr(force, 'getNumTabulatedFunctions'):
+        for i in range(force.getNumTabulatedFunctions()):
+            custom.addTabulatedFunction(force.getTabulatedFunctionName(i),
+                                        force.getTabulatedFunction(i).Copy())
+    else:
+        for i in range(force.getNumFunctions()):
+            custom.addFunction(*force.getFunctionParameters(i))
+
+    pair_types = (CustomGBForce.ParticlePair,
+                  CustomGBForce.ParticlePairNoExclusions)
+    values = [list(force.getComputedValueParameters(i))
+              for i in range(force.getNumComputedValues())]
+    for value in values:
+        if value[2] in pair_types and re.search(r'\bq[12]\b', value[1]):
+            value[1] = '%s;q1=%s;q2=%s' % (value[1], charge_expression('1'),
+                                           charge_expression('2'))
+    position = 0
+    if values and values[0][2] in pair_types: position = 1
+    values.insert(position, ['q', charge_expression(''),
+                             CustomGBForce.SingleParticle])
+    for value in values:
+        custom.addComputedValue(*value)
+    for i in range(force.getNumEnergyTerms()):
+        custom.addEnergyTerm(*force.getEnergyTermParameters(i))
+    for i in range(force.getNumExclusions()):
+        custom.addExclusion(*force.getExclusionParticles(i))
+
+    custom.setNonbondedMethod(force.getNonbondedMethod())
+    custom.setCutoffDistance(force.getCutoffDistance())
+    custom.setForceGroup(force.getForceGroup())
+    return custom
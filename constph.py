@@ -30,12 +30,8 @@ EXAMPLES
 
 TODO
 
-* Add NCMC switching moves to allow this scheme to be efficient in explicit solvent.
-* Add alternative proposal types, including schemes that avoid proposing self-transitions (or always accept them):
-  - Parallel Monte Carlo schemes: Compute N proposals at once, and pick using Gibbs sampling or Metropolized Gibbs?
 * Allow specification of probabilities for selecting N residues to change protonation state at once.
 * Add calibrate() method to automagically adjust relative energies of protonation states of titratable groups in molecule.
-* Add automatic tuning of switching times for optimal acceptance.
 * Extend to handle systems set up via OpenMM app Forcefield class.
 
 COPYRIGHT AND LICENSE
@@ -48,18 +44,30 @@ COPYRIGHT AND LICENSE
 # GLOBAL IMPORTS
 #=============================================================================================
 
-import re
 import os
 import sys
 import math
 import random
 import copy
 import time
+import itertools
+import warnings
+import weakref
+import multiprocessing
+
+import numpy
 
 import simtk
 import simtk.openmm as openmm
 import simtk.unit as units
 
+import cnstphgbforces
+import cpinutils.namelist
+from constphutils import _strip_units, _strip_charges, _logsumexp
+from analyticenergy import AnalyticCoulombEnergy, AnalyticGBEnergy, _getCoulombConstant
+from titrationcache import TitrationEnergyCache
+from scoringworkers import _initializeScoringWorker, _scoreTitrationStates, _sampleTitrationStates
+
 #=============================================================================================
 # MODULE CONSTANTS
 #=============================================================================================
@@ -67,29 +75,17 @@ import simtk.unit as units
 kB = units.BOLTZMANN_CONSTANT_kB * units.AVOGADRO_CONSTANT_NA
 
 #=============================================================================================
-# Monte Carlo titration.
+# Titratable groups and titration forces.
 #=============================================================================================
 
-class MonteCarloTitration(object):
+class TitrationDriver(object):
     """
-    Monte Carlo titration driver for constnat-pH dynamics.
-
-    This move type implements the constant-pH dynamics of Mongan and Case [1].
-
-    REFERENCES
-
-    [1] Mongan J, Case DA, and McCammon JA. Constant pH molecular dynamics in generalized Born implicit solvent. J Comput Chem 25:2038, 2004.
-    http://dx.doi.org/10.1002/jcc.20139
-    
-    [2] Stern HA. Molecular simulation with variable protonation states at constant pH. JCP 126:164112, 2007.
-    http://link.aip.org/link/doi/10.1063/1.2731781
-    
-    [3] Nonequilibrium candidate Monte Carlo is an efficient tool for equilibrium simulation. PNAS 108:E1009, 2011.
-    http://dx.doi.org/10.1073/pnas.1106094108
-
-    TODO
+    Titratable groups and states of a System, with the parameter tables and titration forces shared by titration drivers.
 
-    * Add methods to keep track of history of protonation states.
+    The driver holds the titratable groups and their states, compiles them into unit-free parameter tables, and moves the forces
+    that depend on the charges of titratable atoms into dedicated force groups.  If requested, electrostatics of titratable atoms are
+    moved into Custom forces whose charges are controlled by global parameters.  How titration states are sampled is left to the
+    subclasses: MonteCarloTitration by discrete Monte Carlo moves, LambdaDynamicsTitration (see lambdadynamics) by continuous lambda-dynamics.
 
     """
 
@@ -97,113 +93,154 @@ class MonteCarloTitration(object):
     # Initialization.
     #=============================================================================================
 
-    def __init__(self, system, temperature, pH, prmtop, cpin_filename, nattempts_per_update=None, simultaneous_proposal_probability=0.1, debug=False):
+    def __init__(self, system, temperature, pH, prmtop, use_global_parameters=False, debug=False):
         """
-        Initialize a Monte Carlo titration driver for constant pH simulation.
+        Initialize the titratable groups and titration forces of a System.
 
         ARGUMENTS
 
         system (simtk.openmm.System) - system to be titrated, containing all possible protonation sites
         temperature (simtk.unit.Quantity compatible with simtk.unit.kelvin) - temperature to be simulated
-        pH (float) - the pH to be simulated 
-        prmtop (Prmtop) - parsed AMBER 'prmtop' file (necessary to provide information on exclusions)
-        cpin_filename (string) - AMBER 'cpin' file defining protonation charge states and energies
+        pH (float) - the pH to be simulated
+        prmtop (simtk.openmm.app.AmberPrmtopFile) - parsed AMBER 'prmtop' file; 1,4 exceptions are identified from the System, and its bonds
+                                                    are only used if the System defines neither bonds nor constraints, so it may be None
 
         OPTIONAL ARGUMENTS
-        
-        nattempts_per_update (int) - number of protonation state change attempts per update call; 
-                                   if None, set automatically based on number of titratible groups (default: None)
-        simultaneous_proposal_probability (float) - probability of simultaneously proposing two updates
+
+        use_global_parameters (boolean) - if True, electrostatics of titratable atoms are computed by Custom forces whose charges are
+                                          controlled by global parameters; requires NoCutoff electrostatics, so explicit-solvent (PME)
+                                          Systems are not covered (default: False)
         debug (boolean) - turn debug information on/off
 
-        TODO
+        NOTE
 
-        * Allow constant-pH dynamics to be initialized in other ways than using the AMBER cpin file (e.g. from OpenMM app; automatically).
-        * Generalize simultaneous_proposal_probability to allow probability of single, double, triple, etc. proposals to be specified?
+        The forces modified by titration (NonbondedForce, GBSAOBCForce, and CustomGBForce objects with a 'q' per-particle parameter)
+        are moved into dedicated force groups, so the driver must be constructed before any Context is created for the System.
 
         """
 
-        # Set defaults.
-        self.simultaneous_proposal_probability = simultaneous_proposal_probability # probability of proposing two simultaneous protonation state changes
-
         # Store parameters.
         self.system = system
         self.temperature = temperature
         self.pH = pH
-        self.cpin_filename = cpin_filename
+        self.prmtop = prmtop
+        self.use_global_parameters = use_global_parameters
         self.debug = debug
 
         # Initialize titration group records.
         self.titrationGroups = list()
-        self.titrationStates = list()
+
+        # Compiled parameter tables are built lazily and invalidated whenever groups or states are added.
+        self._compiled = False
 
         # Determine 14 Coulomb and Lennard-Jones scaling from system.
-        # TODO: Get this from prmtop file?
         self.coulomb14scale = self.get14scaling(system)
 
-        # Store list of exceptions that may need to be modified.        
-        self.atomExceptions = [ list() for index in range(prmtop._prmtop.getNumAtoms()) ]
-        for (atom1, atom2, chargeProd, rMin, epsilon, iScee, iScnb) in prmtop._prmtop.get14Interactions():
-            self.atomExceptions[atom1].append(atom2)
-            self.atomExceptions[atom2].append(atom1)                                        
+        # Index of NonbondedForce exceptions by particle, and bonded neighbors of each particle, built when exceptions of titratable groups are first needed.
+        self._exceptionIndex = None
+        self._bondedNeighbors = None
+
+        # Index of the titratable group containing each atom, or -1.
+        self._atomGroupIndices = -numpy.ones([system.getNumParticles()], numpy.int64)
 
         # Store force object pointers.
-        # TODO: Add Custom forces.
-        force_classes_to_update = ['NonbondedForce', 'GBSAOBCForce']
+        force_classes_to_update = ['NonbondedForce', 'GBSAOBCForce', 'CustomGBForce']
         self.forces_to_update = list()
+        self._force_indices = list() # index in the System of each force in self.forces_to_update
+        self._charge_parameter_indices = list() # index of the charge in the per-particle parameters of each force
         for force_index in range(self.system.getNumForces()):
             force = self.system.getForce(force_index)
-            if force.__class__.__name__ in force_classes_to_update:
-                self.forces_to_update.append(force)            
+            force_classname = force.__class__.__name__
+            if force_classname not in force_classes_to_update:
+                continue
+            if force_classname == 'CustomGBForce':
+                parameter_names = [ force.getPerParticleParameterName(index) for index in range(force.getNumPerParticleParameters()) ]
+                if 'q' not in parameter_names:
+                    continue
+                self._charge_parameter_indices.append(parameter_names.index('q'))
+            else:
+                self._charge_parameter_indices.append(0)
+            self.forces_to_update.append(force)            
+            self._force_indices.append(force_index)
 
-        if cpin_filename:
-            # Load AMBER cpin file defining protonation states.
-            namelist = self._parse_fortran_namelist(cpin_filename, 'CNSTPH')
-
-            # Make sure RESSTATE is a list.
-            if type(namelist['RESSTATE'])==int:
-                namelist['RESSTATE'] = [namelist['RESSTATE']]    
-
-            # Extract number of titratable groups.
-            self.ngroups = len(namelist['RESSTATE'])
-
-            # Define titratable groups and titration states.
-            for group_index in range(self.ngroups):
-                # Extract information about this titration group.
-                first_atom = namelist['STATEINF(%d)%%FIRST_ATOM' % group_index] - 1
-                first_charge = namelist['STATEINF(%d)%%FIRST_CHARGE' % group_index]
-                first_state = namelist['STATEINF(%d)%%FIRST_STATE' % group_index]
-                num_atoms = namelist['STATEINF(%d)%%NUM_ATOMS' % group_index]
-                num_states = namelist['STATEINF(%d)%%NUM_STATES' % group_index]
-                
-                # Define titratable group.
-                atom_indices = range(first_atom, first_atom+num_atoms)
-                self.addTitratableGroup(atom_indices)
-                
-                # Define titration states.
-                for titration_state in range(num_states):
-                    # Extract charges for this titration state.
-                    charges = namelist['CHRGDAT'][(first_charge+num_atoms*titration_state):(first_charge+num_atoms*(titration_state+1))]
-                    charges = units.Quantity(charges, units.elementary_charge)
-                    # Extract relative energy for this titration state.
-                    relative_energy = namelist['STATENE'][first_state+titration_state] * units.kilocalories_per_mole
-                    # Don't use pKref for AMBER cpin files---reference pKa contribution is already included in relative_energy.
-                    pKref = 0.0
-                    # Get proton count.
-                    proton_count = namelist['PROTCNT'][first_state+titration_state]
-                    # Create titration state.
-                    self.addTitrationState(group_index, pKref, relative_energy, charges, proton_count)
-
-                # Set default state for this group.
-                self.setTitrationState(group_index, namelist['RESSTATE'][group_index])
+        # Flags indicating which forces in self.forces_to_update have parameters not yet pushed to the Context.
+        self._forces_modified = [ False for force in self.forces_to_update ]
 
-        self.setNumAttemptsPerUpdate(nattempts_per_update)
+        # Move the forces we modify into dedicated force groups.
+        self._titration_forces = list(self.forces_to_update) # forces whose energies depend on the titration states
+        self._titration_force_indices = list(self._force_indices) # index in the System of each of these forces
+        self._original_force_groups = list()
+        self._verified_contexts = weakref.WeakKeyDictionary() # Contexts whose force groups have been checked against the System
+        self._assignTitrationForceGroups()
+
+        # Global parameters controlling titration states, if use_global_parameters is set; built when tables are compiled.
+        self._global_parameter_values = None
+        self._global_parameters_modified = set()
 
-        # Reset statistics.
-        self.resetStatistics()
-                
         return
 
+    def _readCpin(self, cpin_filename):
+        """
+        Define the titratable groups and states of an AMBER cpin file, and compile their parameter tables.
+
+        ARGUMENTS
+
+        cpin_filename (string) - AMBER 'cpin' file defining protonation charge states and energies
+
+        RETURNS
+
+        titration_states (list of int) - the initial state of each group, as given in the file
+
+        """
+        # Load AMBER cpin file defining protonation states; CHRGDAT and STATENE are read as numpy arrays, and STATEINF pointers are checked.
+        namelist = cpinutils.namelist.read_cpin(cpin_filename)
+
+        # Extract number of titratable groups.
+        self.ngroups = len(namelist['RESSTATE'])
+
+        # Define titratable groups.
+        groups_atom_indices = list()
+        residue_types = list()
+        for group_index in range(self.ngroups):
+            first_atom = namelist['STATEINF(%d)%%FIRST_ATOM' % group_index] - 1
+            num_atoms = namelist['STATEINF(%d)%%NUM_ATOMS' % group_index]
+            groups_atom_indices.append(range(first_atom, first_atom+num_atoms))
+
+            # Residue name, from RESNAME entries of the form 'Residue: AS4 2' following the 'System: ...' entry.
+            residue_type = None
+            if ('RESNAME' in namelist) and (len(namelist['RESNAME']) > group_index+1):
+                fields = str(namelist['RESNAME'][group_index+1]).split()
+                if (len(fields) > 1) and (fields[0] == 'Residue:'):
+                    residue_type = fields[1]
+            residue_types.append(residue_type)
+        self.addTitratableGroups(groups_atom_indices, residue_types=residue_types)
+
+        # Define titration states.
+        for group_index in range(self.ngroups):
+            # Extract information about this titration group.
+            first_charge = namelist['STATEINF(%d)%%FIRST_CHARGE' % group_index]
+            first_state = namelist['STATEINF(%d)%%FIRST_STATE' % group_index]
+            num_atoms = namelist['STATEINF(%d)%%NUM_ATOMS' % group_index]
+            num_states = namelist['STATEINF(%d)%%NUM_STATES' % group_index]
+
+            for titration_state in range(num_states):
+                # Extract charges for this titration state.
+                charges = namelist['CHRGDAT'][(first_charge+num_atoms*titration_state):(first_charge+num_atoms*(titration_state+1))]
+                charges = units.Quantity(charges, units.elementary_charge)
+                # Extract relative energy for this titration state.
+                relative_energy = float(namelist['STATENE'][first_state+titration_state]) * units.kilocalories_per_mole
+                # Don't use pKref for AMBER cpin files---reference pKa contribution is already included in relative_energy.
+                pKref = 0.0
+                # Get proton count.
+                proton_count = namelist['PROTCNT'][first_state+titration_state]
+                # Create titration state.
+                self.addTitrationState(group_index, pKref, relative_energy, charges, proton_count)
+
+        # Compile parameter tables once all groups and states are known.
+        self._compileTitrationTables()
+
+        return list(namelist['RESSTATE'])
+
     def get14scaling(self, system):
         """
         Determine Coulomb 14 scaling.
@@ -216,6 +253,11 @@ class MonteCarloTitration(object):
 
         coulomb14scale (float) - degree to which 1,4 coulomb interactions are scaled
 
+        NOTE
+
+        Exclusions have zero charge products whatever the charges of their particles, so only exceptions with nonzero charge products
+        are considered.  None is returned if there is no such exception.
+
         """
         # Look for a NonbondedForce.
         forces = { system.getForce(index).__class__.__name__ : system.getForce(index) for index in range(system.getNumForces()) }
@@ -223,9 +265,12 @@ class MonteCarloTitration(object):
         # Determine coulomb14scale from first exception with nonzero chargeprod.
         for index in range(force.getNumExceptions()):
             [particle1, particle2, chargeProd, sigma, epsilon] = force.getExceptionParameters(index)
-            [charge1, sigma1, epsilon1] = force.getParticleParameters(particle1)
-            [charge2, sigma2, epsilon2] = force.getParticleParameters(particle2)
-            if (abs(charge1/units.elementary_charge) > 0) and (abs(charge2/units.elementary_charge)>0):
+            chargeProd = _strip_units(chargeProd)
+            if (chargeProd == 0.0) or (chargeProd == sys.float_info.epsilon):
+                continue
+            charge1 = _strip_units(force.getParticleParameters(particle1)[0])
+            charge2 = _strip_units(force.getParticleParameters(particle2)[0])
+            if (charge1 != 0.0) and (charge2 != 0.0):
                 coulomb14scale = chargeProd / (charge1*charge2)
                 return coulomb14scale
         
@@ -244,51 +289,295 @@ class MonteCarloTitration(object):
 
         exception_indices (list) - list of exception indices for NonbondedForce
 
+        NOTE
+
+        1,4 exceptions are told apart from exclusions by their nonzero charge product or epsilon.  Exceptions with both zero, which
+        include 1,4 pairs of dummy atoms without charge or Lennard-Jones parameters, are 1,4 exceptions if their particles are not
+        within two bonds (or constraints) of each other.
+
         TODO
 
         * Deal with the case where there may be multiple NonbondedForce objects.
         * Deal with electrostatics implmented as CustomForce objects (by CustomNonbondedForce + CustomBondForce)
         
+        """
+        return self._get14exceptionsOfGroups(system, [particle_indices])[0]
+
+    def _get14exceptionsOfGroups(self, system, groups_particle_indices):
+        """
+        Return the 1,4 exceptions involving each of several sets of particles, resolved in a single pass over the exceptions.
+
+        ARGUMENTS
+
+        system (simtk.openmm.System) - the system to examine
+        groups_particle_indices (list of list of int) - the particles of each set, which must not overlap
+
+        RETURNS
+
+        groups_exception_indices (list of list of int) - sorted exception indices for NonbondedForce involving each set of particles
+
+        NOTE
+
+        See get14exceptions() for how 1,4 exceptions are told apart from exclusions.
+
         """
         # Locate NonbondedForce object.
-        forces = { system.getForce(index).__class__.__name__ : system.getForce(index) for index in range(system.getNumForces()) }
-        force = forces['NonbondedForce']         
-        # Build a list of exception indices involving any of the specified particles.
-        exception_indices = list()
-        for exception_index in range(force.getNumExceptions()):
+        force_indices = { system.getForce(index).__class__.__name__ : index for index in range(system.getNumForces()) }
+        force = system.getForce(force_indices['NonbondedForce'])
+        index = self._getExceptionIndex(system, force_indices['NonbondedForce'])
+
+        # Map particles to the set containing them.
+        particle_sets = -numpy.ones([system.getNumParticles()], numpy.int64)
+        for (set_index, particle_indices) in enumerate(groups_particle_indices):
+            particle_sets[numpy.array(particle_indices, numpy.int64)] = set_index
+
+        # Sets of both particles of every exception.
+        exception_sets = particle_sets[index['particles']]
+        involved = numpy.where((exception_sets >= 0).any(axis=1))[0]
+
+        groups_exception_indices = [ list() for particle_indices in groups_particle_indices ]
+        for exception_index in involved:
+            exception_index = int(exception_index)
+            if not index['nonzero'][exception_index]:
+                (particle1, particle2) = index['particles'][exception_index]
+                if self._withinTwoBonds(system, int(particle1), int(particle2)):
+                    continue
+            for set_index in set(exception_sets[exception_index]):
+                if set_index >= 0:
+                    groups_exception_indices[set_index].append(exception_index)
+            # BEGIN UGLY HACK
+            # chargeprod and sigma cannot be identically zero or else we risk the error:
+            # Exception: updateParametersInContext: The number of non-excluded exceptions has changed
+            # TODO: Once OpenMM interface permits this, omit this code.
             [particle1, particle2, chargeProd, sigma, epsilon] = force.getExceptionParameters(exception_index)
-            if (particle1 in particle_indices) or (particle2 in particle_indices):
-                if (particle2 in self.atomExceptions[particle1]) or (particle1 in self.atomExceptions[particle2]):
-                    exception_indices.append(exception_index)
-                    # BEGIN UGLY HACK
-                    # chargeprod and sigma cannot be identically zero or else we risk the error:
-                    # Exception: updateParametersInContext: The number of non-excluded exceptions has changed
-                    # TODO: Once OpenMM interface permits this, omit this code.
-                    [particle1, particle2, chargeProd, sigma, epsilon] = force.getExceptionParameters(exception_index)
-                    if (2*chargeProd == chargeProd): chargeProd = sys.float_info.epsilon                        
-                    if (2*epsilon == epsilon): epsilon = sys.float_info.epsilon
-                    force.setExceptionParameters(exception_index, particle1, particle2, chargeProd, sigma, epsilon)
-                    # END UGLY HACK
+            if (2*chargeProd == chargeProd): chargeProd = sys.float_info.epsilon                        
+            if (2*epsilon == epsilon): epsilon = sys.float_info.epsilon
+            force.setExceptionParameters(exception_index, particle1, particle2, chargeProd, sigma, epsilon)
+            # END UGLY HACK
+            index['nonzero'][exception_index] = True
 
-        return exception_indices
+        return groups_exception_indices
 
-    def resetStatistics(self):
+    def _getExceptionIndex(self, system, force_index):
         """
-        Reset statistics of titration state tracking.
+        Return an index of the NonbondedForce exceptions by particle, building it in one pass over the exceptions if needed.
 
-        TODO
+        ARGUMENTS
+
+        system (simtk.openmm.System) - the system containing the force
+        force_index (int) - index of the NonbondedForce in the System
+
+        RETURNS
+
+        index (dict) - the index, with
+            index['particles'] (numpy array of shape [nexceptions, 2]) - the particles of each exception
+            index['nonzero'] (numpy array of bool) - True for exceptions with nonzero charge product or epsilon
+            index['exceptions'], index['offsets'] (numpy arrays) - exceptions[offsets[i]:offsets[i+1]] are the exceptions involving particle i
+
+        NOTE
+
+        The index is kept, with a reference to the System, for the System, force index, and number of exceptions it was built for.  It
+        cannot be keyed on the force object, since System.getForce() returns a new Python object on every call, nor on id(system), which
+        may be reused by a new System once the old one is garbage-collected.
 
-        * Keep track of more statistics regarding history of individual protonation states.
-        * Keep track of work values for individual trials to use for calibration.
-        
         """
-                
-        self.nattempted = 0
-        self.naccepted = 0 
-        self.work_history = list()
-        
+        force = system.getForce(force_index)
+        nexceptions = force.getNumExceptions()
+        key = (force_index, nexceptions)
+        if (self._exceptionIndex is not None) and (self._exceptionIndex['system'] is system) and (self._exceptionIndex['key'] == key):
+            return self._exceptionIndex
+
+        particles = numpy.zeros([nexceptions, 2], numpy.int64)
+        nonzero = numpy.zeros([nexceptions], numpy.bool_)
+        for exception_index in range(nexceptions):
+            [particle1, particle2, chargeProd, sigma, epsilon] = force.getExceptionParameters(exception_index)
+            particles[exception_index,:] = [particle1, particle2]
+            nonzero[exception_index] = (_strip_units(chargeProd) != 0.0) or (_strip_units(epsilon) != 0.0)
+
+        index = dict()
+        index['system'] = system
+        index['key'] = key
+        index['particles'] = particles
+        index['nonzero'] = nonzero
+        (index['exceptions'], index['offsets']) = self._buildAdjacency(particles.T.ravel(), numpy.concatenate([numpy.arange(nexceptions)]*2), system.getNumParticles())
+        self._exceptionIndex = index
+
+        return index
+
+    def _buildAdjacency(self, keys, values, nparticles):
+        """
+        Return a compressed index of values by particle.
+
+        ARGUMENTS
+
+        keys (numpy array of int) - particle index of each entry
+        values (numpy array of int) - value of each entry
+        nparticles (int) - the number of particles
+
+        RETURNS
+
+        (entries, offsets) (numpy arrays) - entries[offsets[i]:offsets[i+1]] are the values of the entries for particle i
+
+        """
+        order = numpy.argsort(keys, kind='mergesort')
+        entries = values[order]
+        offsets = numpy.searchsorted(keys[order], numpy.arange(nparticles+1))
+
+        return (entries, offsets)
+
+    def _withinTwoBonds(self, system, particle1, particle2):
+        """
+        Return True if two particles are connected by at most two bonds or constraints.
+
+        If the System defines neither HarmonicBondForce bonds nor constraints, the bonds of the topology of the prmtop are used instead,
+        and an exception is raised if no prmtop was given.
+        The bonded neighbors of each particle are kept, with a reference to the System, for the System, number of forces, and number of
+        constraints they were found for.
+
+        """
+        key = (system.getNumForces(), system.getNumConstraints())
+        if (self._bondedNeighbors is None) or (self._bondedNeighbors[0] is not system) or (self._bondedNeighbors[1] != key):
+            pairs = list()
+            for force_index in range(system.getNumForces()):
+                force = system.getForce(force_index)
+                if force.__class__.__name__ == 'HarmonicBondForce':
+                    pairs += [ force.getBondParameters(bond_index)[0:2] for bond_index in range(force.getNumBonds()) ]
+            pairs += [ system.getConstraintParameters(constraint_index)[0:2] for constraint_index in range(system.getNumConstraints()) ]
+            if (len(pairs) == 0) and hasattr(self.prmtop, 'topology'):
+                pairs = [ (atom1.index, atom2.index) for (atom1, atom2) in self.prmtop.topology.bonds() ]
+            if len(pairs) == 0:
+                raise Exception("Cannot tell exclusions from 1,4 exceptions of particles %d and %d: the System defines neither bonds nor constraints, and no prmtop topology was given." % (particle1, particle2))
+            pairs = numpy.array(pairs, numpy.int64).reshape(-1, 2)
+            self._bondedNeighbors = (system, key, self._buildAdjacency(pairs.T.ravel(), pairs[:,::-1].T.ravel(), system.getNumParticles()))
+
+        (neighbors, offsets) = self._bondedNeighbors[2]
+        first = set(neighbors[offsets[particle1]:offsets[particle1+1]])
+        if particle2 in first:
+            return True
+        for particle in first:
+            if particle2 in neighbors[offsets[particle]:offsets[particle+1]]:
+                return True
+
+        return False
+
+    def _assignTitrationForceGroups(self):
+        """
+        Move the forces whose energies depend on the titration states into dedicated force groups not used by any other force.
+
+        Nonbonded electrostatics and GB forces are placed in separate groups, so that their energies can be evaluated separately.
+
+        NOTE
+
+        self.titration_force_groups is set to the list of force group indices used for each force in self._titration_forces,
+        and self._titration_force_classes to the class ('Nonbonded' or 'GB') of each.
+        The original force groups are recorded, by index of the force in the System, in self._original_force_groups so they can be restored.
+        Forces are identified by their index, since System.getForce() returns a new Python object on every call.
+
+        A Context only sees the force groups of the System at its creation, so the layout is verified against each Context on first use
+        (see _verifyForceGroups()).
+
+        """
+        # Determine force groups in use by all other forces.
+        used_groups = set()
+        for force_index in range(self.system.getNumForces()):
+            if force_index not in self._titration_force_indices:
+                used_groups.add(self.system.getForce(force_index).getForceGroup())
+        free_groups = [ group for group in reversed(range(32)) if group not in used_groups ]
+
+        # Assign one group for nonbonded electrostatics and one for all GB forces.
+        nonbonded_classes = ['NonbondedForce', 'CustomNonbondedForce', 'CustomBondForce']
+        classes = [ 'Nonbonded' if (force.__class__.__name__ in nonbonded_classes) else 'GB' for force in self._titration_forces ]
+        if len(set(classes)) > len(free_groups):
+            raise Exception("Not enough free force groups to isolate titration forces: %d needed, %d available." % (len(set(classes)), len(free_groups)))
+        class_groups = dict()
+        for classname in classes:
+            if classname not in class_groups:
+                class_groups[classname] = free_groups[len(class_groups)]
+
+        self.titration_force_groups = list()
+        self._titration_force_classes = classes
+        for (force, force_index, classname) in zip(self._titration_forces, self._titration_force_indices, classes):
+            force_group = class_groups[classname]
+            reciprocal_space_force_group = None
+            if hasattr(force, 'getReciprocalSpaceForceGroup'):
+                reciprocal_space_force_group = force.getReciprocalSpaceForceGroup()
+            self._original_force_groups.append( (force_index, force.getForceGroup(), reciprocal_space_force_group) )
+            force.setForceGroup(force_group)
+            if (reciprocal_space_force_group is not None) and (reciprocal_space_force_group >= 0):
+                # Reciprocal space electrostatics also depend on the charges.
+                force.setReciprocalSpaceForceGroup(force_group)
+            self.titration_force_groups.append(force_group)
+        self._force_group_layout = zip(self._titration_force_indices, self.titration_force_groups)
+        self._verified_contexts = weakref.WeakKeyDictionary()
+
+        return
+
+    def _verifyForceGroups(self, context):
+        """
+        Check that a Context was created from a System holding the titration forces in their force groups.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context
+
+        NOTE
+
+        A Context only sees the force groups of the System at its creation, and they cannot be queried from it afterwards, so the driver
+        must be constructed before any Context is created.  The force group of each titration force in the System of the Context is
+        compared with the layout recorded by _assignTitrationForceGroups(), which catches Contexts created from copies of the System
+        made before the driver was constructed, and titration forces moved to other groups since.  With global-parameter titration forces,
+        the Context must also define their global parameters, which Contexts created before the forces were built do not.
+
+        Verified Contexts are held by weak reference, so that a Context created after another was garbage-collected is verified anew,
+        even if it reuses the id() of the old one.
+
+        """
+        system = context.getSystem()
+        for (force_index, force_group) in self._force_group_layout:
+            if (force_index >= system.getNumForces()) or (system.getForce(force_index).getForceGroup() != force_group):
+                raise Exception("Force %d of the System of this Context is not in titration force group %d.  The Context must be created from the titrated System after the titration driver is constructed." % (force_index, force_group))
+        if self._global_parameter_values is not None:
+            context_parameters = context.getParameters()
+            for name in self._global_parameter_values:
+                if name not in context_parameters:
+                    raise Exception("Global parameter '%s' of the titration forces is not defined in this Context.  The Context must be created after the titration forces are built." % name)
+        self._verified_contexts[context] = True
+
+        return
+
+    def _restoreForceGroups(self):
+        """
+        Return all forces moved by _assignTitrationForceGroups() to their original force groups.
+
+        """
+        for (force_index, force_group, reciprocal_space_force_group) in self._original_force_groups:
+            force = self.system.getForce(force_index)
+            force.setForceGroup(force_group)
+            if (reciprocal_space_force_group is not None) and (reciprocal_space_force_group >= 0):
+                force.setReciprocalSpaceForceGroup(reciprocal_space_force_group)
+        self._original_force_groups = list()
+
         return
 
+    def _getForceGroupMask(self, force_groups):
+        """
+        Return the bit mask selecting the specified force groups in Context.getState().
+
+        ARGUMENTS
+
+        force_groups (list of int) - the force groups to select
+
+        RETURNS
+
+        mask (int) - the bit mask
+
+        """
+        mask = 0
+        for force_group in set(force_groups):
+            mask |= (1 << force_group)
+
+        return mask
+
     def _parse_fortran_namelist(self, filename, namelist_name):
         """
         Parse a fortran namelist generated by AMBER 11 constant-pH python scripts.
@@ -304,71 +593,14 @@ class MonteCarloTitration(object):
 
         NOTES
 
-        This code is not fully general for all Fortran namelists---it is specialized to the cpin files.
-
-        """
-        # Read file contents.
-        infile = open(filename, 'r')
-        lines = infile.readlines()
-        infile.close()
-        
-        # Concatenate all text.
-        contents = ''
-        for line in lines:
-            contents += line.strip()
-
-        # Extract section corresponding to keyword.
-        key = '&' + namelist_name
-        terminator = '/'
-        match = re.match(key + '(.*)' + terminator, contents)
-        contents = match.groups(1)[0]
-
-        # Parse contents.
-        # These regexp match strings come from fortran-namelist from Stephane Chamberland (stephane.chamberland@ec.gc.ca) [LGPL].
-        valueInt  = re.compile(r'[+-]?[0-9]+')
-        valueReal = re.compile(r'[+-]?([0-9]+\.[0-9]*|[0-9]*\.[0-9]+)')
-        valueString = re.compile(r'^[\'\"](.*)[\'\"]$')
-
-        # Parse contents.
-        namelist = dict()
-        while len(contents) > 0:
-            # Peel off variable name.
-            match = re.match(r'^([^,]+)=(.+)$', contents)
-            if not match: break
-            name = match.group(1).strip()
-            contents = match.group(2).strip()
-
-            # Peel off value, which extends to either next variable name or end of section.
-            match = re.match(r'^([^=]+),([^,]+)=(.+)$', contents)
-            if match:
-                value = match.group(1).strip()
-                contents = match.group(2) + '=' + match.group(3)
-            else:
-                value = contents
-                contents = ''
-
-            # Split value on commas.
-            elements = value.split(',')            
-            value = list()
-            for element in elements:
-                if valueReal.match(element):
-                    element = float(element)
-                elif valueInt.match(element):
-                    element = int(element)
-                elif valueString.match(element):
-                    element = element[1:-1] 
-                if element != '':
-                    value.append(element)
-            if len(value) == 1:
-                value = value[0]
-
-            namelist[name] = value
+        This is a thin wrapper around cpinutils.namelist.read_namelist(), which reads the file in a single pass.
 
-        return namelist
+        """
+        return cpinutils.namelist.read_namelist(filename, namelist_name)
 
 
     #=============================================================================================
-    # This functionality takes the place of a C++ MonteCarloTitration Force object.
+    # Titratable groups and states.
     #=============================================================================================
 
     def getNumTitratableGroups(self):
@@ -383,7 +615,7 @@ class MonteCarloTitration(object):
 
         return len(self.titrationGroups)
 
-    def addTitratableGroup(self, atom_indices):
+    def addTitratableGroup(self, atom_indices, residue_type=None):
         """
         Define a new titratable group.
         
@@ -391,31 +623,107 @@ class MonteCarloTitration(object):
 
         atom_indices (list of int) - the atom indices defining the titration group
 
+        OPTIONAL ARGUMENTS
+
+        residue_type (string) - residue name (e.g. 'AS4') used to share settings among groups of the same type;
+                                if None, groups are typed by the charges of their titration states (default: None)
+
+        RETURNS
+
+        group_index (int) - index of the new titration group
+
         NOTE
 
-        No two titration groups may share atoms.
+        No two titration groups may share atoms.  To define many groups, addTitratableGroups() is faster.
 
         """
-        # Check to make sure the requested group does not share atoms with any existing titration group.
-        for group in self.titrationGroups:
-            if set(group['atom_indices']).intersection(atom_indices):
-                raise Exception("Titration groups cannot share atoms.  The requested atoms of new titration group (%s) share atoms with another group (%s)." % (str(atom_indices), str(group['atom_indices'])))
-        
-        # Define the new group.
-        group = dict()
-        group['atom_indices'] = list(atom_indices) # deep copy
-        group['titration_states'] = list()
-        group_index = len(self.titrationGroups) + 1
-        group['index'] = group_index
-        group['nstates'] = 0
-        group['exception_indices'] = self.get14exceptions(system, atom_indices) # NonbondedForce exceptions associated with this titration state
+        return self.addTitratableGroups([atom_indices], residue_types=[residue_type])[0]
 
-        self.titrationGroups.append(group)
+    def addTitratableGroups(self, groups_atom_indices, residue_types=None):
+        """
+        Define several new titratable groups at once.
 
-        # Note that we haven't yet defined any titration states, so current state is set to None.
-        self.titrationStates.append(None)
+        ARGUMENTS
+
+        groups_atom_indices (list of list of int) - the atom indices defining each titration group
+
+        OPTIONAL ARGUMENTS
+
+        residue_types (list of string) - residue name of each group, or None for groups typed by the charges of their titration states;
+                                         if None, all groups are typed by their charges (default: None)
+
+        RETURNS
+
+        group_indices (list of int) - indices of the new titration groups
+
+        NOTE
+
+        No two titration groups may share atoms.  Either all groups are added, or, if any atoms are shared, none are.
+
+        EXAMPLES
+
+        >>> group_indices = mc_titration.addTitratableGroups([[10, 11, 12], [40, 41, 42, 43]], residue_types=['AS4', 'GL4']) # doctest: +SKIP
+
+        """
+        if self._global_parameter_values is not None:
+            raise Exception("Titratable groups and states cannot be modified once global-parameter titration forces have been built.")
+        if residue_types is None:
+            residue_types = [None] * len(groups_atom_indices)
+        if len(residue_types) != len(groups_atom_indices):
+            raise Exception("Number of residue types (%d) does not match number of titration groups (%d)." % (len(residue_types), len(groups_atom_indices)))
+
+        # Check to make sure the requested groups share atoms neither with existing titration groups nor with each other.
+        first_group_index = len(self.titrationGroups)
+        atom_groups = self._atomGroupIndices.copy()
+        for (group_offset, atom_indices) in enumerate(groups_atom_indices):
+            atom_indices = numpy.array(atom_indices, numpy.int64)
+            if (len(atom_indices) > 0) and ((atom_indices.min() < 0) or (atom_indices.max() >= len(atom_groups))):
+                raise Exception("Atom indices of titration group (%s) must be in range(%d)." % (str(list(atom_indices)), len(atom_groups)))
+            if len(numpy.unique(atom_indices)) != len(atom_indices):
+                raise Exception("The requested atoms of new titration group (%s) are not unique." % str(list(atom_indices)))
+            shared = atom_groups[atom_indices][atom_groups[atom_indices] >= 0]
+            if len(shared) > 0:
+                shared_atoms = list(numpy.where(atom_groups == shared[0])[0])
+                raise Exception("Titration groups cannot share atoms.  The requested atoms of new titration group (%s) share atoms with another group (%s)." % (str(list(atom_indices)), str(shared_atoms)))
+            atom_groups[atom_indices] = first_group_index + group_offset
+
+        # Resolve NonbondedForce exceptions of all groups at once.
+        groups_exception_indices = self._get14exceptionsOfGroups(self.system, groups_atom_indices)
+
+        # Define the new groups.
+        group_indices = list()
+        for (atom_indices, residue_type, exception_indices) in zip(groups_atom_indices, residue_types, groups_exception_indices):
+            group = dict()
+            group['atom_indices'] = list(atom_indices) # deep copy
+            group['titration_states'] = list()
+            group_index = len(self.titrationGroups)
+            group['index'] = group_index
+            group['nstates'] = 0
+            group['residue_type'] = residue_type
+            group['exception_indices'] = exception_indices # NonbondedForce exceptions associated with this titration state
+
+            self.titrationGroups.append(group)
+            group_indices.append(group_index)
+
+        self._atomGroupIndices = atom_groups
+        self._compiled = False
+
+        return group_indices
+
+    def getTitratableGroupOfAtoms(self, atom_indices):
+        """
+        Return the titratable group containing each of the specified atoms.
+
+        ARGUMENTS
+
+        atom_indices (list of int) - the atoms to look up
+
+        RETURNS
 
-        return group_index
+        group_indices (numpy array of int) - index of the titration group containing each atom, or -1 for atoms outside of titratable groups
+
+        """
+        return self._atomGroupIndices[numpy.array(atom_indices, numpy.int64)]
 
     def getNumTitrationStates(self, titration_group_index):
         """
@@ -449,6 +757,8 @@ class MonteCarloTitration(object):
 
         NOTE
 
+        Charges are stored as a unit-free numpy array in units of elementary charge.
+
         The relative free energy of a titration state is computed as
         
         relative_energy + kT * proton_count * ln (10^(pH - pKa))
@@ -463,212 +773,2797 @@ class MonteCarloTitration(object):
             raise Exception("Invalid titratable group requested.  Requested %d, valid groups are in range(%d)." % (titration_group_index, self.getNumTitratableGroups()))        
         if len(charges) != len(self.titrationGroups[titration_group_index]['atom_indices']):
             raise Exception('The number of charges must match the number (and order) of atoms in the defined titration group.')
+        if self._global_parameter_values is not None:
+            raise Exception("Titratable groups and states cannot be modified once global-parameter titration forces have been built.")
         
         state = dict()
         state['pKref'] = pKref
         state['relative_energy'] = relative_energy
-        state['charges'] = copy.deepcopy(charges) 
+        state['charges'] = _strip_charges(charges)
         state['proton_count'] = proton_count
         self.titrationGroups[titration_group_index]['titration_states'].append(state)
 
-        # Increment count of titration states and set current state to last defined state.
-        self.titrationStates[titration_group_index] = self.titrationGroups[titration_group_index]['nstates']
+        # Increment count of titration states.
         self.titrationGroups[titration_group_index]['nstates'] += 1
+        self._compiled = False
 
         return
 
-    def getTitrationState(self, titration_group_index):        
+    def getTitrationStateTotalCharge(self, titration_group_index, titration_state_index):
         """
-        Return the current titration state for the specified titratable group.
+        Return the total charge for the specified titration state.
         
         ARGUMENTS
 
         titration_group_index (int) - the titration group to be queried
-        
+        titration_state_index (int) - the titration state to be queried
+
         RETURNS
 
-        state (int) - the titration state for the specified titration group
+        charge (simtk.openmm.Quantity compatible with simtk.unit.elementary_charge) - total charge for the specified titration state
 
         """
         if titration_group_index not in range(self.getNumTitratableGroups()):
             raise Exception("Invalid titratable group requested.  Requested %d, valid groups are in range(%d)." % (titration_group_index, self.getNumTitratableGroups()))        
+        if titration_state_index not in range(self.getNumTitrationStates(titration_group_index)):
+            raise Exception("Invalid titration state requested.  Requested %d, valid states are in range(%d)." % (titration_state_index, self.getNumTitrationStates(titration_group_index)))
 
-        return self.titrationStates[titration_group_index]
-
-    def getTitrationStates(self):        
-        """
-        Return the current titration states for all titratable groups.        
-        
-        RETURNS
+        charges = self.titrationGroups[titration_group_index]['titration_states'][titration_state_index]['charges']
+        return units.Quantity(charges.sum(), units.elementary_charge)
 
-        states (list of int) - the titration states for all titratable groups
 
+    def _getParticleParameters(self, force, particle_index):
         """
-        return list(self.titrationStates) # deep copy
+        Return the per-particle parameters of a force we update as a unit-free list.
 
-    def getTitrationStateTotalCharge(self, titration_group_index):
-        """
-        Return the total charge for the specified titration state.
-        
         ARGUMENTS
 
-        titration_group_index (int) - the titration group to be queried
+        force (simtk.openmm.Force) - one of the forces in self.forces_to_update
+        particle_index (int) - the particle to query
 
         RETURNS
 
-        charge (simtk.openmm.Quantity compatible with simtk.unit.elementary_charge) - total charge for the specified titration state
+        parameters (list of float) - unit-free parameters in MD units, in the order accepted by setParticleParameters
 
         """
-        if titration_group_index not in range(self.getNumTitratableGroups()):
-            raise Exception("Invalid titratable group requested.  Requested %d, valid groups are in range(%d)." % (titration_group_index, self.getNumTitratableGroups()))        
-        if titration_state_index not in range(self.getNumTitrationStates(titratable_group_index)):
-            raise Exception("Invalid titration state requested.  Requested %d, valid states are in range(%d)." % (titration_state_index, self.getNumTitrationStates(titration_group_index)))
-
-        charges = self.titrationGroups[titration_group_index]['titration_states'][titration_state_index]['charges'][:]
-        return simtk.unit.Quantity((charges / charges.unit).sum(), charges.unit)
+        force_classname = force.__class__.__name__
+        if force_classname in ['NonbondedForce', 'GBSAOBCForce', 'CustomGBForce']:
+            return [ _strip_units(parameter) for parameter in force.getParticleParameters(particle_index) ]
+        else:
+            raise Exception("Don't know how to update force type '%s'" % force_classname)
 
-
-    def setTitrationState(self, titration_group_index, titration_state_index, context=None, debug=False):
+    def _setParticleParameters(self, force, particle_index, parameters):
         """
-        Change the titration state of the designated group for the provided state.
+        Set the per-particle parameters of a force we update from a unit-free list.
 
         ARGUMENTS
-        
-        titration_group_index (int) - the index of the titratable group whose titration state should be updated
-        titration_state_index (int) - the titration state to set as active
-        
-        OPTIONAL ARGUMENTS
 
-        context (simtk.openmm.Context) - if provided, will update protonation state in the specified Context (default: None)
-        debug (boolean) - if True, will print debug information
+        force (simtk.openmm.Force) - one of the forces in self.forces_to_update
+        particle_index (int) - the particle to modify
+        parameters (list of float) - unit-free parameters in MD units, as returned by _getParticleParameters
 
         """
+        if force.__class__.__name__ == 'CustomGBForce':
+            force.setParticleParameters(particle_index, parameters)
+        else:
+            force.setParticleParameters(particle_index, *parameters)
 
-        # Check parameters for validity.
-        if titration_group_index not in range(self.getNumTitratableGroups()):
-            raise Exception("Invalid titratable group requested.  Requested %d, valid groups are in range(%d)." % (titration_group_index, self.getNumTitratableGroups()))        
-        if titration_state_index not in range(self.getNumTitrationStates(titration_group_index)):
-            raise Exception("Invalid titration state requested.  Requested %d, valid states are in range(%d)." % (titration_state_index, self.getNumTitrationStates(titration_group_index)))
+        return
 
-        # Get titration group and state.
-        titration_group = self.titrationGroups[titration_group_index]
-        titration_state = self.titrationGroups[titration_group_index]['titration_states'][titration_state_index]
-        
-        # Modify charges and exceptions.
-        for force in self.forces_to_update:
-            # Get name of force class.
-            force_classname = force.__class__.__name__
-            # Get atom indices and charges.
-            charges = titration_state['charges']
-            atom_indices = titration_group['atom_indices']
-            # Update charges.
-            # TODO: Handle Custom forces, looking for "charge" and "chargeProd".
-            for (charge_index, atom_index) in enumerate(atom_indices):
-                if force_classname == 'NonbondedForce':
-                    [charge, sigma, epsilon] = force.getParticleParameters(atom_index)
-                    if debug: print " modifying NonbondedForce atom %d : (charge, sigma, epsilon) : (%s, %s, %s) -> (%s, %s, %s)" % (atom_index, str(charge), str(sigma), str(epsilon), str(charges[charge_index]), str(sigma), str(epsilon))
-                    force.setParticleParameters(atom_index, charges[charge_index], sigma, epsilon)
-                elif force_classname == 'GBSAOBCForce':
-                    if debug: print " modifying GBSAOBCForce atom %d : (charge, radius, scaleFactor) : (%s, %s, %s) -> (%s, %s, %s)" % (atom_index, str(charge), str(radius), scaleFactor, str(charges[charge_index]), str(radius), scaleFactor)
-                    [charge, radius, scaleFactor] = force.getParticleParameters(atom_index)
-                    force.setParticleParameters(atom_index, charges[charge_index], radius, scaleFactor)
-                else:
-                    raise Exception("Don't know how to update force type '%s'" % force_classname)
-            # Update exceptions
-            # TODO: Handle Custom forces.
-            if force_classname == 'NonbondedForce':
-                for exception_index in titration_group['exception_indices']:
-                    [particle1, particle2, chargeProd, sigma, epsilon] = force.getExceptionParameters(exception_index)
-                    [charge1, sigma1, epsilon1] = force.getParticleParameters(particle1)
-                    [charge2, sigma2, epsilon2] = force.getParticleParameters(particle2)
-                    #print "chargeProd: old %s new %s" % (str(chargeProd), str(self.coulomb14scale * charge1 * charge2))
-                    chargeProd = self.coulomb14scale * charge1 * charge2
-                    # BEGIN UGLY HACK
-                    # chargeprod and sigma cannot be identically zero or else we risk the error:
-                    # Exception: updateParametersInContext: The number of non-excluded exceptions has changed
-                    # TODO: Once OpenMM interface permits this, omit this code.
-                    if (2*chargeProd == chargeProd): chargeProd = sys.float_info.epsilon                        
-                    if (2*epsilon == epsilon): epsilon = sys.float_info.epsilon
-                    # END UGLY HACK
-                    force.setExceptionParameters(exception_index, particle1, particle2, chargeProd, sigma, epsilon)
+    def _compileTitrationTables(self):
+        """
+        Compile unit-free parameter tables for all titratable groups.
 
-            # Update parameters in Context, if specified.
-            if context and hasattr(force, 'updateParametersInContext'): 
-                force.updateParametersInContext(context)                
+        For each group, this stores
+        
+        group['charges'] (numpy array of shape [nstates, natoms]) - charges (in elementary charge) for each titration state
+        group['particle_parameters'] (list of list of float) - for each force in self.forces_to_update, the unit-free per-particle parameters of each atom in the group
+        group['exception_parameters'] (list of list) - [particle1, particle2, sigma, epsilon] for each NonbondedForce exception in group['exception_indices']
+        group['exception_atoms'] (numpy array of shape [nexceptions, 2]) - group-local indices of the exception particles, or -1 if outside of the group
+        group['exception_chargeprods'] (numpy array of shape [nstates, nexceptions]) - precomputed 1,4 charge products for each titration state
+        group['exception_partners'] (list) - for exceptions coupling this group to another titratable group, (group index, local atom index) of the partner atom, or None
+        group['transitions'] (list of list) - transitions[i][j] is a tuple (atoms, exceptions) of group-local atom and exception indices whose parameters differ between states i and j
+        group['tautomer_classes'] (list of list of int) - states grouped into classes of tautomers, which have equal proton count, pKref, and relative energy
+        group['state_classes'] (list of int) - index of the tautomer class of each state
+        group['type'] (string) - residue type of the group; groups without one share the type 'group N' of the first group N with identical charges
 
-        # Update titration state records.
-        self.titrationStates[titration_group_index] = titration_state_index
+        NOTE
 
-        return
+        Only the atoms and exceptions listed in group['transitions'] are touched when a group changes state,
+        so this must be called again (it is, automatically) whenever groups or states are added.
 
-    def update(self, context):
         """
-        Perform a Monte Carlo update of the titration state.
+        if self._global_parameter_values is not None:
+            raise Exception("Titratable groups and states cannot be modified once global-parameter titration forces have been built.")
+
+        # Map titratable atoms to (group index, group-local atom index).
+        self._atomGroups = dict()
+        for (group_index, group) in enumerate(self.titrationGroups):
+            for (atom_local_index, atom_index) in enumerate(group['atom_indices']):
+                self._atomGroups[atom_index] = (group_index, atom_local_index)
+
+        # Locate the NonbondedForce whose exceptions we modify.
+        nonbonded_force = None
+        for force in self.forces_to_update:
+            if force.__class__.__name__ == 'NonbondedForce':
+                nonbonded_force = force
+        coulomb14scale = 0.0
+        if self.coulomb14scale is not None:
+            coulomb14scale = float(self.coulomb14scale)
+
+        # Unit-free chargeProd currently written for each exception involving a titratable atom, keyed by exception index.
+        self._exceptionChargeProds = dict()
+
+        for (group_index, group) in enumerate(self.titrationGroups):
+            atom_indices = group['atom_indices']
+            natoms = len(atom_indices)
+            nstates = group['nstates']
+
+            # Charges for all states.
+            charges = numpy.zeros([nstates, natoms], numpy.float64)
+            for (state_index, titration_state) in enumerate(group['titration_states']):
+                charges[state_index,:] = titration_state['charges']
+            group['charges'] = charges
+
+            # Charge-independent per-particle parameters for each force.
+            group['particle_parameters'] = [ [ self._getParticleParameters(force, atom_index) for atom_index in atom_indices ] for force in self.forces_to_update ]
+
+            # NonbondedForce exceptions.
+            exception_parameters = list()
+            exception_atoms = numpy.zeros([len(group['exception_indices']), 2], numpy.int32)
+            exception_chargeprods = numpy.zeros([nstates, len(group['exception_indices'])], numpy.float64)
+            exception_partners = list()
+            for (exception_local_index, exception_index) in enumerate(group['exception_indices']):
+                [particle1, particle2, chargeProd, sigma, epsilon] = nonbonded_force.getExceptionParameters(exception_index)
+                exception_parameters.append([particle1, particle2, _strip_units(sigma), _strip_units(epsilon)])
+                self._exceptionChargeProds[exception_index] = _strip_units(chargeProd)
+                # Charges of each particle in every titration state; particles outside of this group keep their current charge.
+                particle_charges = list()
+                partner = None
+                for (column, particle) in enumerate([particle1, particle2]):
+                    if particle in self._atomGroups and self._atomGroups[particle][0] == group_index:
+                        atom_local_index = self._atomGroups[particle][1]
+                        exception_atoms[exception_local_index,column] = atom_local_index
+                        particle_charges.append(charges[:,atom_local_index])
+                    else:
+                        exception_atoms[exception_local_index,column] = -1
+                        if particle in self._atomGroups:
+                            # Partner charge depends on the state of another titratable group; computed when applied.
+                            partner = self._atomGroups[particle]
+                        [charge, sigma, epsilon] = nonbonded_force.getParticleParameters(particle)
+                        particle_charges.append(_strip_units(charge) * numpy.ones([nstates], numpy.float64))
+                exception_chargeprods[:,exception_local_index] = coulomb14scale * particle_charges[0] * particle_charges[1]
+                exception_partners.append(partner)
+            # BEGIN UGLY HACK
+            # chargeprod cannot be identically zero or else we risk the error:
+            # Exception: updateParametersInContext: The number of non-excluded exceptions has changed
+            # TODO: Once OpenMM interface permits this, omit this code.
+            exception_chargeprods[exception_chargeprods == 0.0] = sys.float_info.epsilon
+            # END UGLY HACK
+            group['exception_parameters'] = exception_parameters
+            group['exception_atoms'] = exception_atoms
+            group['exception_chargeprods'] = exception_chargeprods
+            group['exception_partners'] = exception_partners
+
+            # Sparse lists of atoms and exceptions that differ between each pair of states.
+            transitions = list()
+            for initial_state in range(nstates):
+                transitions.append(list())
+                for final_state in range(nstates):
+                    changed = (charges[initial_state,:] != charges[final_state,:])
+                    changed_atoms = numpy.nonzero(changed)[0]
+                    # Append a False entry so that local index -1 (particle outside of group) is never flagged as changed.
+                    changed = numpy.append(changed, False)
+                    changed_exceptions = numpy.nonzero(changed[exception_atoms[:,0]] | changed[exception_atoms[:,1]])[0]
+                    transitions[initial_state].append( (changed_atoms, changed_exceptions) )
+            group['transitions'] = transitions
+
+            # Tautomer classes: states with equal proton count and reference energy.
+            tautomer_classes = list()
+            class_keys = list()
+            state_classes = list()
+            for (state_index, titration_state) in enumerate(group['titration_states']):
+                key = (titration_state['proton_count'], titration_state['pKref'], _strip_units(titration_state['relative_energy']))
+                if key not in class_keys:
+                    class_keys.append(key)
+                    tautomer_classes.append(list())
+                state_classes.append(class_keys.index(key))
+                tautomer_classes[state_classes[-1]].append(state_index)
+            group['tautomer_classes'] = tautomer_classes
+            group['state_classes'] = state_classes
+
+        # Residue types, used to share settings such as NCMC switching lengths.
+        signature_types = dict()
+        for (group_index, group) in enumerate(self.titrationGroups):
+            if group['residue_type'] is not None:
+                group['type'] = group['residue_type']
+            else:
+                signature = (group['charges'].shape, tuple(numpy.round(group['charges'], 6).flat))
+                group['type'] = signature_types.setdefault(signature, 'group %d' % group_index)
+
+        self._compiled = True
+
+        # Compute reference-state contributions to the log probability.
+        self._updateReferenceWeights()
+
+        # Set up the forces for the new tables.
+        self._buildTitrationForces()
+
+        return
+
+    def _buildTitrationForces(self):
+        """
+        Set up the titration forces for newly compiled parameter tables.
+
+        Per-particle charge updates are replaced by global parameters, if requested.
+
+        """
+        if self.use_global_parameters:
+            self._buildGlobalParameterForces()
+
+        return
+
+    def _chargeExpression(self, suffix):
+        """
+        Return an expression for the charge of a particle in terms of the global parameters controlling the titration states.
+
+        The charge of a particle in titratable group g is
+
+        q = q0 + sum_s dq_s * lambda_g_s
+
+        where q0 is its charge in state 0, dq_s the change in charge in state s, and lambda_g_s is 1 if group g is in state s and 0 otherwise.
+        Particles outside titratable groups have titration_group = -1 and all dq_s = 0.
+
+        ARGUMENTS
+
+        suffix (string) - suffix appended to per-particle parameter and intermediate variable names (e.g. '1' or '2' for pair expressions)
+
+        RETURNS
+
+        (expression, definitions) (string, string) - expression for the charge, and the ';'-separated definitions of the intermediate variables it uses
+
+        """
+        max_nstates = max([ group['nstates'] for group in self.titrationGroups ])
+        terms = [ 'titration_q0%s' % suffix ]
+        definitions = list()
+        for state_index in range(1, max_nstates):
+            selectors = [ 'delta(titration_group%s-%d)*%s' % (suffix, group_index, group['global_parameter_names'][state_index]) for (group_index, group) in enumerate(self.titrationGroups) if group['nstates'] > state_index ]
+            terms.append('titration_dq%d_%s*titration_l%d_%s' % (state_index, suffix, state_index, suffix))
+            definitions.append('titration_l%d_%s=%s' % (state_index, suffix, '+'.join(selectors)))
+
+        return ('+'.join(terms), ';'.join(definitions))
+
+    def _buildGlobalParameterForces(self):
+        """
+        Move electrostatics of titratable atoms into Custom forces whose charges are controlled by global parameters.
+
+        The charges of titratable atoms (and the charge products of their 1,4 exceptions) in the NonbondedForce are zeroed, and
+        
+        - a CustomNonbondedForce computes Coulomb interactions of titratable atoms with all other atoms,
+        - a CustomBondForce computes the scaled 1,4 Coulomb interactions of titratable exceptions,
+        - each GB force is replaced by a CustomGBForce (built with cnstphgbforces) whose charge is a computed value,
+
+        all using the charge expression of _chargeExpression() with one global parameter per group state (state 0 excluded).
+
+        NOTE
+
+        Energies agree with those of the per-particle parameter path up to the precision of the platform and of the CustomGBForce
+        conversion of GBSAOBCForce (see cnstphgbforces); the Coulomb constant is that of the NonbondedForce (see _getCoulombConstant()).
+
+        Only NoCutoff electrostatics are supported.  Explicit-solvent Systems (reaction-field, Ewald, or PME electrostatics) are not
+        covered, since the reciprocal-space and cutoff terms of titratable charges cannot be moved into Custom forces; an exception is
+        raised for them.
+
+        """
+        if self._global_parameter_values is not None:
+            return
+
+        # Locate the NonbondedForce.
+        nonbonded_forces = [ force for force in self.forces_to_update if force.__class__.__name__ == 'NonbondedForce' ]
+        if len(nonbonded_forces) != 1:
+            raise Exception("Global-parameter titration requires exactly one NonbondedForce.")
+        nonbonded_force = nonbonded_forces[0]
+        if nonbonded_force.getNonbondedMethod() != openmm.NonbondedForce.NoCutoff:
+            raise Exception("Global-parameter titration is only implemented for NoCutoff electrostatics.")
+
+        # Name the global parameters controlling each group state.
+        for (group_index, group) in enumerate(self.titrationGroups):
+            group['global_parameter_names'] = [None] + [ 'titration_lambda_%d_%d' % (group_index, state_index) for state_index in range(1, group['nstates']) ]
+        global_parameter_names = [ name for group in self.titrationGroups for name in group['global_parameter_names'][1:] ]
+
+        # Per-particle parameters: reference charge, charge difference for each state, and titratable group index.
+        natoms = self.system.getNumParticles()
+        max_nstates = max([ group['nstates'] for group in self.titrationGroups ])
+        parameter_names = ['titration_q0'] + [ 'titration_dq%d_' % state_index for state_index in range(1, max_nstates) ] + ['titration_group']
+        parameter_values = numpy.zeros([natoms, max_nstates+1], numpy.float64)
+        parameter_values[:,max_nstates] = -1
+        for atom_index in range(natoms):
+            [charge, sigma, epsilon] = nonbonded_force.getParticleParameters(atom_index)
+            parameter_values[atom_index,0] = _strip_units(charge)
+        titratable_atoms = list()
+        for (group_index, group) in enumerate(self.titrationGroups):
+            for (atom_local_index, atom_index) in enumerate(group['atom_indices']):
+                parameter_values[atom_index,0] = group['charges'][0,atom_local_index]
+                parameter_values[atom_index,1:group['nstates']] = group['charges'][1:,atom_local_index] - group['charges'][0,atom_local_index]
+                parameter_values[atom_index,max_nstates] = group_index
+                titratable_atoms.append(atom_index)
+        parameter_values = parameter_values.tolist()
+
+        (charge1, definitions1) = self._chargeExpression('1')
+        (charge2, definitions2) = self._chargeExpression('2')
+        pair_definitions = 'charge1=%s;%s;charge2=%s;%s' % (charge1, definitions1, charge2, definitions2)
+
+        # Coulomb interactions of titratable atoms with all other atoms.
+        coulomb_force = openmm.CustomNonbondedForce('%r*charge1*charge2/r;%s' % (_getCoulombConstant(), pair_definitions))
+        for name in parameter_names:
+            coulomb_force.addPerParticleParameter(name)
+        for name in global_parameter_names:
+            coulomb_force.addGlobalParameter(name, 0.0)
+        for atom_index in range(natoms):
+            coulomb_force.addParticle(parameter_values[atom_index])
+        for exception_index in range(nonbonded_force.getNumExceptions()):
+            [particle1, particle2, chargeProd, sigma, epsilon] = nonbonded_force.getExceptionParameters(exception_index)
+            coulomb_force.addExclusion(particle1, particle2)
+        coulomb_force.addInteractionGroup(titratable_atoms, range(natoms))
+        coulomb_force.setNonbondedMethod(openmm.CustomNonbondedForce.NoCutoff)
+
+        # Scaled 1,4 interactions of titratable exceptions.
+        exception_force = openmm.CustomBondForce('%r*%r*charge1*charge2/r;%s' % (_getCoulombConstant(), float(self.coulomb14scale or 0.0), pair_definitions))
+        for suffix in ['1', '2']:
+            for name in parameter_names:
+                exception_force.addPerBondParameter(name + suffix)
+        for name in global_parameter_names:
+            exception_force.addGlobalParameter(name, 0.0)
+        exception_indices = sorted(set([ exception_index for group in self.titrationGroups for exception_index in group['exception_indices'] ]))
+        for exception_index in exception_indices:
+            [particle1, particle2, chargeProd, sigma, epsilon] = nonbonded_force.getExceptionParameters(exception_index)
+            exception_force.addBond(particle1, particle2, parameter_values[particle1] + parameter_values[particle2])
+            nonbonded_force.setExceptionParameters(exception_index, particle1, particle2, 0.0, sigma, epsilon)
+
+        # Remove titratable charges from the NonbondedForce.
+        for atom_index in titratable_atoms:
+            [charge, sigma, epsilon] = nonbonded_force.getParticleParameters(atom_index)
+            nonbonded_force.setParticleParameters(atom_index, 0.0, sigma, epsilon)
+
+        # Replace GB forces with CustomGBForces computing charges from the global parameters.
+        gb_forces = list()
+        removed_force_indices = list()
+        for (force, force_index) in zip(self.forces_to_update, self._force_indices):
+            if force.__class__.__name__ == 'NonbondedForce':
+                continue
+            custom_force = force
+            if force.__class__.__name__ == 'GBSAOBCForce':
+                custom_force = cnstphgbforces.GBSAOBCForceAsCustomGBForce(force)
+            gb_forces.append(cnstphgbforces.ComputedChargeGBForce(custom_force, lambda suffix: '%s;%s' % self._chargeExpression(suffix), parameter_names, parameter_values, global_parameter_names))
+            removed_force_indices.append(force_index)
+
+        # Return all forces to their original groups before any are removed, since removal invalidates the recorded indices.
+        self._restoreForceGroups()
+        for force_index in sorted(removed_force_indices, reverse=True):
+            self.system.removeForce(force_index)
+        new_forces = [coulomb_force, exception_force] + gb_forces
+        new_force_indices = [ self.system.addForce(force) for force in new_forces ]
+
+        # Record where each global parameter lives, so its default value can follow the titration state.
+        self._global_parameter_values = dict([ (name, 0.0) for name in global_parameter_names ])
+        self._global_parameter_defaults = dict([ (name, list()) for name in global_parameter_names ])
+        for force in [coulomb_force, exception_force] + gb_forces:
+            for index in range(force.getNumGlobalParameters()):
+                name = force.getGlobalParameterName(index)
+                if name in self._global_parameter_defaults:
+                    self._global_parameter_defaults[name].append( (force, index) )
+
+        # Only the new Custom forces depend on the titration states now.
+        self._titration_forces = new_forces
+        self._titration_force_indices = new_force_indices
+        self._assignTitrationForceGroups()
+        self.forces_to_update = list()
+        self._force_indices = list()
+        self._forces_modified = list()
+        self._charge_parameter_indices = list()
+
+        return
+
+    def _updateReferenceWeights(self):
+        """
+        Compute the reference-state contribution to the log probability of each titration state.
+
+        For each group, group['log_reference_weights'] (numpy array of shape [nstates]) stores
+        
+        - proton_count * (pH - pKref) * ln 10 + beta * relative_energy
+
+        """
+        temperature = self.temperature 
+        kT = kB * temperature # thermal energy
+        beta = 1.0 / kT # inverse temperature
+
+        self._beta = 1.0 / _strip_units(kT) # unit-free inverse temperature, in 1/(kJ/mol)
+        self._reference_conditions = (self.pH, _strip_units(temperature))
+
+        for titration_group in self.titrationGroups:
+            log_reference_weights = numpy.zeros([titration_group['nstates']], numpy.float64)
+            for (state_index, titration_state) in enumerate(titration_group['titration_states']):
+                pKref = titration_state['pKref']
+                proton_count = titration_state['proton_count']
+                relative_energy = titration_state['relative_energy']
+                log_reference_weights[state_index] = - proton_count * (self.pH - pKref) * math.log(10) + beta * relative_energy
+            titration_group['log_reference_weights'] = log_reference_weights
+
+        return
+
+    def _setGlobalParameter(self, name, value):
+        """
+        Set the value of a global parameter controlling titration states, to be pushed to the Context with the next update.
+
+        The default value in the System is changed as well, so that new Contexts start from the current titration states.
+
+        ARGUMENTS
+
+        name (string) - the name of the global parameter
+        value (float) - the new value
+
+        """
+        self._global_parameter_values[name] = value
+        self._global_parameters_modified.add(name)
+        for (force, index) in self._global_parameter_defaults[name]:
+            force.setGlobalParameterDefaultValue(index, value)
+
+        return
+
+#=============================================================================================
+# Monte Carlo titration.
+#=============================================================================================
+
+class MonteCarloTitration(TitrationDriver):
+    """
+    Monte Carlo titration driver for constnat-pH dynamics.
+
+    This move type implements the constant-pH dynamics of Mongan and Case [1].
+
+    REFERENCES
+
+    [1] Mongan J, Case DA, and McCammon JA. Constant pH molecular dynamics in generalized Born implicit solvent. J Comput Chem 25:2038, 2004.
+    http://dx.doi.org/10.1002/jcc.20139
+    
+    [2] Stern HA. Molecular simulation with variable protonation states at constant pH. JCP 126:164112, 2007.
+    http://link.aip.org/link/doi/10.1063/1.2731781
+    
+    [3] Nonequilibrium candidate Monte Carlo is an efficient tool for equilibrium simulation. PNAS 108:E1009, 2011.
+    http://dx.doi.org/10.1073/pnas.1106094108
+
+    TODO
+
+    * Add methods to keep track of history of protonation states.
+
+    """
+
+    #=============================================================================================
+    # Initialization.
+    #=============================================================================================
+
+    def __init__(self, system, temperature, pH, prmtop, cpin_filename, nattempts_per_update=None, simultaneous_proposal_probability=0.1, proposal_size_probabilities=None, neighbor_cutoff=None, use_global_parameters=False, analytic_coulomb=False, analytic_gb=False, analytic_gb_tolerance=0.01, site_interaction_sweeps=0, proposal_scheme='uniform', tautomer_move_probability=0.0, ncmc_steps=0, ncmc_propagation_steps=1, energy_cache_memory=16777216, enumeration_threshold=0, debug=False):
+        """
+        Initialize a Monte Carlo titration driver for constant pH simulation.
+
+        ARGUMENTS
+
+        system (simtk.openmm.System) - system to be titrated, containing all possible protonation sites
+        temperature (simtk.unit.Quantity compatible with simtk.unit.kelvin) - temperature to be simulated
+        pH (float) - the pH to be simulated 
+        prmtop (simtk.openmm.app.AmberPrmtopFile) - parsed AMBER 'prmtop' file; 1,4 exceptions are identified from the System, and its bonds
+                                                    are only used if the System defines neither bonds nor constraints, so it may be None
+        cpin_filename (string) - AMBER 'cpin' file defining protonation charge states and energies
+
+        OPTIONAL ARGUMENTS
+        
+        nattempts_per_update (int) - number of protonation state change attempts per update call; 
+                                   if None, set automatically based on number of titratible groups (default: None)
+        simultaneous_proposal_probability (float) - probability of simultaneously proposing two updates
+        proposal_size_probabilities (list of float) - if specified, element k-1 is the probability of simultaneously proposing updates of k groups;
+                                                      overrides simultaneous_proposal_probability (default: None)
+        neighbor_cutoff (simtk.unit.Quantity compatible with simtk.unit.nanometers) - if specified, groups updated simultaneously are drawn among the
+                                                      groups whose centroids are within this distance of a first, randomly drawn group (default: None)
+        use_global_parameters (boolean) - if True, electrostatics of titratable atoms are computed by Custom forces whose charges are
+                                          controlled by global parameters, so that a state change is a Context.setParameter() call
+                                          instead of a parameter upload; requires NoCutoff electrostatics, so explicit-solvent (PME)
+                                          Systems are not covered (default: False)
+        analytic_coulomb (boolean) - if True, Coulomb energy changes of titration trials are computed analytically from the electrostatic potentials
+                                     at titratable atoms, which are computed once per configuration, instead of by the Context;
+                                     requires NoCutoff electrostatics (default: False)
+        analytic_gb (boolean) - if True, GB energy changes of titration trials are computed analytically from Born radii computed once per
+                                configuration, instead of by the Context; requires OBC2 GB forces without cutoff (default: False)
+        analytic_gb_tolerance (float) - bound, in kJ/mol, on the first-order error of analytic GB energies due to neglected Born radius
+                                        changes when a charge changes to or from zero in the cnstphgbforces models; 0 for exact energies,
+                                        at O(natoms^2) cost per such trial (default: 0.01)
+        site_interaction_sweeps (int) - if positive, each update also attempts a composite move generated by this many sweeps over all groups of a
+                                        pairwise site-interaction model of the titration energies, corrected by delayed acceptance (default: 0)
+        proposal_scheme (string) - how new states of the groups selected in a trial are proposed (default: 'uniform'):
+                                   'uniform' - uniformly among all joint states, including the current one, with Metropolis acceptance
+                                   'gibbs' - from the exact conditional distribution over all joint states, always accepted
+                                   'metropolized-gibbs' - from the conditional distribution excluding the current joint state, with Metropolis-Hastings acceptance
+        tautomer_move_probability (float) - probability that an attempt is a move between tautomers of the same protonation state of one group;
+                                            if nonzero, 'uniform' attempts propose states in a different tautomer class instead (default: 0.0)
+        ncmc_steps (int) - if positive, 'uniform' and tautomer attempts are nonequilibrium candidate Monte Carlo (NCMC) moves [3], in which parameters
+                           are switched from the initial to the final states in this many perturbation steps, separated by dynamics;
+                           lengths for individual residue types can be set or tuned with setNCMCProtocol() or beginNCMCTuning() (default: 0)
+        ncmc_propagation_steps (int) - number of integrator steps of the Context integrator between NCMC perturbation steps (default: 1)
+        energy_cache_memory (int) - bound, in bytes, on the memory used to cache energies of protonation states visited since dynamics
+                                    was last run, so that revisited states are not evaluated again; 0 disables the cache (default: 16 MB)
+        enumeration_threshold (int) - if the number of joint protonation states of all groups does not exceed this, update() enumerates them
+                                      exactly, accumulating Rao-Blackwellized populations and drawing the new states from the exact
+                                      distribution; 0 disables enumeration (default: 0)
+        debug (boolean) - turn debug information on/off
+
+        NOTE
+
+        The forces modified by titration (NonbondedForce, GBSAOBCForce, and CustomGBForce objects with a 'q' per-particle parameter)
+        are moved into dedicated force groups so that titration trials only need to evaluate their energies.
+        The driver must therefore be constructed before any Context is created for the System (see TitrationDriver).
+
+        TODO
+
+        * Allow constant-pH dynamics to be initialized in other ways than using the AMBER cpin file (e.g. from OpenMM app; automatically).
+
+        """
+        TitrationDriver.__init__(self, system, temperature, pH, prmtop, use_global_parameters=use_global_parameters, debug=debug)
+
+        # Set defaults.
+        self.simultaneous_proposal_probability = simultaneous_proposal_probability # probability of proposing two simultaneous protonation state changes
+        self.proposal_size_probabilities = proposal_size_probabilities # probability of proposing 1, 2, 3, ... simultaneous protonation state changes
+        self.neighbor_cutoff = neighbor_cutoff
+
+        # Store parameters.
+        self.cpin_filename = cpin_filename
+        self.analytic_coulomb = analytic_coulomb
+        self.analytic_gb = analytic_gb
+        self.analytic_gb_tolerance = analytic_gb_tolerance
+        self.site_interaction_sweeps = site_interaction_sweeps
+        if proposal_scheme not in ['uniform', 'gibbs', 'metropolized-gibbs']:
+            raise Exception("Unknown proposal scheme '%s'." % proposal_scheme)
+        self.proposal_scheme = proposal_scheme
+        self.tautomer_move_probability = tautomer_move_probability
+        self.ncmc_steps = ncmc_steps
+        self.ncmc_propagation_steps = ncmc_propagation_steps
+        self.enumeration_threshold = enumeration_threshold
+
+        # Current titration state of each group.
+        self.titrationStates = list()
+
+        # Titration states whose parameters are currently written to the System forces (None if not yet written).
+        self._parameterStates = list()
+
+        # Record of the titration trial in progress, if any.
+        self._trial = None
+
+        # Cached log probability of the current configuration and titration states.
+        self._cached_log_probability = None
+
+        # Energies of protonation states visited in the current configuration.
+        self._energy_cache = None
+        if energy_cache_memory:
+            self._energy_cache = TitrationEnergyCache(energy_cache_memory)
+
+        # Lists of analytic energy evaluators, keyed by the class of titration forces whose energies they replace; built when tables are compiled.
+        self._analytic_energies = dict()
+        self._analytic_epoch = None # configuration epoch for which the analytic evaluators were set up
+        self._analytic_states = None # titration states corresponding to the charges of the analytic evaluators
+
+        # Weights with which groups are selected for titration attempts (None for uniform), and statistics for learning them.
+        self._selection_weights = None
+        self._selection_statistics = None
+
+        # Neighbors of each titratable group, and the configuration epoch for which they were determined.
+        self._group_neighbors = None
+        self._neighbor_epoch = None
+
+        # NCMC switching lengths chosen for each residue type, and statistics for tuning them.
+        self._ncmc_protocol = dict()
+        self._ncmc_tuning = None
+
+        # Evaluators and cached parameters of the site-interaction model used to generate composite moves, and the GB forces
+        # from which the evaluators are set up when first needed.
+        self._site_interaction_energies = None
+        self._site_interaction_gb_forces = list()
+        self._site_interaction_model = None
+
+        # Pool of worker processes scoring candidate states of Gibbs proposals, if started, and the configuration shared with it.
+        self._scoring_pool = None
+        self._scoring_positions = None
+        self._scoring_epoch = None
+        self._scoring_version = 0
+        self._scoring_nworkers = 0
+        self._scoring_layout = None
+
+        # Asynchronous update in progress in the scoring pool, if any.
+        self._asynchronous_update = None
+
+        if cpin_filename:
+            # Define groups and states from the AMBER cpin file, and set the default states of all groups.
+            titration_states = self._readCpin(cpin_filename)
+            for (group_index, titration_state_index) in enumerate(titration_states):
+                self.setTitrationState(group_index, titration_state_index)
+
+        self.setNumAttemptsPerUpdate(nattempts_per_update)
+
+        # Reset statistics.
+        self.resetStatistics()
+                
+        return
+
+    def _getConfigurationEpoch(self, context):
+        """
+        Return a key identifying the current configuration of the Context, which changes whenever the positions or box vectors change.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context to examine
+
+        RETURNS
+
+        epoch (tuple) - key that compares equal only if the positions and box vectors are unchanged
+
+        NOTE
+
+        The key holds a checksum of the positions and box vectors, so that configurations changed without running dynamics, e.g. by
+        setPositions(), setState(), energy minimization, or replica exchange, are detected as well.
+
+        """
+        state = context.getState(getPositions=True)
+        positions = numpy.array(state.getPositions(asNumpy=True).value_in_unit(units.nanometers), numpy.float64)
+        epoch = (id(context), hash(positions.tostring()))
+        box_vectors = state.getPeriodicBoxVectors()
+        if box_vectors is not None:
+            epoch += (tuple([ _strip_units(component) for vector in box_vectors for component in vector ]),)
+
+        return epoch
+
+    def invalidateCache(self):
+        """
+        Discard cached quantities that depend on the configuration of the Context.
+
+        Changes of the configuration are detected by update() (see _getConfigurationEpoch()), so this is only needed if the force
+        parameters of the System are modified otherwise.
+
+        """
+        self._cached_log_probability = None
+        self._analytic_epoch = None
+        if self._energy_cache is not None:
+            self._energy_cache.clear()
+        self._site_interaction_model = None
+        self._neighbor_epoch = None
+
+        return
+
+    def resetStatistics(self):
+        """
+        Reset statistics of titration state tracking.
+
+        TODO
+
+        * Keep track of more statistics regarding history of individual protonation states.
+        * Keep track of work values for individual trials to use for calibration.
+        
+        """
+                
+        self.nattempted = 0
+        self.naccepted = 0 
+        self.work_history = list()
+
+        # Sums of exact conditional populations of the states of each group over enumerated configurations.
+        self.nenumerated = 0
+        self.population_sums = [ numpy.zeros([group['nstates']], numpy.float64) for group in self.titrationGroups ]
+        
+        return
+
+    #=============================================================================================
+    # Titration states.
+    #=============================================================================================
+
+    def addTitratableGroups(self, groups_atom_indices, residue_types=None):
+        """
+        Define several new titratable groups at once, without a current titration state until their first state is added.
+
+        See TitrationDriver.addTitratableGroups().
+
+        """
+        group_indices = TitrationDriver.addTitratableGroups(self, groups_atom_indices, residue_types=residue_types)
+
+        # Note that we haven't yet defined any titration states, so current state is set to None.
+        self.titrationStates += [ None for group_index in group_indices ]
+        self._parameterStates += [ None for group_index in group_indices ]
+
+        return group_indices
+
+    def addTitrationState(self, titration_group_index, pKref, relative_energy, charges, proton_count):
+        """
+        Add a titration state to a titratable group, and make it the current state of the group.
+
+        See TitrationDriver.addTitrationState().
+
+        """
+        TitrationDriver.addTitrationState(self, titration_group_index, pKref, relative_energy, charges, proton_count)
+
+        # Set current state to last defined state.
+        self.titrationStates[titration_group_index] = self.titrationGroups[titration_group_index]['nstates'] - 1
+
+        return
+
+    def getTitrationState(self, titration_group_index):        
+        """
+        Return the current titration state for the specified titratable group.
+        
+        ARGUMENTS
+
+        titration_group_index (int) - the titration group to be queried
+        
+        RETURNS
+
+        state (int) - the titration state for the specified titration group
+
+        """
+        if titration_group_index not in range(self.getNumTitratableGroups()):
+            raise Exception("Invalid titratable group requested.  Requested %d, valid groups are in range(%d)." % (titration_group_index, self.getNumTitratableGroups()))        
+
+        return self.titrationStates[titration_group_index]
+
+    def getTitrationStates(self):        
+        """
+        Return the current titration states for all titratable groups.        
+        
+        RETURNS
+
+        states (list of int) - the titration states for all titratable groups
+
+        """
+        return list(self.titrationStates) # deep copy
+
+    def _buildTitrationForces(self):
+        """
+        Set up the energy evaluators of titration trials and the titration forces for newly compiled parameter tables.
+
+        """
+        # Titration states are packed into compact keys for the energy cache.
+        self._state_key_dtype = numpy.uint8
+        if max([ group['nstates'] for group in self.titrationGroups ] + [0]) > 256:
+            self._state_key_dtype = numpy.int32
+        if self._energy_cache is not None:
+            self._energy_cache.clear()
+
+        # Set up analytic energy evaluators, if requested, from the original forces.
+        self._buildAnalyticEnergies()
+
+        # Replace per-particle charge updates by global parameters, if requested.
+        if self.use_global_parameters:
+            # Forces are deleted on removal from the System, so the site-interaction model keeps copies of the original GB forces.
+            self._site_interaction_gb_forces = [ copy.deepcopy(force) for force in self._site_interaction_gb_forces ]
+            self._buildGlobalParameterForces()
+            self._parameterStates = [ None for group in self.titrationGroups ]
+
+        return
+
+    def _updateReferenceWeights(self):
+        """
+        Compute the reference-state contribution to the log probability of each titration state, and their sum over all groups.
+
+        self._log_reference_sum holds the sum of group['log_reference_weights'] (see TitrationDriver._updateReferenceWeights()) over the
+        current titration states of all groups, which is then maintained incrementally as group states change.
+
+        """
+        TitrationDriver._updateReferenceWeights(self)
+
+        self._log_reference_sum = 0.0
+        for (titration_group, titration_state_index) in zip(self.titrationGroups, self.titrationStates):
+            if titration_state_index is not None:
+                self._log_reference_sum += titration_group['log_reference_weights'][titration_state_index]
+
+        return
+
+    def _writeTitrationState(self, titration_group_index, titration_state_index, debug=False):
+        """
+        Write the parameters of the specified titration state into the System forces.
+
+        Only atoms and exceptions whose parameters differ from the state currently written to the System are modified.
+
+        ARGUMENTS
+        
+        titration_group_index (int) - the index of the titratable group whose parameters should be written
+        titration_state_index (int) - the titration state to write
+
+        OPTIONAL ARGUMENTS
+
+        debug (boolean) - if True, will print debug information
+
+        RETURNS
+
+        nchanged (int) - number of particle and exception parameter sets modified
+
+        """
+        if not self._compiled:
+            self._compileTitrationTables()
+
+        titration_group = self.titrationGroups[titration_group_index]
+        initial_state_index = self._parameterStates[titration_group_index]
+        if initial_state_index is None:
+            # Parameters currently in the System are unknown, so write everything.
+            atoms = range(len(titration_group['atom_indices']))
+            exceptions = range(len(titration_group['exception_indices']))
+        else:
+            (atoms, exceptions) = titration_group['transitions'][initial_state_index][titration_state_index]
+
+        if debug: print " group %d : state %s -> %d : modifying %d atoms and %d exceptions" % (titration_group_index, str(initial_state_index), titration_state_index, len(atoms), len(exceptions))
+
+        if self._global_parameter_values is not None:
+            # Only the global parameters selecting the state of this group change.
+            for (state_index, name) in enumerate(titration_group['global_parameter_names']):
+                if name is None: continue
+                value = 1.0 if (state_index == titration_state_index) else 0.0
+                if (initial_state_index is None) or (self._global_parameter_values[name] != value):
+                    if self._trial is not None:
+                        self._trial['snapshot'].append( ('parameter', None, name, self._global_parameter_values[name]) )
+                    self._setGlobalParameter(name, value)
+            self._parameterStates[titration_group_index] = titration_state_index
+            return len(atoms) + len(exceptions)
+
+        # If a trial is in progress, parameters about to be overwritten are recorded so they can be restored on rejection.
+        snapshot = None
+        if self._trial is not None:
+            snapshot = self._trial['snapshot']
+
+        charges = titration_group['charges'][titration_state_index]
+        atom_indices = titration_group['atom_indices']
+        for (force_index, force) in enumerate(self.forces_to_update):
+            particle_parameters = titration_group['particle_parameters'][force_index]
+            charge_parameter_index = self._charge_parameter_indices[force_index]
+            # Update charges.
+            for atom_local_index in atoms:
+                parameters = particle_parameters[atom_local_index]
+                if snapshot is not None:
+                    if initial_state_index is None:
+                        previous_parameters = self._getParticleParameters(force, atom_indices[atom_local_index])
+                    else:
+                        previous_parameters = list(parameters)
+                        previous_parameters[charge_parameter_index] = float(titration_group['charges'][initial_state_index, atom_local_index])
+                    snapshot.append( ('particle', force_index, atom_indices[atom_local_index], previous_parameters) )
+                parameters[charge_parameter_index] = float(charges[atom_local_index])
+                self._setParticleParameters(force, atom_indices[atom_local_index], parameters)
+            # Update exceptions.
+            if force.__class__.__name__ == 'NonbondedForce':
+                chargeprods = titration_group['exception_chargeprods'][titration_state_index]
+                for exception_local_index in exceptions:
+                    [particle1, particle2, sigma, epsilon] = titration_group['exception_parameters'][exception_local_index]
+                    chargeProd = float(chargeprods[exception_local_index])
+                    partner = titration_group['exception_partners'][exception_local_index]
+                    if partner is not None:
+                        # Partner atom belongs to another titratable group, so use its current charge.
+                        (partner_group_index, partner_local_index) = partner
+                        partner_group = self.titrationGroups[partner_group_index]
+                        partner_charge = partner_group['charges'][self.titrationStates[partner_group_index], partner_local_index]
+                        atom_local_index = max(titration_group['exception_atoms'][exception_local_index]) # the other entry is -1
+                        chargeProd = float(self.coulomb14scale) * float(charges[atom_local_index]) * float(partner_charge)
+                        # BEGIN UGLY HACK
+                        if (chargeProd == 0.0): chargeProd = sys.float_info.epsilon
+                        # END UGLY HACK
+                    exception_index = titration_group['exception_indices'][exception_local_index]
+                    if snapshot is not None:
+                        snapshot.append( ('exception', force_index, exception_index, [particle1, particle2, self._exceptionChargeProds[exception_index], sigma, epsilon]) )
+                    force.setExceptionParameters(exception_index, particle1, particle2, chargeProd, sigma, epsilon)
+                    self._exceptionChargeProds[exception_index] = chargeProd
+                if len(exceptions) > 0:
+                    self._forces_modified[force_index] = True
+            if len(atoms) > 0:
+                self._forces_modified[force_index] = True
+
+        self._parameterStates[titration_group_index] = titration_state_index
+
+        return len(atoms) + len(exceptions)
+
+    def _writeInterpolatedTitrationStates(self, transitions, fraction):
+        """
+        Write parameters interpolated between the initial and final states of groups that change state together into the System forces.
+
+        Charges are interpolated linearly.  Exceptions between two changing groups use the interpolated charges of both particles;
+        all other exception charge products are interpolated linearly.  In global-parameter mode, the global parameters are interpolated.
+
+        ARGUMENTS
+
+        transitions (list of tuple) - (titration group index, initial state index, final state index) for each changing group
+        fraction (float) - interpolation parameter, 0 for the initial and 1 for the final states
+
+        NOTE
+
+        Only the atoms and exceptions that differ between the initial and final states are written, and self._parameterStates is not
+        modified, so that a subsequent setTitrationState() to either the initial or the final state overwrites all interpolated parameters.
+        Interpolated parameters are not recorded in titration trials.
+
+        """
+        if not self._compiled:
+            self._compileTitrationTables()
+
+        interpolated_charges = dict()
+        for (titration_group_index, initial_state_index, final_state_index) in transitions:
+            charges = self.titrationGroups[titration_group_index]['charges']
+            interpolated_charges[titration_group_index] = (1.0 - fraction) * charges[initial_state_index] + fraction * charges[final_state_index]
+
+        for (titration_group_index, initial_state_index, final_state_index) in transitions:
+            titration_group = self.titrationGroups[titration_group_index]
+
+            if self._global_parameter_values is not None:
+                for (state_index, name) in enumerate(titration_group['global_parameter_names']):
+                    if name is None: continue
+                    value = 0.0
+                    if state_index == initial_state_index: value += 1.0 - fraction
+                    if state_index == final_state_index: value += fraction
+                    self._setGlobalParameter(name, value)
+                continue
+
+            (atoms, exceptions) = titration_group['transitions'][initial_state_index][final_state_index]
+            charges = interpolated_charges[titration_group_index]
+            atom_indices = titration_group['atom_indices']
+            for (force_index, force) in enumerate(self.forces_to_update):
+                charge_parameter_index = self._charge_parameter_indices[force_index]
+                for atom_local_index in atoms:
+                    parameters = list(titration_group['particle_parameters'][force_index][atom_local_index])
+                    parameters[charge_parameter_index] = float(charges[atom_local_index])
+                    self._setParticleParameters(force, atom_indices[atom_local_index], parameters)
+                if force.__class__.__name__ == 'NonbondedForce':
+                    chargeprods = titration_group['exception_chargeprods']
+                    for exception_local_index in exceptions:
+                        [particle1, particle2, sigma, epsilon] = titration_group['exception_parameters'][exception_local_index]
+                        chargeProd = (1.0 - fraction) * chargeprods[initial_state_index, exception_local_index] + fraction * chargeprods[final_state_index, exception_local_index]
+                        partner = titration_group['exception_partners'][exception_local_index]
+                        if partner is not None:
+                            (partner_group_index, partner_local_index) = partner
+                            if partner_group_index in interpolated_charges:
+                                partner_charge = interpolated_charges[partner_group_index][partner_local_index]
+                            else:
+                                partner_charge = self.titrationGroups[partner_group_index]['charges'][self.titrationStates[partner_group_index], partner_local_index]
+                            atom_local_index = max(titration_group['exception_atoms'][exception_local_index]) # the other entry is -1
+                            chargeProd = float(self.coulomb14scale) * charges[atom_local_index] * partner_charge
+                        # BEGIN UGLY HACK
+                        if (chargeProd == 0.0): chargeProd = sys.float_info.epsilon
+                        # END UGLY HACK
+                        exception_index = titration_group['exception_indices'][exception_local_index]
+                        force.setExceptionParameters(exception_index, particle1, particle2, float(chargeProd), sigma, epsilon)
+                        self._exceptionChargeProds[exception_index] = float(chargeProd)
+                    if len(exceptions) > 0:
+                        self._forces_modified[force_index] = True
+                if len(atoms) > 0:
+                    self._forces_modified[force_index] = True
+
+        return
+
+    def setTitrationState(self, titration_group_index, titration_state_index, context=None, debug=False):
+        """
+        Change the titration state of the designated group for the provided state.
+
+        ARGUMENTS
+        
+        titration_group_index (int) - the index of the titratable group whose titration state should be updated
+        titration_state_index (int) - the titration state to set as active
+        
+        OPTIONAL ARGUMENTS
+
+        context (simtk.openmm.Context) - if provided, will update protonation state in the specified Context (default: None)
+        debug (boolean) - if True, will print debug information
+
+        """
+
+        # Check parameters for validity.
+        if titration_group_index not in range(self.getNumTitratableGroups()):
+            raise Exception("Invalid titratable group requested.  Requested %d, valid groups are in range(%d)." % (titration_group_index, self.getNumTitratableGroups()))        
+        if titration_state_index not in range(self.getNumTitrationStates(titration_group_index)):
+            raise Exception("Invalid titration state requested.  Requested %d, valid states are in range(%d)." % (titration_state_index, self.getNumTitrationStates(titration_group_index)))
+
+        if not self._compiled:
+            self._compileTitrationTables()
+
+        # Update titration state records and the running sum of reference-state contributions.
+        log_reference_weights = self.titrationGroups[titration_group_index]['log_reference_weights']
+        self._log_reference_sum += log_reference_weights[titration_state_index] - log_reference_weights[self.titrationStates[titration_group_index]]
+        self.titrationStates[titration_group_index] = titration_state_index
+
+        # Modify charges and exceptions that differ from those currently in the System.
+        self._writeTitrationState(titration_group_index, titration_state_index, debug=debug)
+
+        # Update parameters in Context, if specified.
+        if context:
+            self._updateParametersInContext(context)
+
+        return
+
+    def _updateParametersInContext(self, context, force_groups=None):
+        """
+        Push modified force parameters to the Context, with one updateParametersInContext call per modified force.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context to update
+
+        OPTIONAL ARGUMENTS
+
+        force_groups (list of int) - if specified, only forces in these force groups are pushed (default: None)
+
+        RETURNS
+
+        nupdated (int) - the number of forces whose parameters were pushed
+
+        """
+        if context not in self._verified_contexts:
+            self._verifyForceGroups(context)
+
+        # Global parameters are cheap to set and do not count as parameter uploads.
+        for name in self._global_parameters_modified:
+            context.setParameter(name, self._global_parameter_values[name])
+        self._global_parameters_modified = set()
+
+        nupdated = 0
+        for (force_index, force) in enumerate(self.forces_to_update):
+            if (force_groups is not None) and (force.getForceGroup() not in force_groups):
+                continue
+            if self._forces_modified[force_index] and hasattr(force, 'updateParametersInContext'):
+                force.updateParametersInContext(context)
+                self._forces_modified[force_index] = False
+                if self._trial is not None:
+                    self._trial['forces_pushed'][force_index] = True
+                nupdated += 1
+
+        return nupdated
+
+    #=============================================================================================
+    # Analytic energies.
+    #=============================================================================================
+
+    def _buildAnalyticEnergies(self):
+        """
+        Set up the requested analytic energy evaluators from the forces in the System.
+
+        NOTE
+
+        Each list of evaluators replaces the Context energy of the titration force groups of one class (see _assignTitrationForceGroups()).
+        Titratable atoms are numbered in group order, with group['analytic_offset'] the index of the first atom of each group.
+
+        The evaluators of the site-interaction model are set up when first needed (see _buildSiteInteractionEnergies()); only the GB forces
+        they are set up from are recorded here.
+
+        """
+        self._analytic_energies = dict()
+        self._analytic_epoch = None
+        self._site_interaction_energies = None
+        self._site_interaction_model = None
+
+        offset = 0
+        titratable_atoms = list()
+        for group in self.titrationGroups:
+            group['analytic_offset'] = offset
+            titratable_atoms += list(group['atom_indices'])
+            offset += len(group['atom_indices'])
+
+        # GB forces are evaluated from their own parameters.
+        gb_forces = [ force for (force, classname) in zip(self._titration_forces, self._titration_force_classes) if classname == 'GB' ]
+        if self.analytic_gb:
+            self._analytic_energies['GB'] = [ self._createAnalyticGBEnergy(force, titratable_atoms) for force in gb_forces ]
+        if self.analytic_coulomb:
+            self._analytic_energies['Nonbonded'] = [ self._createAnalyticCoulombEnergy(titratable_atoms) ]
+        self._site_interaction_gb_forces = gb_forces
+
+        return
+
+    def _buildSiteInteractionEnergies(self):
+        """
+        Set up the analytic energy evaluators of the site-interaction model.
+
+        NOTE
+
+        The model only needs to approximate the energies: electrostatics are treated without cutoff, and GB models that cannot be
+        evaluated are omitted with a warning.
+
+        """
+        titratable_atoms = [ atom_index for group in self.titrationGroups for atom_index in group['atom_indices'] ]
+
+        self._site_interaction_energies = [ self._createAnalyticCoulombEnergy(titratable_atoms, approximate=True) ]
+        for force in self._site_interaction_gb_forces:
+            (model, reason) = self._identifyAnalyticGBModel(force)
+            if model is None:
+                warnings.warn("%s  The site-interaction model omits the energy of this %s." % (reason, force.__class__.__name__))
+                continue
+            self._site_interaction_energies.append(self._createAnalyticGBEnergy(force, titratable_atoms))
+
+        return
+
+    def _createAnalyticCoulombEnergy(self, titratable_atoms, approximate=False):
+        """
+        Create an analytic evaluator for the Coulomb energy of the NonbondedForce.
+
+        ARGUMENTS
+
+        titratable_atoms (list of int) - indices of titratable atoms, in the order used for charge changes
+
+        OPTIONAL ARGUMENTS
+
+        approximate (boolean) - if True, electrostatics with a cutoff are approximated by those without cutoff, instead of raising an exception (default: False)
+
+        RETURNS
+
+        analytic_energy (AnalyticCoulombEnergy) - the evaluator
+
+        """
+        # Locate the NonbondedForce.
+        nonbonded_force_indices = [ index for index in range(self.system.getNumForces()) if self.system.getForce(index).__class__.__name__ == 'NonbondedForce' ]
+        if len(nonbonded_force_indices) != 1:
+            raise Exception("Analytic Coulomb energies require exactly one NonbondedForce.")
+        nonbonded_force = self.system.getForce(nonbonded_force_indices[0])
+        if (nonbonded_force.getNonbondedMethod() != openmm.NonbondedForce.NoCutoff) and not approximate:
+            raise Exception("Analytic Coulomb energies are only implemented for NoCutoff electrostatics.")
+
+        charges = numpy.array([ _strip_units(nonbonded_force.getParticleParameters(atom_index)[0]) for atom_index in range(nonbonded_force.getNumParticles()) ], numpy.float64)
+
+        # Titratable 1,4 interactions are scaled; all other exceptions of titratable atoms have charge products that do not change.
+        coulomb14scale = float(self.coulomb14scale or 0.0)
+        scaled_exceptions = set([ exception_index for group in self.titrationGroups for exception_index in group['exception_indices'] ])
+        exception_pairs = list()
+        exception_weights = list()
+        particles = self._getExceptionIndex(self.system, nonbonded_force_indices[0])['particles']
+        for exception_index in numpy.where((self._atomGroupIndices[particles] >= 0).any(axis=1))[0]:
+            exception_pairs.append([int(particle) for particle in particles[exception_index]])
+            exception_weights.append(coulomb14scale if (exception_index in scaled_exceptions) else 0.0)
+
+        return AnalyticCoulombEnergy(charges, titratable_atoms, exception_pairs, exception_weights)
+
+    def _createAnalyticGBEnergy(self, force, titratable_atoms):
+        """
+        Create an analytic evaluator for the energy of a GB force.
+
+        ARGUMENTS
+
+        force (simtk.openmm.Force) - a GBSAOBCForce, or a CustomGBForce created by cnstphgbforces.GBSAOBC2Force() or cnstphgbforces.GBSAOBCForceAsCustomGBForce()
+        titratable_atoms (list of int) - indices of titratable atoms, in the order used for charge changes
+
+        RETURNS
+
+        analytic_energy (AnalyticGBEnergy) - the evaluator
+
+        """
+        (model, reason) = self._identifyAnalyticGBModel(force)
+        if model is None:
+            raise Exception(reason)
+
+        natoms = force.getNumParticles()
+        if force.__class__.__name__ == 'GBSAOBCForce':
+            parameters = numpy.array([ [ _strip_units(parameter) for parameter in force.getParticleParameters(index) ] for index in range(natoms) ], numpy.float64)
+            return AnalyticGBEnergy(parameters[:,0], parameters[:,1], parameters[:,2], titratable_atoms, _strip_units(force.getSolventDielectric()), _strip_units(force.getSoluteDielectric()),
+                                    surface_area_factor=model['surface_area_factor'], engulfment=True, exclude_uncharged=False)
+
+        # Extract parameters by name.
+        global_parameters = dict([ (force.getGlobalParameterName(index), force.getGlobalParameterDefaultValue(index)) for index in range(force.getNumGlobalParameters()) ])
+        parameter_names = [ force.getPerParticleParameterName(index) for index in range(force.getNumPerParticleParameters()) ]
+        parameters = numpy.array([ [ _strip_units(parameter) for parameter in force.getParticleParameters(index) ] for index in range(natoms) ], numpy.float64)
+        (charges, radii, scales) = [ parameters[:,parameter_names.index(name)] for name in ['q', 'radius', 'scale'] ]
+        return AnalyticGBEnergy(charges, radii, scales, titratable_atoms, global_parameters['solventDielectric'], global_parameters['soluteDielectric'], offset=global_parameters['offset'],
+                                surface_area_factor=model['surface_area_factor'], engulfment=model['engulfment'], exclude_uncharged=model['exclude_uncharged'],
+                                energy_tolerance=self.analytic_gb_tolerance)
+
+    def _identifyAnalyticGBModel(self, force):
+        """
+        Identify the GB model of a force, for analytic evaluation of its energy.
+
+        ARGUMENTS
+
+        force (simtk.openmm.Force) - the GB force
+
+        RETURNS
+
+        model (dict) - the 'engulfment', 'exclude_uncharged', and 'surface_area_factor' arguments of AnalyticGBEnergy, or None if the
+                       energy of the force cannot be evaluated analytically
+        reason (string) - why the energy cannot be evaluated analytically, or None
+
+        """
+        force_classname = force.__class__.__name__
+        if force_classname == 'GBSAOBCForce':
+            if force.getNonbondedMethod() != openmm.GBSAOBCForce.NoCutoff:
+                return (None, "Analytic GB energies are only implemented for GB forces without cutoff.")
+            surface_area_factor = 28.3919551
+            if hasattr(force, 'getSurfaceAreaEnergy'):
+                surface_area_factor = 4 * math.pi * _strip_units(force.getSurfaceAreaEnergy())
+            return ({ 'engulfment' : True, 'exclude_uncharged' : False, 'surface_area_factor' : surface_area_factor }, None)
+
+        if force_classname != 'CustomGBForce':
+            return (None, "Analytic GB energies are not implemented for force type '%s'." % force_classname)
+        if force.getNonbondedMethod() != openmm.CustomGBForce.NoCutoff:
+            return (None, "Analytic GB energies are only implemented for GB forces without cutoff.")
+
+        # Identify the model by comparing the expressions with those of the OBC2 forces in cnstphgbforces.
+        def get_expressions(custom_force):
+            computed_values = [ tuple(custom_force.getComputedValueParameters(index)) for index in range(custom_force.getNumComputedValues()) ]
+            energy_terms = set([ tuple(custom_force.getEnergyTermParameters(index)) for index in range(custom_force.getNumEnergyTerms()) ])
+            return (computed_values, energy_terms)
+        (computed_values, energy_terms) = get_expressions(force)
+        (excluded_computed_values, surface_area_energy_terms) = get_expressions(cnstphgbforces.GBSAOBC2Force(SA='ACE'))
+        (excluded_computed_values, polarization_energy_terms) = get_expressions(cnstphgbforces.GBSAOBC2Force(SA=None))
+        (engulfed_computed_values, engulfed_energy_terms) = get_expressions(cnstphgbforces.GBSAOBCForceAsCustomGBForce(openmm.GBSAOBCForce()))
+        if computed_values == excluded_computed_values:
+            (engulfment, exclude_uncharged) = (False, True)
+        elif computed_values == engulfed_computed_values:
+            (engulfment, exclude_uncharged) = (True, False)
+        else:
+            return (None, "Analytic GB energies are only implemented for the OBC2 models of cnstphgbforces.")
+        if energy_terms not in [surface_area_energy_terms, polarization_energy_terms]:
+            return (None, "Analytic GB energies are only implemented for the OBC2 models of cnstphgbforces.")
+        surface_area_factor = 28.3919551 if (energy_terms == surface_area_energy_terms) else 0.0
+
+        return ({ 'engulfment' : engulfment, 'exclude_uncharged' : exclude_uncharged, 'surface_area_factor' : surface_area_factor }, None)
+
+    def _getContextEnergyGroups(self):
+        """
+        Return the titration force groups whose energies must be computed by the Context, as they are not evaluated analytically.
+
+        RETURNS
+
+        force_groups (list of int) - the force groups
+
+        """
+        return sorted(set([ force_group for (force_group, classname) in zip(self.titration_force_groups, self._titration_force_classes) if classname not in self._analytic_energies ]))
+
+    def _getAnalyticChargeChanges(self, titration_states):
+        """
+        Return the changes in the charges of titratable atoms between the states of the analytic evaluators and the given titration states.
+
+        ARGUMENTS
+
+        titration_states (list of int) - titration state of each group
+
+        RETURNS
+
+        indices (numpy array of int) - titratable-local indices of the atoms whose charges change
+        delta_charges (numpy array) - the charge changes
+
+        """
+        indices = list()
+        delta_charges = list()
+        for (group_index, (initial_state, final_state)) in enumerate(zip(self._analytic_states, titration_states)):
+            if initial_state == final_state:
+                continue
+            group = self.titrationGroups[group_index]
+            (changed_atoms, changed_exceptions) = group['transitions'][initial_state][final_state]
+            indices.append(group['analytic_offset'] + changed_atoms)
+            delta_charges.append(group['charges'][final_state,changed_atoms] - group['charges'][initial_state,changed_atoms])
+        if len(indices) == 0:
+            return (numpy.zeros([0], numpy.int64), numpy.zeros([0], numpy.float64))
+
+        return (numpy.concatenate(indices), numpy.concatenate(delta_charges))
+
+    def _getPositions(self, context):
+        """
+        Return the positions of the Context as a unit-free array, in nm.
+
+        """
+        positions = context.getState(getPositions=True).getPositions(asNumpy=True)
+        return numpy.array(positions.value_in_unit(units.nanometers), numpy.float64)
+
+    def _getTitratableCharges(self, titration_states):
+        """
+        Return the charges of all titratable atoms, numbered in group order, for the given titration states.
+
+        """
+        return numpy.concatenate([ group['charges'][state_index,:] for (group, state_index) in zip(self.titrationGroups, titration_states) ])
+
+    def _getAnalyticEnergy(self, context, epoch=None):
+        """
+        Return the analytically evaluated energy of the current titration states, relative to a reference fixed for each configuration.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context, from which positions are retrieved when the configuration has changed
+
+        OPTIONAL ARGUMENTS
+
+        epoch (tuple) - the configuration epoch, as returned by _getConfigurationEpoch(); determined from the Context if None (default: None)
+
+        RETURNS
+
+        energy (float) - the energy, in kJ/mol
+
+        """
+        if epoch is None:
+            epoch = self._getConfigurationEpoch(context)
+        if epoch != self._analytic_epoch:
+            # Recompute potentials for the new configuration.
+            positions = self._getPositions(context)
+            titratable_charges = self._getTitratableCharges(self.titrationStates)
+            for analytic_energies in self._analytic_energies.values():
+                for analytic_energy in analytic_energies:
+                    analytic_energy.setConfiguration(positions, titratable_charges)
+            self._analytic_epoch = epoch
+            self._analytic_states = list(self.titrationStates)
+
+        (indices, delta_charges) = self._getAnalyticChargeChanges(self.titrationStates)
+        energy = 0.0
+        for analytic_energies in self._analytic_energies.values():
+            for analytic_energy in analytic_energies:
+                energy += analytic_energy.getEnergy() + analytic_energy.getEnergyChange(indices, delta_charges)
+
+        return energy
+
+    def _updateAnalyticStates(self):
+        """
+        Update the analytic evaluators to the current titration states, e.g. after a trial has been accepted.
+
+        """
+        if self._analytic_epoch is None:
+            return
+
+        (indices, delta_charges) = self._getAnalyticChargeChanges(self.titrationStates)
+        for analytic_energies in self._analytic_energies.values():
+            for analytic_energy in analytic_energies:
+                analytic_energy.applyChange(indices, delta_charges)
+        self._analytic_states = list(self.titrationStates)
+
+        return
+
+    #=============================================================================================
+    # Group selection.
+    #=============================================================================================
+
+    def _drawProposalSize(self):
+        """
+        Draw the number of titratable groups to simultaneously attempt to update.
+
+        RETURNS
+
+        ndraw (int) - the number of groups, at most the number of titratable groups
+
+        """
+        ngroups = self.getNumTitratableGroups()
+        probabilities = self.proposal_size_probabilities
+        if probabilities is None:
+            probabilities = [1.0 - self.simultaneous_proposal_probability, self.simultaneous_proposal_probability]
+
+        # Draw k with probability probabilities[k-1].
+        cumulative_probabilities = numpy.cumsum(probabilities)
+        ndraw = 1 + min(int(numpy.searchsorted(cumulative_probabilities, random.random() * cumulative_probabilities[-1], side='right')), len(probabilities)-1)
+
+        return max(1, min(ndraw, ngroups))
+
+    def _selectTitrationGroups(self, context, epoch, ndraw):
+        """
+        Select the titratable groups to simultaneously attempt to update.
+
+        Without a neighbor cutoff, groups are drawn uniformly.  Otherwise, a first group is drawn uniformly and the others uniformly
+        among its neighbors, so that fewer than ndraw groups are returned if it has fewer than ndraw-1 neighbors.
+        If selection weights have been set (see endSelectionWeightAdaptation()), groups drawn uniformly are instead drawn with probability
+        proportional to their weights.  In all cases the selection does not depend on the titration states, so the proposal remains symmetric.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context
+        epoch (tuple) - the configuration epoch, as returned by _getConfigurationEpoch()
+        ndraw (int) - the number of groups to select
+
+        RETURNS
+
+        titration_group_indices (list of int) - the selected groups
+
+        """
+        ngroups = self.getNumTitratableGroups()
+        if self._selection_weights is not None:
+            # Draw groups with probability proportional to their (fixed) selection weights, without replacement.
+            candidates = range(ngroups)
+            titration_group_indices = list()
+            for draw in range(ndraw if (self.neighbor_cutoff is None) else 1):
+                cumulative_weights = numpy.cumsum(self._selection_weights[candidates])
+                index = min(int(numpy.searchsorted(cumulative_weights, random.random() * cumulative_weights[-1], side='right')), len(candidates)-1)
+                titration_group_indices.append(candidates.pop(index))
+            if (self.neighbor_cutoff is None) or (ndraw == 1):
+                return titration_group_indices
+            first_group_index = titration_group_indices[0]
+        elif (self.neighbor_cutoff is None) or (ndraw == 1):
+            return random.sample(range(ngroups), ndraw)
+        else:
+            first_group_index = random.randrange(ngroups)
+
+        neighbors = self._getGroupNeighbors(context, epoch)[first_group_index]
+
+        return [first_group_index] + random.sample(neighbors, min(ndraw-1, len(neighbors)))
+
+    def beginSelectionWeightAdaptation(self):
+        """
+        Start learning selection weights, by recording how often each group changes state when selected in subsequent updates.
+
+        NOTE
+
+        Groups are selected with the current weights (uniformly, if none have been set) while learning.  Since the weights change with the
+        history, updates while learning do not preserve detailed balance; this should only be done during equilibration.
+
+        """
+        ngroups = self.getNumTitratableGroups()
+        self._selection_statistics = dict()
+        self._selection_statistics['nattempted'] = numpy.zeros([ngroups], numpy.int64)
+        self._selection_statistics['nchanged'] = numpy.zeros([ngroups], numpy.int64)
+
+        return
+
+    def endSelectionWeightAdaptation(self, minimum_weight=0.05):
+        """
+        Stop learning selection weights, and freeze the weights at the rates at which groups changed state while learning.
+
+        OPTIONAL ARGUMENTS
+
+        minimum_weight (float) - lower bound on the weight of each group, relative to the mean weight, which keeps all groups sampled (default: 0.05)
+
+        RETURNS
+
+        weights (numpy array of shape [ngroups]) - the normalized selection weights
+
+        NOTE
+
+        Rates are estimated as (nchanged + 1) / (nattempted + 2), so that groups never selected while learning get weight 1/2.
+
+        """
+        if self._selection_statistics is None:
+            raise Exception("Selection weight adaptation has not been started.")
+
+        rates = (self._selection_statistics['nchanged'] + 1.0) / (self._selection_statistics['nattempted'] + 2.0)
+        self._selection_statistics = None
+        self.setSelectionWeights(numpy.maximum(rates, minimum_weight * rates.mean()))
+
+        return self._selection_weights
+
+    def setSelectionWeights(self, weights=None):
+        """
+        Set the relative probabilities with which groups are selected for titration attempts.
+
+        OPTIONAL ARGUMENTS
+
+        weights (list or numpy array of float) - positive weight of each group, or None to select groups uniformly (default: None)
+
+        """
+        if weights is None:
+            self._selection_weights = None
+            return
+
+        weights = numpy.array(weights, numpy.float64)
+        if (weights.shape != (self.getNumTitratableGroups(),)) or numpy.any(weights <= 0.0):
+            raise Exception("Selection weights must be positive, one for each titratable group.")
+        self._selection_weights = weights / weights.sum()
+
+        return
+
+    def getSelectionWeights(self):
+        """
+        Return the normalized probabilities with which groups are selected for titration attempts, or None if they are selected uniformly.
+
+        """
+        return self._selection_weights
+
+    def _getGroupNeighbors(self, context, epoch):
+        """
+        Return the neighbors of each titratable group, determined with a cell list of group centroids once per configuration.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context
+        epoch (tuple) - the configuration epoch, as returned by _getConfigurationEpoch()
+
+        RETURNS
+
+        neighbors (list of list of int) - neighbors[g] are the groups whose centroids are within self.neighbor_cutoff of that of group g
+
+        NOTE
+
+        Rectangular periodic boxes are handled with the minimum image convention.
+
+        """
+        if (self._group_neighbors is not None) and (self._neighbor_epoch == epoch):
+            return self._group_neighbors
+
+        state = context.getState(getPositions=True)
+        positions = numpy.array(state.getPositions(asNumpy=True).value_in_unit(units.nanometers), numpy.float64)
+        centroids = numpy.array([ positions[group['atom_indices'],:].mean(axis=0) for group in self.titrationGroups ])
+        cutoff = _strip_units(self.neighbor_cutoff)
+
+        # Box edge lengths for periodic systems.
+        box_lengths = None
+        if hasattr(self.system, 'usesPeriodicBoundaryConditions') and self.system.usesPeriodicBoundaryConditions():
+            box_vectors = state.getPeriodicBoxVectors()
+            box_lengths = numpy.array([ _strip_units(box_vectors[dimension][dimension]) for dimension in range(3) ], numpy.float64)
+            centroids -= numpy.floor(centroids / box_lengths) * box_lengths
+
+        # Assign centroids to cells at least as large as the cutoff.
+        if box_lengths is not None:
+            ncells = numpy.maximum(1, numpy.floor(box_lengths / cutoff).astype(numpy.int64))
+            cell_indices = numpy.minimum(numpy.floor(centroids / (box_lengths / ncells)).astype(numpy.int64), ncells-1)
+        else:
+            cell_indices = numpy.floor(centroids / cutoff).astype(numpy.int64)
+        cells = dict()
+        for (group_index, cell_index) in enumerate(cell_indices):
+            cells.setdefault(tuple(cell_index), list()).append(group_index)
+
+        neighbors = [ list() for group in self.titrationGroups ]
+        for (group_index, cell_index) in enumerate(cell_indices):
+            # Collect candidates from this and all adjacent cells.
+            candidate_cells = set()
+            for offset in itertools.product([-1, 0, 1], repeat=3):
+                neighbor_cell = cell_index + numpy.array(offset)
+                if box_lengths is not None:
+                    neighbor_cell = neighbor_cell % ncells
+                candidate_cells.add(tuple(neighbor_cell))
+            for neighbor_cell in candidate_cells:
+                for neighbor_index in cells.get(neighbor_cell, list()):
+                    if neighbor_index == group_index:
+                        continue
+                    delta = centroids[neighbor_index] - centroids[group_index]
+                    if box_lengths is not None:
+                        delta -= numpy.round(delta / box_lengths) * box_lengths
+                    if numpy.sqrt((delta**2).sum()) <= cutoff:
+                        neighbors[group_index].append(neighbor_index)
+            neighbors[group_index].sort()
+
+        self._group_neighbors = neighbors
+        self._neighbor_epoch = epoch
+
+        return neighbors
+
+    #=============================================================================================
+    # Tautomer moves.
+    #=============================================================================================
+
+    def _proposeProtonationState(self, titration_group_index):
+        """
+        Propose a state of a group in a different tautomer class: the class is drawn uniformly among the other classes, then the state within it.
+
+        ARGUMENTS
+
+        titration_group_index (int) - the group
+
+        RETURNS
+
+        titration_state_index (int) - the proposed state (the current one if the group has a single class)
+        log_proposal_ratio (float) - log of the ratio of reverse to forward proposal probabilities, log(|new class| / |current class|)
+
+        """
+        group = self.titrationGroups[titration_group_index]
+        tautomer_classes = group['tautomer_classes']
+        current_state = self.titrationStates[titration_group_index]
+        current_class = group['state_classes'][current_state]
+        if len(tautomer_classes) == 1:
+            return (current_state, 0.0)
+
+        new_class = random.choice([ class_index for class_index in range(len(tautomer_classes)) if class_index != current_class ])
+        titration_state_index = random.choice(tautomer_classes[new_class])
+
+        return (titration_state_index, math.log(len(tautomer_classes[new_class])) - math.log(len(tautomer_classes[current_class])))
+
+    def _attemptTautomerMove(self, context, epoch):
+        """
+        Attempt to change the state of one group to another tautomer of its current protonation state.
+
+        The group is drawn uniformly among groups whose current tautomer class has more than one state, and the new state uniformly
+        among the other states of the class.  The proposal is symmetric, and reference energies cancel.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context to update
+        epoch (tuple) - the configuration epoch, as returned by _getConfigurationEpoch()
+
+        """
+        eligible_groups = [ group_index for (group_index, group) in enumerate(self.titrationGroups) if len(group['tautomer_classes'][group['state_classes'][self.titrationStates[group_index]]]) > 1 ]
+        if len(eligible_groups) == 0:
+            return
+
+        titration_group_index = random.choice(eligible_groups)
+        group = self.titrationGroups[titration_group_index]
+        current_state = self.titrationStates[titration_group_index]
+        titration_state_index = random.choice([ state_index for state_index in group['tautomer_classes'][group['state_classes'][current_state]] if state_index != current_state ])
+        self._attemptTitrationTrial(context, epoch, [titration_group_index], [titration_state_index])
+
+        return
+
+    #=============================================================================================
+    # Gibbs proposals.
+    #=============================================================================================
+
+    def _computeLogProbabilities(self, context, epoch, titration_group_indices, candidate_states):
+        """
+        Compute the log probabilities of the current configuration with the specified groups in each of the candidate joint states.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context
+        epoch (tuple) - the configuration epoch, as returned by _getConfigurationEpoch()
+        titration_group_indices (list of int) - the groups whose states are varied
+        candidate_states (list of tuple of int) - joint states of these groups
+
+        RETURNS
+
+        log_P (numpy array of shape [len(candidate_states)]) - the log probability of each candidate
+
+        NOTE
+
+        Each candidate is staged as a rejected titration trial, so the titration states are left unchanged.
+        With analytic energies, no parameters are pushed to the Context.
+        If a scoring pool has been started, all candidates, including the current states, are scored by the pool instead.
+
+        """
+        if self._scoring_pool is not None:
+            return self._scoreWithPool(context, epoch, titration_group_indices, candidate_states)
+
+        initial_states = tuple([ self.titrationStates[titration_group_index] for titration_group_index in titration_group_indices ])
+        log_P = numpy.zeros([len(candidate_states)], numpy.float64)
+        for (candidate_index, states) in enumerate(candidate_states):
+            if tuple(states) == initial_states:
+                log_P[candidate_index] = self._getCurrentLogProbability(context, epoch)
+                continue
+            self.beginTitrationTrial()
+            for (titration_group_index, titration_state_index) in zip(titration_group_indices, states):
+                self.setTitrationState(titration_group_index, titration_state_index)
+            log_P[candidate_index] = self._compute_log_probability(context, epoch)
+            self.rejectTitrationTrial()
+
+        return log_P
+
+    def _attemptGibbsMove(self, context, epoch, titration_group_indices):
+        """
+        Attempt a Gibbs or Metropolized Gibbs update of the joint state of the specified groups, as selected by self.proposal_scheme.
+
+        The log probabilities of all joint states of the groups are evaluated, giving their conditional distribution p.
+        With 'gibbs', the new state j is drawn from p and always accepted.
+        With 'metropolized-gibbs', j != i is drawn with probability p_j / (1 - p_i) and accepted with probability min(1, (1 - p_i) / (1 - p_j)),
+        which never proposes the current state i.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context
+        epoch (tuple) - the configuration epoch, as returned by _getConfigurationEpoch()
+        titration_group_indices (list of int) - the groups to update
+
+        """
+        initial_titration_states = list(self.titrationStates)
+        candidate_states = list(itertools.product(*[ range(self.getNumTitrationStates(titration_group_index)) for titration_group_index in titration_group_indices ]))
+        initial_index = candidate_states.index(tuple([ initial_titration_states[titration_group_index] for titration_group_index in titration_group_indices ]))
+
+        # Metropolized Gibbs has no other state to propose if there is only one, so this counts as a rejected self-transition.
+        if (self.proposal_scheme == 'metropolized-gibbs') and (len(candidate_states) == 1):
+            self.nattempted += 1
+            self.work_history.append( (initial_titration_states, list(initial_titration_states), 0.0) )
+            return
+
+        log_P = self._computeLogProbabilities(context, epoch, titration_group_indices, candidate_states)
+
+        # Draw the new joint state.
+        if self.proposal_scheme == 'gibbs':
+            proposal = numpy.exp(log_P - log_P.max())
+        else:
+            # Normalize among the other states, so the proposal is accurate even if the current state dominates.
+            proposal = numpy.exp(log_P - numpy.delete(log_P, initial_index).max())
+            proposal[initial_index] = 0.0
+        final_index = min(int(numpy.searchsorted(numpy.cumsum(proposal), random.random() * proposal.sum())), len(candidate_states)-1)
+
+        self.nattempted += 1
+        log_P_accept = 0.0
+        if self.proposal_scheme == 'metropolized-gibbs':
+            # log (1 - p_i) - log (1 - p_j), with 1 - p_k the total probability of all states other than k.
+            log_P_accept = _logsumexp(numpy.delete(log_P, initial_index)) - _logsumexp(numpy.delete(log_P, final_index))
+        accept = (log_P_accept > 0.0) or (random.random() < math.exp(log_P_accept))
+
+        final_titration_states = list(initial_titration_states)
+        for (titration_group_index, titration_state_index) in zip(titration_group_indices, candidate_states[final_index]):
+            final_titration_states[titration_group_index] = titration_state_index
+        work = - (log_P[final_index] - log_P[initial_index])
+        self.work_history.append( (initial_titration_states, final_titration_states, work) )
+        if self.debug:
+            print "   %s proposal: %s -> %s | log acceptance %f" % (self.proposal_scheme, str(initial_titration_states), str(final_titration_states), log_P_accept)
+
+        if not accept:
+            return
+        self.naccepted += 1
+        if final_index == initial_index:
+            return
+        self.beginTitrationTrial()
+        for (titration_group_index, titration_state_index) in zip(titration_group_indices, candidate_states[final_index]):
+            self.setTitrationState(titration_group_index, titration_state_index)
+        self.acceptTitrationTrial()
+        if (self._scoring_pool is None) or self._sharesPoolEnergies():
+            self._cached_log_probability = ( (epoch, tuple(self.titrationStates)), log_P[final_index] )
+
+        return
+
+    #=============================================================================================
+    # Parallel scoring of candidate states.
+    #=============================================================================================
+
+    def startScoringPool(self, nworkers, platform_name='CPU', platform_properties=None, asynchronous=False):
+        """
+        Start worker processes that score the candidate states of Gibbs proposals concurrently.
+
+        Each worker holds its own Context of a copy of the System, and receives the positions through shared memory once per configuration.
+        The candidates of each proposal, including the current states, are divided among the workers, and the new states are selected
+        from the resulting log probabilities with the Gibbs or Metropolized Gibbs rule of self.proposal_scheme, preserving detailed balance.
+
+        ARGUMENTS
+
+        nworkers (int) - the number of worker processes
+
+        OPTIONAL ARGUMENTS
+
+        platform_name (string) - name of the platform of the worker Contexts (default: 'CPU')
+        platform_properties (dict) - platform properties of the worker Contexts; if None, CPU Contexts use a single thread each (default: None)
+        asynchronous (boolean) - True if the pool is started to run asynchronous updates (see beginAsynchronousUpdate()) (default: False)
+
+        NOTE
+
+        Workers are forked from this process, so they must be started after all titratable groups and states have been defined, and
+        restarted if the System is modified otherwise.  The pool scores the proposals of the 'gibbs' and 'metropolized-gibbs' proposal
+        schemes and the joint states enumerated by update(), and runs asynchronous updates; an exception is raised if neither the
+        proposal scheme nor enumeration would use it and asynchronous is False.
+
+        Energies scored by the pool are stored in the energy cache, unless analytic energies are in use (see _sharesPoolEnergies()).
+
+        GPU platforms do not survive a fork: once this process has created a CUDA or OpenCL Context, only CPU workers are safe.  To use
+        GPU workers, start the pool before creating any Context in this process.
+
+        """
+        if (self.proposal_scheme not in ['gibbs', 'metropolized-gibbs']) and not self.enumeration_threshold and not asynchronous:
+            raise Exception("The '%s' proposal scheme does not use a scoring pool; start it with asynchronous=True to run asynchronous updates." % self.proposal_scheme)
+        if self._scoring_pool is not None:
+            self.stopScoringPool()
+        if not self._compiled:
+            self._compileTitrationTables()
+        if (platform_properties is None) and (platform_name == 'CPU'):
+            platform_properties = { 'Threads' : '1' }
+
+        natoms = self.system.getNumParticles()
+        self._scoring_positions = multiprocessing.Array('d', 3*natoms + 9, lock=False)
+        self._scoring_epoch = None
+        self._scoring_pool = multiprocessing.Pool(nworkers, _initializeScoringWorker, (self, self._scoring_positions, platform_name, platform_properties))
+        self._scoring_nworkers = nworkers
+        self._scoring_layout = [ group['nstates'] for group in self.titrationGroups ]
+
+        return
+
+    def stopScoringPool(self):
+        """
+        Stop the worker processes started by startScoringPool(), if any.
+
+        """
+        if self._scoring_pool is None:
+            return
+
+        self._scoring_pool.terminate()
+        self._scoring_pool.join()
+        self._scoring_pool = None
+        self._scoring_positions = None
+
+        return
+
+    def _checkScoringLayout(self):
+        """
+        Raise an exception if groups or states have been added since the workers of the scoring pool were forked.
+
+        """
+        if [ group['nstates'] for group in self.titrationGroups ] != self._scoring_layout:
+            raise Exception("Titratable groups or states were added after the scoring pool was started; restart it with startScoringPool().")
+
+        return
+
+    def _scoreWithPool(self, context, epoch, titration_group_indices, candidate_states):
+        """
+        Compute the log probabilities of candidate joint states of the specified groups with the scoring pool.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context, from which the positions are shared with the workers
+        epoch (tuple) - the configuration epoch, as returned by _getConfigurationEpoch()
+        titration_group_indices (list of int) - the groups whose states are varied
+        candidate_states (list of tuple of int) - joint states of these groups
+
+        RETURNS
+
+        log_P (numpy array of shape [len(candidate_states)]) - the log probability of each candidate
+
+        """
+        self._checkScoringLayout()
+        if self._reference_conditions != (self.pH, _strip_units(self.temperature)):
+            self._updateReferenceWeights()
+
+        # Share the positions once per configuration.
+        periodic = hasattr(self.system, 'usesPeriodicBoundaryConditions') and self.system.usesPeriodicBoundaryConditions()
+        if (self._scoring_epoch is None) or (self._scoring_epoch != epoch):
+            state = context.getState(getPositions=True)
+            natoms = self.system.getNumParticles()
+            shared = numpy.frombuffer(self._scoring_positions, numpy.float64)
+            shared[:3*natoms] = numpy.array(state.getPositions(asNumpy=True).value_in_unit(units.nanometers), numpy.float64).flat
+            if periodic:
+                shared[3*natoms:] = numpy.array([ [ _strip_units(component) for component in vector ] for vector in state.getPeriodicBoxVectors() ], numpy.float64).flat
+            self._scoring_epoch = epoch
+            self._scoring_version += 1
+
+        # Divide the candidates among the workers.
+        titration_states_list = list()
+        log_reference_sums = numpy.zeros([len(candidate_states)], numpy.float64)
+        for (candidate_index, states) in enumerate(candidate_states):
+            titration_states = list(self.titrationStates)
+            log_reference_sums[candidate_index] = self._log_reference_sum
+            for (titration_group_index, titration_state_index) in zip(titration_group_indices, states):
+                log_reference_weights = self.titrationGroups[titration_group_index]['log_reference_weights']
+                log_reference_sums[candidate_index] += log_reference_weights[titration_state_index] - log_reference_weights[titration_states[titration_group_index]]
+                titration_states[titration_group_index] = titration_state_index
+            titration_states_list.append(titration_states)
+        # Only score the candidates whose energies are not cached.
+        energies = numpy.zeros([len(candidate_states)], numpy.float64)
+        keys = None
+        missing = range(len(candidate_states))
+        if (self._energy_cache is not None) and self._sharesPoolEnergies():
+            keys = [ numpy.array(titration_states, self._state_key_dtype).tostring() for titration_states in titration_states_list ]
+            missing = list()
+            for (candidate_index, key) in enumerate(keys):
+                energy = self._energy_cache.get(epoch, key)
+                if energy is None:
+                    missing.append(candidate_index)
+                else:
+                    energies[candidate_index] = energy
+
+        if len(missing) > 0:
+            chunk_size = int(math.ceil(float(len(missing)) / float(self._scoring_nworkers)))
+            tasks = [ (self._scoring_version, periodic, [ titration_states_list[candidate_index] for candidate_index in missing[start:start+chunk_size] ]) for start in range(0, len(missing), chunk_size) ]
+            scored_energies = [ energy for chunk in self._scoring_pool.map(_scoreTitrationStates, tasks) for energy in chunk ]
+            for (candidate_index, energy) in zip(missing, scored_energies):
+                energies[candidate_index] = energy
+                if keys is not None:
+                    self._energy_cache.set(epoch, keys[candidate_index], energy)
+
+        return - self._beta * energies + log_reference_sums
+
+    def _sharesPoolEnergies(self):
+        """
+        Return True if energies scored by the pool can be mixed with those evaluated in this process.
+
+        NOTE
+
+        Workers evaluate the full energies of the titration forces in their Contexts, which agree with those of update() up to round-off
+        unless analytic energies, relative to a reference fixed for each configuration, are in use.
+
+        """
+        return len(self._analytic_energies) == 0
+
+    def beginAsynchronousUpdate(self, context):
+        """
+        Start a titration update on a snapshot of the current configuration in the scoring pool, and return without waiting for it.
+
+        Dynamics can be run on the Context, in the current titration states, while a worker samples new titration states at the snapshot
+        with the same moves as update().  This is speculative execution of the sequence of a titration update followed by dynamics:
+        if the update leaves the states unchanged, the dynamics run in the meantime is kept; otherwise, endAsynchronousUpdate() returns
+        the Context to the snapshot in the new states, and the dynamics must be run again.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context, whose positions, velocities, and box vectors are snapshotted
+
+        EXAMPLES
+
+        A driver overlapping titration with dynamics would run
+
+            mc_titration.startScoringPool(1, asynchronous=True)
+            for iteration in range(niterations):
+                mc_titration.beginAsynchronousUpdate(context)
+                integrator.step(nsteps)
+                if not mc_titration.endAsynchronousUpdate(context):
+                    integrator.step(nsteps)
+
+        NOTE
+
+        The titration states of the Context must not be changed until endAsynchronousUpdate() has been called.
+
+        The worker runs the single- and multi-group trials of update() with the 'uniform', 'gibbs', and 'metropolized-gibbs' proposal
+        schemes, tautomer moves, exact enumeration, weighted or neighbor-based group selection, and site-interaction moves, with the
+        settings of this driver at the time of the call; its statistics, including the counts used to learn selection weights, are
+        added to those of this driver by endAsynchronousUpdate().  NCMC moves propagate the configuration, which the worker cannot
+        return, so an exception is raised if they are enabled.  Groups and states must not be added after the pool was started.
+
+        """
+        if self._scoring_pool is None:
+            raise Exception("Asynchronous updates require a scoring pool; call startScoringPool() first.")
+        if self._asynchronous_update is not None:
+            raise Exception("An asynchronous update is already in progress.")
+        if self.ncmc_steps or self._ncmc_protocol or (self._ncmc_tuning is not None):
+            raise Exception("Asynchronous updates cannot run NCMC moves, which propagate the configuration of the worker.")
+        self._checkScoringLayout()
+
+        state = context.getState(getPositions=True, getVelocities=True)
+        positions = numpy.array(state.getPositions(asNumpy=True).value_in_unit(units.nanometers), numpy.float64)
+        box_vectors = None
+        if hasattr(self.system, 'usesPeriodicBoundaryConditions') and self.system.usesPeriodicBoundaryConditions():
+            box_vectors = [ [ _strip_units(component) for component in vector ] for vector in state.getPeriodicBoxVectors() ]
+
+        step_count = None
+        if hasattr(context, 'getStepCount'):
+            step_count = context.getStepCount()
+
+        titration_states = list(self.titrationStates)
+        task = (positions, box_vectors, titration_states, self._getAsynchronousSettings(), self._selection_statistics is not None)
+        self._asynchronous_update = (titration_states, state, step_count, self._scoring_pool.apply_async(_sampleTitrationStates, (task,)))
+
+        return
+
+    def endAsynchronousUpdate(self, context):
+        """
+        Wait for the update started by beginAsynchronousUpdate(), and apply its states.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context to update
+
+        RETURNS
+
+        kept (boolean) - True if the states were unchanged and the dynamics run since beginAsynchronousUpdate() is kept; False if the
+                         Context has been returned to the snapshot in the new states, including its time and step count, so that the
+                         dynamics must be run again
+
+        NOTE
+
+        The update at the snapshot is an ordinary titration update, so the sequence of the update and the dynamics that follows it
+        preserves the equilibrium distribution exactly.  The dynamics is only discarded when the states change, which is independent
+        of the dynamics itself.
+
+        """
+        if self._asynchronous_update is None:
+            raise Exception("No asynchronous update is in progress.")
+
+        (initial_titration_states, snapshot, step_count, result) = self._asynchronous_update
+        self._asynchronous_update = None
+        (final_titration_states, statistics) = result.get()
+        if self.titrationStates != initial_titration_states:
+            raise Exception("Titration states were changed during an asynchronous update.")
+        self._mergeAsynchronousStatistics(statistics)
+
+        if final_titration_states == initial_titration_states:
+            return True
+
+        # Discard the dynamics, and continue from the snapshot in the new states.
+        box_vectors = snapshot.getPeriodicBoxVectors()
+        if box_vectors is not None:
+            context.setPeriodicBoxVectors(*box_vectors)
+        context.setPositions(snapshot.getPositions())
+        context.setVelocities(snapshot.getVelocities())
+        context.setTime(snapshot.getTime())
+        if step_count is not None:
+            context.setStepCount(step_count)
+        self.invalidateCache()
+        for (titration_group_index, titration_state_index) in enumerate(final_titration_states):
+            if titration_state_index != initial_titration_states[titration_group_index]:
+                self.setTitrationState(titration_group_index, titration_state_index)
+        self._updateParametersInContext(context)
+
+        return False
+
+    def _getAsynchronousSettings(self):
+        """
+        Return the settings of the moves of update() that are sent to the worker running an asynchronous update.
+
+        RETURNS
+
+        settings (dict) - the value of each attribute, keyed by its name
+
+        """
+        names = [ 'pH', 'temperature', 'nattempts_per_update', 'proposal_scheme', 'tautomer_move_probability', 'enumeration_threshold',
+                  'simultaneous_proposal_probability', 'proposal_size_probabilities', 'neighbor_cutoff', 'site_interaction_sweeps', '_selection_weights' ]
+
+        return dict([ (name, getattr(self, name)) for name in names ])
+
+    def _mergeAsynchronousStatistics(self, statistics):
+        """
+        Add the statistics accumulated by a worker during an asynchronous update to those of this driver.
+
+        ARGUMENTS
+
+        statistics (dict) - the statistics returned by the worker (see _sampleTitrationStates())
+
+        """
+        self.nattempted += statistics['nattempted']
+        self.naccepted += statistics['naccepted']
+        self.work_history.extend(statistics['work_history'])
+
+        if statistics['nenumerated']:
+            # Groups or states may have been added since statistics were last reset.
+            if [ len(population_sum) for population_sum in self.population_sums ] != [ group['nstates'] for group in self.titrationGroups ]:
+                self.nenumerated = 0
+                self.population_sums = [ numpy.zeros([group['nstates']], numpy.float64) for group in self.titrationGroups ]
+            self.nenumerated += statistics['nenumerated']
+            for (population_sum, worker_population_sum) in zip(self.population_sums, statistics['population_sums']):
+                population_sum += worker_population_sum
+
+        if (self._selection_statistics is not None) and (statistics['selection_statistics'] is not None):
+            self._selection_statistics['nattempted'] += statistics['selection_statistics']['nattempted']
+            self._selection_statistics['nchanged'] += statistics['selection_statistics']['nchanged']
+
+        return
+
+    #=============================================================================================
+    # Site-interaction model.
+    #=============================================================================================
+
+    def _getSiteInteractionModel(self, context, epoch):
+        """
+        Return the pairwise site-interaction model of the log probability for the current configuration, computing it if needed.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context
+        epoch (tuple) - the configuration epoch, as returned by _getConfigurationEpoch()
+
+        RETURNS
+
+        model (dict) - the model, with
+            model['columns'] (list of int) - index of the first column of each group; column columns[g]+s stands for group g in state s
+            model['log_weights'] (numpy array of shape [ncolumns]) - log probability contribution of each group state on its own
+            model['couplings'] (numpy array of shape [ncolumns, ncolumns]) - log probability contribution of each pair of states of different groups
+
+        NOTE
+
+        The model is exact for energies that are quadratic forms in the charges (Coulomb without cutoff, GB with fixed Born radii), in which case
+        log P(s) = sum_g log_weights[s_g] + 1/2 sum_{g != h} couplings[s_g, s_h] up to a constant, and approximate otherwise.  It depends
+        on the configuration only, not on the current titration states, as required for the proposals of site-interaction moves.
+
+        """
+        key = (epoch, self._reference_conditions)
+        if (self._site_interaction_model is not None) and (self._site_interaction_model['key'] == key):
+            return self._site_interaction_model
+        if self._site_interaction_energies is None:
+            self._buildSiteInteractionEnergies()
+
+        # Charges of each titratable atom (rows) in each group state (columns).
+        columns = list()
+        ncolumns = 0
+        for group in self.titrationGroups:
+            columns.append(ncolumns)
+            ncolumns += group['nstates']
+        natoms = sum([ len(group['atom_indices']) for group in self.titrationGroups ])
+        charges = numpy.zeros([natoms, ncolumns], numpy.float64)
+        for (group, column) in zip(self.titrationGroups, columns):
+            offset = group['analytic_offset']
+            charges[offset:offset+len(group['atom_indices']),column:column+group['nstates']] = group['charges'].T
+
+        # The evaluators are set up with charges that do not depend on the current states, so that the model is a function of the
+        # configuration alone: each atom gets its charge of largest magnitude over all states of its group.  This matters for GB
+        # models that exclude uncharged atoms from the Born radii, which are computed from these charges.
+        reference_charges = charges[numpy.arange(natoms),numpy.abs(charges).argmax(axis=1)]
+
+        # Project the quadratic forms onto group states.
+        positions = self._getPositions(context)
+        energies = numpy.zeros([ncolumns], numpy.float64)
+        interactions = numpy.zeros([ncolumns, ncolumns], numpy.float64)
+        for analytic_energy in self._site_interaction_energies:
+            analytic_energy.setConfiguration(positions, reference_charges)
+            # Potentials due to non-titratable atoms only.
+            fixed_potentials = analytic_energy.potentials - analytic_energy.kernel.dot(reference_charges)
+            energies += charges.T.dot(fixed_potentials)
+            interactions += charges.T.dot(analytic_energy.kernel.dot(charges))
+        energies += 0.5 * numpy.diag(interactions)
+        for (group, column) in zip(self.titrationGroups, columns):
+            interactions[column:column+group['nstates'],column:column+group['nstates']] = 0.0
+
+        model = dict()
+        model['key'] = key
+        model['columns'] = columns
+        model['log_weights'] = - self._beta * energies + numpy.concatenate([ group['log_reference_weights'] for group in self.titrationGroups ])
+        model['couplings'] = - self._beta * interactions
+        self._site_interaction_model = model
+
+        return model
+
+    def assignMostProbableTitrationStates(self, context, nsweeps=100):
+        """
+        Set the titration states to an estimate of the most probable states at the current configuration and pH, to shorten equilibration.
+
+        Starting from the most probable state of each group on its own, each group in turn is set to its most probable state given the
+        states of all others under the site-interaction model (see _getSiteInteractionModel()), until no state changes.  The model combines
+        the reference energies of the states with their electrostatic interactions in the current configuration.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context, whose parameters are updated to the new titration states
+
+        OPTIONAL ARGUMENTS
+
+        nsweeps (int) - maximum number of sweeps over all groups (default: 100)
+
+        RETURNS
+
+        titration_states (list of int) - the assigned titration states
+
+        NOTE
+
+        This is intended for minimized starting structures, before equilibration; the result is a local maximum of the approximate model.
+
+        """
+        if not self._compiled:
+            self._compileTitrationTables()
+        if self._reference_conditions != (self.pH, _strip_units(self.temperature)):
+            self._updateReferenceWeights()
+
+        model = self._getSiteInteractionModel(context, self._getConfigurationEpoch(context))
+        columns = model['columns']
+        couplings = model['couplings']
+        log_weights = model['log_weights']
+
+        titration_states = [ int(log_weights[column:column+group['nstates']].argmax()) for (group, column) in zip(self.titrationGroups, columns) ]
+        fields = couplings[:,[ column + state_index for (column, state_index) in zip(columns, titration_states) ]].sum(axis=1)
+        for sweep in range(nsweeps):
+            changed = False
+            for (group_index, (group, column)) in enumerate(zip(self.titrationGroups, columns)):
+                log_P = log_weights[column:column+group['nstates']] + fields[column:column+group['nstates']]
+                state_index = int(log_P.argmax())
+                if state_index != titration_states[group_index]:
+                    fields += couplings[:,column+state_index] - couplings[:,column+titration_states[group_index]]
+                    titration_states[group_index] = state_index
+                    changed = True
+            if not changed:
+                break
+
+        for (titration_group_index, titration_state_index) in enumerate(titration_states):
+            self.setTitrationState(titration_group_index, titration_state_index)
+        self._updateParametersInContext(context)
+
+        return titration_states
+
+    def _getSiteInteractionLogProbability(self, model, titration_states):
+        """
+        Return the log probability of the given titration states under the site-interaction model, up to a constant.
+
+        """
+        selected = numpy.array([ column + state_index for (column, state_index) in zip(model['columns'], titration_states) ], numpy.int64)
+        return model['log_weights'][selected].sum() + 0.5 * model['couplings'][numpy.ix_(selected,selected)].sum()
+
+    def _sampleSiteInteractionModel(self, model, titration_states, nsweeps):
+        """
+        Propose new titration states by heat-bath sampling of the site-interaction model.
+
+        Each step draws a group uniformly at random and a new state for it from its conditional distribution under the model.
+        This random-scan Gibbs sampler satisfies detailed balance with respect to the model.
+
+        ARGUMENTS
+
+        model (dict) - the model, as returned by _getSiteInteractionModel()
+        titration_states (list of int) - initial titration state of each group
+        nsweeps (int) - number of sweeps, each consisting of as many steps as there are groups
+
+        RETURNS
+
+        titration_states (list of int) - proposed titration state of each group
+
+        """
+        titration_states = list(titration_states)
+        columns = model['columns']
+        couplings = model['couplings']
+        log_weights = model['log_weights']
+        ngroups = len(titration_states)
+
+        # Coupling of each group state to the current states of all other groups (intra-group couplings are zero).
+        fields = couplings[:,[ column + state_index for (column, state_index) in zip(columns, titration_states) ]].sum(axis=1)
+
+        for step in range(nsweeps * ngroups):
+            group_index = random.randrange(ngroups)
+            column = columns[group_index]
+            nstates = self.titrationGroups[group_index]['nstates']
+            log_P = log_weights[column:column+nstates] + fields[column:column+nstates]
+            P = numpy.exp(log_P - log_P.max())
+            state_index = min(int(numpy.searchsorted(numpy.cumsum(P), random.random() * P.sum())), nstates-1)
+            if state_index != titration_states[group_index]:
+                fields += couplings[:,column+state_index] - couplings[:,column+titration_states[group_index]]
+                titration_states[group_index] = state_index
+
+        return titration_states
+
+    def _attemptSiteInteractionMove(self, context, epoch):
+        """
+        Attempt a composite titration move generated by sampling the site-interaction model, with delayed acceptance.
+
+        The proposal from initial states s to final states s' is accepted with probability
+
+        min(1, [P(s') / P~(s')] / [P(s) / P~(s)])
+
+        where P is the true and P~ the site-interaction model probability, which preserves detailed balance with respect to P.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context
+        epoch (tuple) - the configuration epoch, as returned by _getConfigurationEpoch()
+
+        """
+        log_P_initial = self._getCurrentLogProbability(context, epoch)
+        model = self._getSiteInteractionModel(context, epoch)
+
+        initial_titration_states = list(self.titrationStates)
+        final_titration_states = self._sampleSiteInteractionModel(model, initial_titration_states, self.site_interaction_sweeps)
+        self.nattempted += 1
+        if final_titration_states == initial_titration_states:
+            self.naccepted += 1
+            return
+
+        self.beginTitrationTrial()
+        for (titration_group_index, titration_state_index) in enumerate(final_titration_states):
+            if titration_state_index != initial_titration_states[titration_group_index]:
+                self.setTitrationState(titration_group_index, titration_state_index)
+        log_P_final = self._compute_log_probability(context, epoch)
+
+        work = - (log_P_final - log_P_initial)
+        self.work_history.append( (initial_titration_states, final_titration_states, work) )
+
+        log_P_accept = (log_P_final - self._getSiteInteractionLogProbability(model, final_titration_states)) - (log_P_initial - self._getSiteInteractionLogProbability(model, initial_titration_states))
+        if self.debug:
+            print "   site-interaction move: %s -> %s | log acceptance %f" % (str(initial_titration_states), str(final_titration_states), log_P_accept)
+        if (log_P_accept > 0.0) or (random.random() < math.exp(log_P_accept)):
+            self.naccepted += 1
+            self.acceptTitrationTrial()
+            self._cached_log_probability = ( (epoch, tuple(self.titrationStates)), log_P_final )
+        else:
+            self.rejectTitrationTrial()
+
+        return
+
+    #=============================================================================================
+    # Titration trials.
+    #=============================================================================================
+
+    def beginTitrationTrial(self):
+        """
+        Begin a titration trial, in which the states of any number of groups may be changed and pushed to the Context at once.
+
+        NOTE
+
+        Within a trial, setTitrationState() should be called without a Context to stage state changes for any number of groups.
+        commitTitrationTrial() then pushes all staged changes with a single updateParametersInContext call per force,
+        after which the trial is closed with acceptTitrationTrial() or rejectTitrationTrial().
+
+        """
+        if self._trial is not None:
+            raise Exception("A titration trial is already in progress.")
+
+        trial = dict()
+        trial['initial_titration_states'] = list(self.titrationStates) # deep copy
+        trial['initial_parameter_states'] = list(self._parameterStates) # deep copy
+        trial['initial_log_reference_sum'] = self._log_reference_sum
+        trial['initial_forces_modified'] = list(self._forces_modified) # deep copy
+        trial['forces_pushed'] = [ False for force in self.forces_to_update ]
+        trial['snapshot'] = list() # parameters overwritten during this trial, in order
+        self._trial = trial
+
+        return
+
+    def commitTitrationTrial(self, context):
+        """
+        Push all titration state changes staged in the current trial to the Context.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context to update
+
+        NOTE
+
+        Forces whose energies are evaluated analytically are not pushed, as the Context does not need them to score the trial.
+
+        """
+        if self._trial is None:
+            raise Exception("No titration trial is in progress.")
+
+        self._updateParametersInContext(context, self._getContextEnergyGroups())
+
+        return
+
+    def acceptTitrationTrial(self):
+        """
+        Accept the titration state changes of the current trial and close it.
+
+        """
+        if self._trial is None:
+            raise Exception("No titration trial is in progress.")
+
+        self._trial = None
+        self._updateAnalyticStates()
+
+        return
+
+    def rejectTitrationTrial(self, context=None):
+        """
+        Restore the titration states and parameters from before the current trial and close it.
+
+        OPTIONAL ARGUMENTS
+
+        context (simtk.openmm.Context) - if provided, the restored parameters are pushed to this Context (default: None)
+
+        NOTE
+
+        Parameters overwritten during the trial are restored from the snapshot recorded when they were written,
+        without querying the forces.  Forces whose trial parameters were never pushed to the Context are left
+        unmodified, so they need no upload.  If no Context is provided, the restored parameters reach the Context
+        when it is next synchronized, which happens before any energy is evaluated in it.
+
+        """
+        if self._trial is None:
+            raise Exception("No titration trial is in progress.")
+
+        trial = self._trial
+        self._trial = None
+
+        # Restore overwritten parameters in reverse order.
+        for (kind, force_index, index, parameters) in reversed(trial['snapshot']):
+            if kind == 'parameter':
+                self._setGlobalParameter(index, parameters)
+                continue
+            force = self.forces_to_update[force_index]
+            if kind == 'particle':
+                self._setParticleParameters(force, index, parameters)
+            else:
+                force.setExceptionParameters(index, *parameters)
+                self._exceptionChargeProds[index] = parameters[2]
+
+        self.titrationStates = trial['initial_titration_states']
+        self._parameterStates = trial['initial_parameter_states']
+        self._log_reference_sum = trial['initial_log_reference_sum']
+
+        # The Context only holds stale parameters for forces that were pushed during the trial.
+        for force_index in range(len(self.forces_to_update)):
+            if trial['forces_pushed'][force_index]:
+                self._forces_modified[force_index] = True
+            else:
+                self._forces_modified[force_index] = trial['initial_forces_modified'][force_index]
+
+        if context:
+            self._updateParametersInContext(context)
+
+        return
+
+    def update(self, context, nattempts=None):
+        """
+        Perform a Monte Carlo update of the titration state.
 
         ARGUMENTS
 
         context (simtk.openmm.Context) - the context to update
 
+        OPTIONAL ARGUMENTS
+
+        nattempts (int) - the number of titration attempts of this update; if None, self.nattempts_per_update (default: None)
+
         NOTE
 
         The titration state actually present in the given context is not checked; it is assumed the MonteCarloTitration internal state is correct.
 
+        Forces whose energies are evaluated analytically (see analytic_coulomb and analytic_gb) are only pushed once, on return.
+        On return, the Context holds parameters consistent with the final titration states.
+
+        The log probability of the current state is cached between trials, and between calls as long as no dynamics has been run.
+
+        If site_interaction_sweeps is set, the single-group trials are followed by one composite move over all groups (see _attemptSiteInteractionMove()).
+
+        If the joint state space is no larger than enumeration_threshold, all joint states are enumerated instead (see _updateByEnumeration()).
+
         """
 
+        # Determine whether the configuration has changed since the log probability was last cached.
+        epoch = self._getConfigurationEpoch(context)
+
+        # Small state spaces are enumerated exactly instead.
+        if self.enumeration_threshold and (self._getNumJointStates() <= self.enumeration_threshold):
+            self._updateByEnumeration(context, epoch)
+            self._updateParametersInContext(context)
+            return
+
         # Perform a number of protonation state update trials.
-        for attempt in range(self.nattempts_per_update):
+        if nattempts is None:
+            nattempts = self.nattempts_per_update
+        for attempt in range(nattempts):
+            # Attempt an intra-class tautomer move instead, if requested.
+            if self.tautomer_move_probability and (random.random() < self.tautomer_move_probability):
+                self._attemptTautomerMove(context, epoch)
+                continue
+
             # Choose how many titratable groups to simultaneously attempt to update.
-            ndraw = 1
-            if (self.getNumTitratableGroups() > 1) and (random.random() < self.simultaneous_proposal_probability):
-                ndraw = 2
-                
-            # Choose groups to update.
-            # TODO: Use Gibbs or Metropolized Gibbs sampling?  Or always accept proposals to same state?
-            titration_group_indices = random.sample(range(self.getNumTitratableGroups()), ndraw)
-            
-            # Compute initial probability of this protonation state.
-            log_P_initial = self._compute_log_probability(context)
-
-            if self.debug:
-                state = context.getState(getEnergy=True)
-                initial_potential = state.getPotentialEnergy()
-                print "   initial %s   %12.3f kcal/mol" % (str(self.getTitrationStates()), initial_potential / units.kilocalories_per_mole)
-
-            # Perform update attempt.
-            initial_titration_states = copy.deepcopy(self.titrationStates) # deep copy
-            for titration_group_index in titration_group_indices:
-                # Choose a titration state with uniform probability (even if it is the same as the current state).
-                titration_state_index = random.choice(range(self.getNumTitrationStates(titration_group_index)))
-                self.setTitrationState(titration_group_index, titration_state_index, context)
-            final_titration_states = copy.deepcopy(self.titrationStates) # deep copy
-
-            # TODO: Always accept self transitions, or avoid them altogether.
-            
-            # Compute final probability of this protonation state.
-            log_P_final = self._compute_log_probability(context)
-            
-            # Compute work and store work history.
-            work = - (log_P_final - log_P_initial)
-            self.work_history.append( (initial_titration_states, final_titration_states, work) )
-
-            # Accept or reject with Metropolis criteria.
-            log_P_accept = -work
-            if self.debug:
-                print "   proposed log probability change: %f -> %f | work %f" % (log_P_initial, log_P_final, work)
-                print ""
-            self.nattempted += 1
-            if (log_P_accept > 0.0) or (random.random() < math.exp(log_P_accept)):
-                # Accept.
-                self.naccepted += 1
+            ndraw = self._drawProposalSize()
+
+            # Choose groups to update; this may determine the neighbors of the groups for the current configuration.
+            titration_group_indices = self._selectTitrationGroups(context, epoch, ndraw)
+
+            initial_titration_states = list(self.titrationStates)
+            if self.proposal_scheme != 'uniform':
+                self._attemptGibbsMove(context, epoch, titration_group_indices)
             else:
-                # Reject.
-                # Restore titration states.
+                titration_state_indices = list()
+                log_proposal_ratio = 0.0
                 for titration_group_index in titration_group_indices:
-                    self.setTitrationState(titration_group_index, initial_titration_states[titration_group_index], context)
-                # TODO: If using NCMC, restore coordinates.
+                    if self.tautomer_move_probability:
+                        # Propose a state in a different tautomer class.
+                        (titration_state_index, log_ratio) = self._proposeProtonationState(titration_group_index)
+                        log_proposal_ratio += log_ratio
+                    else:
+                        # Choose a titration state with uniform probability (even if it is the same as the current state).
+                        titration_state_index = random.choice(range(self.getNumTitrationStates(titration_group_index)))
+                    titration_state_indices.append(titration_state_index)
+                self._attemptTitrationTrial(context, epoch, titration_group_indices, titration_state_indices, log_proposal_ratio)
+
+            # NCMC moves run dynamics, which changes the configuration.
+            if self.ncmc_steps or self._ncmc_protocol or (self._ncmc_tuning is not None):
+                epoch = self._getConfigurationEpoch(context)
+
+            # Record how often each selected group changes state, while learning selection weights.
+            if self._selection_statistics is not None:
+                for titration_group_index in titration_group_indices:
+                    self._selection_statistics['nattempted'][titration_group_index] += 1
+                    if self.titrationStates[titration_group_index] != initial_titration_states[titration_group_index]:
+                        self._selection_statistics['nchanged'][titration_group_index] += 1
+
+        # Attempt a composite move over all groups, generated by the site-interaction model.
+        if self.site_interaction_sweeps:
+            self._attemptSiteInteractionMove(context, epoch)
+
+        # Make sure the Context holds the final parameters before dynamics resumes.
+        self._updateParametersInContext(context)
         
         return
 
+    #=============================================================================================
+    # Exact enumeration.
+    #=============================================================================================
+
+    def _getNumJointStates(self):
+        """
+        Return the number of joint titration states of all groups.
+
+        """
+        njoint = 1
+        for group in self.titrationGroups:
+            njoint *= group['nstates']
+
+        return njoint
+
+    def _updateByEnumeration(self, context, epoch):
+        """
+        Enumerate all joint titration states in the current configuration, accumulate their exact populations, and draw new states from them.
+
+        The conditional population of each state of each group is added to self.population_sums, whose average over updates
+        (see getRaoBlackwellizedPopulations()) estimates the equilibrium populations with lower variance than counting visited states.
+        Drawing the new states from the exact conditional distribution is a Gibbs move, which is always accepted.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context
+        epoch (tuple) - the configuration epoch, as returned by _getConfigurationEpoch()
+
+        """
+        titration_group_indices = range(self.getNumTitratableGroups())
+        candidate_states = list(itertools.product(*[ range(self.getNumTitrationStates(titration_group_index)) for titration_group_index in titration_group_indices ]))
+        initial_titration_states = list(self.titrationStates)
+        initial_index = candidate_states.index(tuple(initial_titration_states))
+
+        log_P = self._computeLogProbabilities(context, epoch, titration_group_indices, candidate_states)
+        populations = numpy.exp(log_P - _logsumexp(log_P))
+
+        # Groups or states may have been added since statistics were last reset.
+        if [ len(population_sum) for population_sum in self.population_sums ] != [ group['nstates'] for group in self.titrationGroups ]:
+            self.nenumerated = 0
+            self.population_sums = [ numpy.zeros([group['nstates']], numpy.float64) for group in self.titrationGroups ]
+
+        # Accumulate marginal populations of each group.
+        states = numpy.array(candidate_states, numpy.int64)
+        for titration_group_index in titration_group_indices:
+            self.population_sums[titration_group_index] += numpy.bincount(states[:,titration_group_index], weights=populations, minlength=self.getNumTitrationStates(titration_group_index))
+        self.nenumerated += 1
+
+        # Draw the new joint state.
+        final_index = min(int(numpy.searchsorted(numpy.cumsum(populations), random.random() * populations.sum())), len(candidate_states)-1)
+        final_titration_states = list(candidate_states[final_index])
+        self.work_history.append( (initial_titration_states, final_titration_states, - (log_P[final_index] - log_P[initial_index])) )
+        self.nattempted += 1
+        self.naccepted += 1
+        if final_index == initial_index:
+            return
+        self.beginTitrationTrial()
+        for (titration_group_index, titration_state_index) in enumerate(final_titration_states):
+            self.setTitrationState(titration_group_index, titration_state_index)
+        self.acceptTitrationTrial()
+        if (self._scoring_pool is None) or self._sharesPoolEnergies():
+            self._cached_log_probability = ( (epoch, tuple(self.titrationStates)), log_P[final_index] )
+
+        return
+
+    def getRaoBlackwellizedPopulations(self):
+        """
+        Return the populations of the states of each group, averaged over the exact conditional populations of all enumerated configurations.
+
+        RETURNS
+
+        populations (list of numpy array) - populations[g][s] is the estimated population of state s of group g, or None if no
+                                            configuration has been enumerated since statistics were last reset
+
+        """
+        if self.nenumerated == 0:
+            return None
+
+        return [ population_sum / self.nenumerated for population_sum in self.population_sums ]
+
+    def _attemptTitrationTrial(self, context, epoch, titration_group_indices, titration_state_indices, log_proposal_ratio=0.0):
+        """
+        Attempt to change the states of the specified groups, accepting or rejecting the change with the Metropolis-Hastings criterion.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context to update
+        epoch (tuple) - the configuration epoch, as returned by _getConfigurationEpoch()
+        titration_group_indices (list of int) - the groups whose states are changed
+        titration_state_indices (list of int) - the proposed state of each of these groups
+
+        OPTIONAL ARGUMENTS
+
+        log_proposal_ratio (float) - log of the ratio of reverse to forward proposal probabilities (default: 0.0)
+
+        RETURNS
+
+        accepted (boolean) - True if the change was accepted
+
+        """
+        ncmc_steps = self._getNCMCSteps(titration_group_indices)
+        if ncmc_steps:
+            return self._attemptNCMCTrial(context, titration_group_indices, titration_state_indices, ncmc_steps, log_proposal_ratio)
+
+        # Compute initial probability of this protonation state, unless already known.
+        log_P_initial = self._getCurrentLogProbability(context, epoch)
+
+        if self.debug:
+            state = context.getState(getEnergy=True)
+            initial_potential = state.getPotentialEnergy()
+            print "   initial %s   %12.3f kcal/mol" % (str(self.getTitrationStates()), initial_potential / units.kilocalories_per_mole)
+
+        # Perform update attempt; all changes are pushed to the Context at once when the final energy is evaluated, unless it is cached.
+        initial_titration_states = copy.deepcopy(self.titrationStates) # deep copy
+        self.beginTitrationTrial()
+        for (titration_group_index, titration_state_index) in zip(titration_group_indices, titration_state_indices):
+            self.setTitrationState(titration_group_index, titration_state_index)
+        final_titration_states = copy.deepcopy(self.titrationStates) # deep copy
+
+        # TODO: Always accept self transitions, or avoid them altogether.
+
+        # Compute final probability of this protonation state.
+        log_P_final = self._compute_log_probability(context, epoch)
+
+        # Compute work and store work history.
+        work = - (log_P_final - log_P_initial)
+        self.work_history.append( (initial_titration_states, final_titration_states, work) )
+
+        # Accept or reject with Metropolis-Hastings criteria.
+        log_P_accept = -work + log_proposal_ratio
+        if self.debug:
+            print "   proposed log probability change: %f -> %f | work %f" % (log_P_initial, log_P_final, work)
+            print ""
+        self.nattempted += 1
+        if (log_P_accept > 0.0) or (random.random() < math.exp(log_P_accept)):
+            # Accept.
+            self.naccepted += 1
+            self.acceptTitrationTrial()
+            self._cached_log_probability = ( (epoch, tuple(self.titrationStates)), log_P_final )
+            return True
+        else:
+            # Reject.
+            # Restore titration states and parameters.
+            self.rejectTitrationTrial()
+            return False
+
+    def _attemptNCMCTrial(self, context, titration_group_indices, titration_state_indices, ncmc_steps, log_proposal_ratio=0.0):
+        """
+        Attempt to change the states of the specified groups with a nonequilibrium candidate Monte Carlo (NCMC) switching move [3].
+
+        Parameters are switched from the initial to the final states in ncmc_steps perturbation steps, between which the Context
+        integrator is run for self.ncmc_propagation_steps steps.  The move is accepted with probability min(1, exp(-w)), where the reduced
+        protocol work w is the sum of the reduced energy changes of all perturbation steps minus the change in the reference-state terms.
+        On rejection, the initial states, positions, and box vectors are restored, and the initial velocities are restored with their
+        signs reversed, as required for the move to preserve the equilibrium distribution when the propagation is time-reversible.
+        The propagation steps are part of the move rather than of the trajectory, so the time and step count of the Context are
+        restored whether or not the move is accepted.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context to update
+        titration_group_indices (list of int) - the groups whose states are changed
+        titration_state_indices (list of int) - the proposed state of each of these groups
+        ncmc_steps (int) - the number of perturbation steps
+
+        OPTIONAL ARGUMENTS
+
+        log_proposal_ratio (float) - log of the ratio of reverse to forward proposal probabilities (default: 0.0)
+
+        RETURNS
+
+        accepted (boolean) - True if the move was accepted
+
+        NOTE
+
+        The configuration changes during the move, so the caller must determine the configuration epoch anew.
+
+        Only the forces whose parameters differ between the initial and final states of the changing groups are pushed to the Context,
+        once per perturbation step.
+
+        """
+        initial_titration_states = list(self.titrationStates)
+        transitions = [ (titration_group_index, initial_titration_states[titration_group_index], titration_state_index)
+                        for (titration_group_index, titration_state_index) in zip(titration_group_indices, titration_state_indices)
+                        if titration_state_index != initial_titration_states[titration_group_index] ]
+        self.nattempted += 1
+        if len(transitions) == 0:
+            self.work_history.append( (initial_titration_states, list(initial_titration_states), 0.0) )
+            self.naccepted += 1
+            return True
+
+        initial_time = time.time()
+
+        # Store the configuration, to be restored if the move is rejected, and the time and step count, which are always restored.
+        state = context.getState(getPositions=True, getVelocities=True)
+        positions = state.getPositions(asNumpy=True)
+        velocities = state.getVelocities(asNumpy=True)
+        box_vectors = state.getPeriodicBoxVectors()
+        initial_simulation_time = state.getTime()
+        initial_step_count = None
+        if hasattr(context, 'getStepCount'):
+            initial_step_count = context.getStepCount()
+
+        titration_force_group_mask = self._getForceGroupMask(self.titration_force_groups)
+        def get_titration_energy():
+            state = context.getState(getEnergy=True, groups=titration_force_group_mask)
+            return _strip_units(state.getPotentialEnergy())
+
+        # The Context must hold the initial states before the first perturbation.
+        self._updateParametersInContext(context)
+
+        initial_log_reference_sum = self._log_reference_sum
+        integrator = context.getIntegrator()
+        protocol_work = 0.0 # in kJ/mol
+        for step in range(ncmc_steps):
+            if step > 0:
+                integrator.step(self.ncmc_propagation_steps)
+            initial_energy = get_titration_energy()
+            if step < ncmc_steps - 1:
+                self._writeInterpolatedTitrationStates(transitions, float(step+1) / float(ncmc_steps))
+            else:
+                for (titration_group_index, initial_state_index, final_state_index) in transitions:
+                    self.setTitrationState(titration_group_index, final_state_index)
+            self._updateParametersInContext(context, self.titration_force_groups)
+            protocol_work += get_titration_energy() - initial_energy
+        final_titration_states = list(self.titrationStates)
+
+        # Compute reduced work and store work history.
+        work = self._beta * protocol_work - (self._log_reference_sum - initial_log_reference_sum)
+        self.work_history.append( (initial_titration_states, final_titration_states, work) )
+
+        # The configuration has changed, so cached quantities are no longer valid.
+        self.invalidateCache()
+
+        # Accept or reject with Metropolis-Hastings criteria.
+        log_P_accept = -work + log_proposal_ratio
+        if self.debug:
+            print "   NCMC %s -> %s | work %f" % (str(initial_titration_states), str(final_titration_states), work)
+        accepted = (log_P_accept > 0.0) or (random.random() < math.exp(log_P_accept))
+        if accepted:
+            self.naccepted += 1
+        else:
+            # Reject: restore titration states and configuration, reversing the velocities.
+            for (titration_group_index, initial_state_index, final_state_index) in transitions:
+                self.setTitrationState(titration_group_index, initial_state_index)
+            self._updateParametersInContext(context, self.titration_force_groups)
+            if box_vectors is not None:
+                context.setPeriodicBoxVectors(*box_vectors)
+            context.setPositions(positions)
+            context.setVelocities(-velocities)
+        context.setTime(initial_simulation_time)
+        if initial_step_count is not None:
+            context.setStepCount(initial_step_count)
+
+        # Record acceptance and cost for tuning the switching length of each residue type involved.
+        if self._ncmc_tuning is not None:
+            elapsed_time = time.time() - initial_time
+            for residue_type in set([ self.titrationGroups[titration_group_index]['type'] for (titration_group_index, initial_state_index, final_state_index) in transitions ]):
+                statistics = self._ncmc_tuning['statistics'].setdefault(residue_type, dict()).setdefault(ncmc_steps, [0, 0, 0.0])
+                statistics[0] += 1
+                statistics[1] += int(accepted)
+                statistics[2] += elapsed_time
+
+        return accepted
+
+    #=============================================================================================
+    # NCMC switching-length tuning
+    #=============================================================================================
+
+    def _getNCMCSteps(self, titration_group_indices):
+        """
+        Return the number of NCMC perturbation steps for a move of the specified groups, or 0 for an instantaneous move.
+
+        While tuning, a candidate length is drawn at random for each move.  Otherwise, the longest of the lengths chosen for the residue
+        types of the groups is used, with self.ncmc_steps for types without a chosen length.
+
+        """
+        if self._ncmc_tuning is not None:
+            return random.choice(self._ncmc_tuning['candidate_steps'])
+
+        if not self._compiled:
+            self._compileTitrationTables()
+
+        return max([ self._ncmc_protocol.get(self.titrationGroups[titration_group_index]['type'], self.ncmc_steps) for titration_group_index in titration_group_indices ] + [0])
+
+    def beginNCMCTuning(self, candidate_steps):
+        """
+        Start tuning NCMC switching lengths, by recording acceptance and wall-clock cost of subsequent moves for each residue type.
+
+        ARGUMENTS
+
+        candidate_steps (list of int) - the candidate numbers of perturbation steps, one of which is drawn at random for each move
+
+        NOTE
+
+        Since lengths are drawn independently of the titration states, moves while tuning preserve detailed balance.
+
+        """
+        candidate_steps = [ int(ncmc_steps) for ncmc_steps in candidate_steps ]
+        if (len(candidate_steps) == 0) or (min(candidate_steps) < 1):
+            raise Exception("Candidate NCMC switching lengths must be positive.")
+        self._ncmc_tuning = dict()
+        self._ncmc_tuning['candidate_steps'] = candidate_steps
+        self._ncmc_tuning['statistics'] = dict() # statistics[residue_type][ncmc_steps] is [nattempted, naccepted, elapsed seconds]
+
+        return
+
+    def endNCMCTuning(self):
+        """
+        Stop tuning NCMC switching lengths, and choose for each residue type the length that maximizes accepted moves per second.
+
+        RETURNS
+
+        protocol (dict) - for each tuned residue type, a dict with the chosen 'ncmc_steps' and its measured 'acceptance_probability',
+                          'seconds_per_switch' and 'accepted_per_second'
+
+        NOTE
+
+        Acceptance probabilities are estimated as (naccepted + 1) / (nattempted + 2), so that rarely tried lengths are not favored by chance.
+        Residue types never tried while tuning keep their previous length.
+
+        """
+        if self._ncmc_tuning is None:
+            raise Exception("NCMC switching-length tuning has not been started.")
+
+        protocol = dict()
+        for (residue_type, statistics) in self._ncmc_tuning['statistics'].iteritems():
+            for (ncmc_steps, (nattempted, naccepted, elapsed_time)) in statistics.iteritems():
+                acceptance_probability = (naccepted + 1.0) / (nattempted + 2.0)
+                seconds_per_switch = elapsed_time / nattempted
+                accepted_per_second = acceptance_probability / max(seconds_per_switch, sys.float_info.min)
+                if (residue_type not in protocol) or (accepted_per_second > protocol[residue_type]['accepted_per_second']):
+                    protocol[residue_type] = { 'ncmc_steps' : ncmc_steps, 'acceptance_probability' : acceptance_probability,
+                                               'seconds_per_switch' : seconds_per_switch, 'accepted_per_second' : accepted_per_second }
+        self._ncmc_tuning = None
+        for (residue_type, choice) in protocol.iteritems():
+            self._ncmc_protocol[residue_type] = choice['ncmc_steps']
+
+        if self.debug:
+            for residue_type in sorted(protocol):
+                choice = protocol[residue_type]
+                print "   NCMC protocol for %s: %d steps | acceptance %.3f | %.3f s per switch | %.3f accepted per second" % (residue_type, choice['ncmc_steps'], choice['acceptance_probability'], choice['seconds_per_switch'], choice['accepted_per_second'])
+
+        return protocol
+
+    def setNCMCProtocol(self, protocol):
+        """
+        Set the NCMC switching length of each residue type, e.g. to reuse lengths tuned in an earlier simulation.
+
+        ARGUMENTS
+
+        protocol (dict) - number of perturbation steps (0 for instantaneous moves) for each residue type; other types use self.ncmc_steps
+
+        """
+        self._ncmc_protocol = dict( (residue_type, int(ncmc_steps)) for (residue_type, ncmc_steps) in protocol.iteritems() )
+
+        return
+
+    def getNCMCProtocol(self):
+        """
+        Return the NCMC switching length chosen for each residue type, as a dict; other types use self.ncmc_steps.
+
+        """
+        return dict(self._ncmc_protocol)
+
     def getAcceptanceProbability(self): 
         """
         Return the fraction of accepted moves
@@ -680,34 +3575,98 @@ class MonteCarloTitration(object):
         """
         return float(self.naccepted) / float(self.nattempted)
 
-    def _compute_log_probability(self, context):
+    def _compute_log_probability(self, context, epoch=None):
         """
         Compute log probability of current configuration and protonation state.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context
+
+        OPTIONAL ARGUMENTS
+
+        epoch (tuple) - the configuration epoch, as returned by _getConfigurationEpoch(); determined from the Context if needed and None (default: None)
+
+        NOTE
+
+        Only the energies of the force groups containing titration forces are included; all other terms, including
+        the kinetic energy, are unaffected by an instantaneous protonation state change and cancel in the acceptance criterion.
+        Energies evaluated analytically are relative to a reference that is fixed for each configuration.
+
+        If an epoch is given, energies of protonation states already visited in this configuration are taken from the energy cache,
+        in which case no parameters are pushed to the Context.
         
         """
-        temperature = self.temperature 
-        kT = kB * temperature # thermal energy
-        beta = 1.0 / kT # inverse temperature
+        if not self._compiled:
+            self._compileTitrationTables()
+        if self._reference_conditions != (self.pH, _strip_units(self.temperature)):
+            self._updateReferenceWeights()
+
+        total_energy = None
+        if (self._energy_cache is not None) and (epoch is not None):
+            key = numpy.array(self.titrationStates, self._state_key_dtype).tostring()
+            total_energy = self._energy_cache.get(epoch, key)
+
+        if total_energy is None:
+            # Evaluate energies of titration forces in the Context, making sure it holds the current parameters of those forces.
+            total_energy = 0.0
+            force_groups = self._getContextEnergyGroups()
+            if len(force_groups) > 0:
+                self._updateParametersInContext(context, force_groups)
+                state = context.getState(getEnergy=True, groups=self._getForceGroupMask(force_groups))
+                total_energy += _strip_units(state.getPotentialEnergy())
+
+            # Add energies evaluated analytically.
+            if len(self._analytic_energies) > 0:
+                total_energy += self._getAnalyticEnergy(context, epoch)
+
+            if (self._energy_cache is not None) and (epoch is not None):
+                self._energy_cache.set(epoch, key, total_energy)
 
         # Add energetic contribution to log probability.
-        state = context.getState(getEnergy=True)
-        total_energy = state.getPotentialEnergy() + state.getKineticEnergy()
-        log_P = - beta * total_energy
+        log_P = - self._beta * total_energy
 
         # TODO: Add pressure contribution for periodic simulations.
 
-        # Correct for reference states.
-        for (titration_group, titration_state_index) in zip(self.titrationGroups, self.titrationStates):
-            titration_state = titration_group['titration_states'][titration_state_index]
-            pKref = titration_state['pKref']
-            proton_count = titration_state['proton_count']
-            relative_energy = titration_state['relative_energy']
-            print "proton_count = %d | pH = %.1f | pKref = %.1f | %.1f | %.1f | beta*relative_energy = %.1f" % (proton_count, self.pH, pKref, -beta*total_energy , - proton_count * (self.pH - pKref) * math.log(10), +beta*relative_energy)
-            log_P += - proton_count * (self.pH - pKref) * math.log(10) + beta * relative_energy 
+        # Correct for reference states, using the running sum over all groups.
+        log_P += self._log_reference_sum
             
         # Return the log probability.
         return log_P
+
+    def _getCurrentLogProbability(self, context, epoch):
+        """
+        Return the log probability of the current configuration and protonation state, using the cached value if still valid.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context
+        epoch (tuple) - the configuration epoch, as returned by _getConfigurationEpoch()
+
+        RETURNS
+
+        log_P (float) - the log probability
+
+        """
+        key = (epoch, tuple(self.titrationStates))
+        if (self._cached_log_probability is not None) and (self._cached_log_probability[0] == key) and (self._reference_conditions == (self.pH, _strip_units(self.temperature))):
+            return self._cached_log_probability[1]
+
+        log_P = self._compute_log_probability(context, epoch)
+        self._cached_log_probability = (key, log_P)
+
+        return log_P
     
+    def getEnergyCacheStatistics(self):
+        """
+        Return hit and memory statistics of the energy cache as a dict (see TitrationEnergyCache.getStatistics()), or None if it is disabled.
+
+        """
+        if self._energy_cache is None:
+            return None
+
+        return self._energy_cache.getStatistics()
+
     def getNumAttemptsPerUpdate(self):
         """
         Get the number of Monte Carlo titration state change attempts per call to update().
@@ -729,8 +3688,7 @@ class MonteCarloTitration(object):
         """
         self.nattempts_per_update = nattempts
         if nattempts is None:
-            # TODO: Perform enough titration attempts to ensure thorough mixing without taking too long per update.
-            # TODO: Cache already-visited states to avoid recomputing?
+            # One attempt per group; TitrationScheduler chooses its own number of attempts per update to balance mixing against cost.
             self.nattempts_per_update = self.getNumTitratableGroups()
         
 #=============================================================================================
@@ -747,7 +3705,7 @@ if __name__ == "__main__":
     
     # Parameters.
     niterations = 500 # number of dynamics/titration cycles to run
-    nsteps = 500 # number of timesteps of dynamics per iteration
+    titration_time_fraction = 0.1 # fraction of wall-clock time to spend on titration
     temperature = 300.0 * units.kelvin
     timestep = 1.0 * units.femtoseconds
     collision_rate = 9.1 / units.picoseconds
@@ -776,6 +3734,7 @@ if __name__ == "__main__":
     
     # Load the AMBER system.
     import simtk.openmm.app as app
+    from titrationscheduler import TitrationScheduler
     print "Creating AMBER system..."
     inpcrd = app.AmberInpcrdFile(inpcrd_filename)
     prmtop = app.AmberPrmtopFile(prmtop_filename)
@@ -796,26 +3755,23 @@ if __name__ == "__main__":
     print "Minimizing energy..."
     openmm.LocalEnergyMinimizer.minimize(context, 10.0)
     
+    # Start from an estimate of the most probable protonation states at this pH.
+    mc_titration.assignMostProbableTitrationStates(context)
+    
     # Run dynamics.
     state = context.getState(getEnergy=True)
     potential_energy = state.getPotentialEnergy()
     print "Initial protonation states: %s   %12.3f kcal/mol" % (str(mc_titration.getTitrationStates()), potential_energy/units.kilocalories_per_mole)
+    scheduler = TitrationScheduler(mc_titration, titration_time_fraction=titration_time_fraction)
     for iteration in range(niterations):
-        # Run some dynamics.
-        initial_time = time.time()
-        integrator.step(nsteps)
-        state = context.getState(getEnergy=True)
-        final_time = time.time()
-        elapsed_time = final_time - initial_time
-        print "  %.3f s elapsed for %d steps of dynamics" % (elapsed_time, nsteps)
-
-        # Attempt protonation state changes.
+        # Run some dynamics and attempt protonation state changes.
+        nsteps = scheduler.nsteps
+        nattempts = scheduler.nattempts
         initial_time = time.time()
-        mc_titration.update(context)    
-        state = context.getState(getEnergy=True)
+        scheduler.step(context)
         final_time = time.time()
         elapsed_time = final_time - initial_time
-        print "  %.3f s elapsed for %d titration trials" % (elapsed_time, mc_titration.getNumAttemptsPerUpdate())
+        print "  %.3f s elapsed for %d steps of dynamics and %d titration trials (%.1f%% of time titrating)" % (elapsed_time, nsteps, nattempts, 100.0 * scheduler.getTitrationTimeFraction())
 
         # Show titration states.
         state = context.getState(getEnergy=True)
@@ -0,0 +1,75 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Unit conversion and numerical subroutines shared by the constant pH modules.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import math
+
+import numpy
+
+import simtk.unit as units
+
+#=============================================================================================
+# SUBROUTINES
+#=============================================================================================
+
+def _strip_units(quantity):
+    """
+    Return the value of a quantity in the OpenMM MD unit system (nm, ps, kJ/mol, elementary charge) as a unit-free float.
+
+    ARGUMENTS
+
+    quantity (simtk.unit.Quantity or float) - the quantity to convert; plain numbers are assumed to already be in MD units
+
+    RETURNS
+
+    value (float) - the unit-free value
+
+    """
+    if units.is_quantity(quantity):
+        return quantity.value_in_unit_system(units.md_unit_system)
+    return quantity
+
+def _strip_charges(charges):
+    """
+    Convert a list or array of charges to a unit-free float64 array in units of elementary charge.
+
+    ARGUMENTS
+
+    charges (simtk.unit.Quantity wrapping a list, list of simtk.unit.Quantity, or list of float) - the charges to convert;
+        plain numbers are assumed to already be in units of elementary charge
+
+    RETURNS
+
+    charges (numpy.array of float64) - the unit-free charges
+
+    """
+    if units.is_quantity(charges):
+        charges = charges.value_in_unit(units.elementary_charge)
+    return numpy.array([ _strip_units(charge) for charge in charges ], numpy.float64)
+
+def _logsumexp(values):
+    """
+    Return log(sum(exp(values))), computed without overflow.
+
+    ARGUMENTS
+
+    values (numpy array) - the values
+
+    RETURNS
+
+    result (float) - the log of the sum of exponentials
+
+    """
+    maximum = values.max()
+    return maximum + math.log(numpy.exp(values - maximum).sum())
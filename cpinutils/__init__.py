@@ -1,5 +1,5 @@
 """ This contains the necessary data for cpinutil.py to run """
 
-__all__ = ['utilities', 'residues', 'exceptions']
+__all__ = ['utilities', 'residues', 'exceptions', 'namelist']
 __author__ = 'Jason Swails'
 __version__ = '13.0'
@@ -24,6 +24,9 @@ class CpinInputWarning(CpinWarning):
 class CpinInputError(CpinError):
    " If the user provides bad input "
 
+class CpinFormatError(CpinError):
+   " If a cpin file cannot be parsed or its contents are inconsistent "
+
 def replace_excepthook(debug):
    " This function replaces sys.excepthook with one that suppresses tracebacks "
    def excepthook(exception_type, exception_value, tb):
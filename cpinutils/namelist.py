@@ -0,0 +1,221 @@
+"""
+Streaming reader for the Fortran namelists of cpin files
+"""
+from cpinutils.exceptions import CpinFormatError
+from array import array
+import numpy as np
+import re
+
+# One token of a namelist: a quoted string, a variable name (with the '=' that
+# follows it), the start of a namelist, the '/' that ends it, an unquoted
+# value, a separating comma, or a comment
+_TOKEN = re.compile(r"""\s*(?:
+      (?P<string>'(?:[^']|'')*'|"(?:[^"]|"")*")
+    | (?P<name>[A-Za-z_]\w*(?:\s*\(\s*\d+\s*\))?(?:\s*%\s*[A-Za-z_]\w*)?)\s*=
+    | (?P<group>&[A-Za-z_]\w*)
+    | (?P<end>/)
+    | (?P<value>[^\s,/='"!&]+)
+    | (?P<comma>,)
+    | (?P<comment>!.*)
+   )""", re.VERBOSE)
+
+_WHITESPACE = re.compile(r'\s+')
+
+_STATEINF = re.compile(r'^STATEINF\((\d+)\)%(\w+)$')
+
+# Smallest allowed value of each STATEINF field
+STATEINF_FIELDS = {'FIRST_ATOM' : 1, 'FIRST_CHARGE' : 0, 'FIRST_STATE' : 0,
+                   'NUM_ATOMS' : 1, 'NUM_STATES' : 1}
+
+# Variables of the CNSTPH namelist read into float64 arrays
+CPIN_ARRAYS = ('CHRGDAT', 'STATENE')
+
+def _tokens(lines):
+   """ Yields (kind, text, line number) for each token in an iterable of lines """
+   for lineno, line in enumerate(lines):
+      line = line.rstrip()
+      pos = 0
+      while pos < len(line):
+         match = _TOKEN.match(line, pos)
+         if match is None:
+            raise CpinFormatError('Could not parse line %d at: %s' %
+                                  (lineno + 1, line[pos:].strip()))
+         pos = match.end()
+         kind = match.lastgroup
+         if kind != 'comment':
+            yield kind, match.group(kind), lineno + 1
+
+def _convert(token, lineno):
+   """ Converts an unquoted value to an int, float, or logical """
+   try:
+      return int(token)
+   except ValueError:
+      pass
+   try:
+      return float(token.replace('d', 'e').replace('D', 'E'))
+   except ValueError:
+      pass
+   if token.upper() in ('T', '.T.', '.TRUE.'):
+      return True
+   if token.upper() in ('F', '.F.', '.FALSE.'):
+      return False
+   raise CpinFormatError('Bad value on line %d: %s' % (lineno, token))
+
+def _values(kind, token, lineno):
+   """ Returns the list of values denoted by a value or string token """
+   if kind == 'string':
+      return [token[1:-1].replace(token[0] * 2, token[0])]
+   # Repeated values of the form count*value
+   count, star, token = token.rpartition('*')
+   if not star:
+      return [_convert(token, lineno)]
+   try:
+      count = int(count)
+   except ValueError:
+      raise CpinFormatError('Bad repeat count on line %d: %s' % (lineno, count))
+   return [_convert(token, lineno)] * count
+
+def read_namelist(source, name, arrays=(), check=None):
+   """
+   Reads the namelist &name from a file name or an open file in a single pass,
+   stopping at its end. Returns a dict mapping the (upper case) variable names
+   to their values: variables listed in arrays are float64 numpy arrays, other
+   variables with one value are that value, and all others are lists.
+
+   If given, check(key, value, lineno) is called as each variable is completed
+   """
+   if hasattr(source, 'read'):
+      return _read_namelist(source, name, arrays, check)
+   with open(source, 'r') as infile:
+      return _read_namelist(infile, name, arrays, check)
+
+def _read_namelist(lines, name, arrays, check):
+   """ Reads a namelist from an iterable of lines. See read_namelist """
+   name = name.upper()
+   arrays = set([key.upper() for key in arrays])
+   namelist = None
+   key = values = None
+
+   def finish():
+      """ Stores the values of the current variable """
+      if key is None:
+         return
+      if key in arrays:
+         value = np.array(values, np.float64)
+      elif len(values) == 1:
+         value = values[0]
+      else:
+         value = values
+      if check is not None:
+         check(key, value, key_lineno)
+      namelist[key] = value
+
+   for kind, token, lineno in _tokens(lines):
+      if namelist is None:
+         # Skip everything before the start of the requested namelist
+         if kind == 'group' and token[1:].upper() == name:
+            namelist = dict()
+         continue
+      if kind == 'name':
+         finish()
+         key = _WHITESPACE.sub('', token).upper()
+         key_lineno = lineno
+         if key in namelist:
+            raise CpinFormatError('Variable %s is set more than once (line %d)' %
+                                  (key, lineno))
+         values = array('d') if key in arrays else list()
+      elif kind in ('value', 'string'):
+         if key is None:
+            raise CpinFormatError('Value without a variable name on line %d' %
+                                  lineno)
+         new_values = _values(kind, token, lineno)
+         # Logicals are ints to array('d'), so they must be rejected explicitly
+         if key in arrays and any(type(value) is bool for value in new_values):
+            raise CpinFormatError('%s must be numeric; got %s on line %d' %
+                                  (key, token, lineno))
+         try:
+            values.extend(new_values)
+         except TypeError:
+            raise CpinFormatError('%s must be numeric; got %s on line %d' %
+                                  (key, token, lineno))
+      elif kind == 'end' or (kind == 'group' and token.upper() == '&END'):
+         finish()
+         return namelist
+      elif kind == 'group':
+         raise CpinFormatError('Namelist &%s is not terminated before %s on '
+                               'line %d' % (name, token, lineno))
+
+   if namelist is None:
+      raise CpinFormatError('Namelist &%s not found' % name)
+   raise CpinFormatError('Namelist &%s is not terminated' % name)
+
+def _check_stateinf(key, value, lineno):
+   """ Validates a STATEINF pointer as soon as it is read """
+   match = _STATEINF.match(key)
+   if match is None:
+      if key.startswith('STATEINF'):
+         raise CpinFormatError('Bad STATEINF entry on line %d: %s' % (lineno, key))
+      return
+   field = match.group(2)
+   if field not in STATEINF_FIELDS:
+      raise CpinFormatError('Unknown STATEINF field on line %d: %s' %
+                            (lineno, key))
+   if type(value) is not int or value < STATEINF_FIELDS[field]:
+      raise CpinFormatError('%s must be an integer of at least %d; got %s on '
+                            'line %d' % (key, STATEINF_FIELDS[field], value, lineno))
+
+def _as_list(value):
+   """ Returns a single value as a one-element list """
+   if isinstance(value, list):
+      return value
+   return [value]
+
+def read_cpin(source):
+   """
+   Reads the CNSTPH namelist of a cpin file (file name or open file), parsing
+   CHRGDAT and STATENE into float64 numpy arrays, PROTCNT and RESSTATE into
+   lists, and checking that the STATEINF pointers of every titratable residue
+   lie within those arrays. Returns the namelist dict (see read_namelist)
+   """
+   namelist = read_namelist(source, 'CNSTPH', CPIN_ARRAYS, _check_stateinf)
+
+   for key in ('CHRGDAT', 'PROTCNT', 'RESSTATE', 'STATENE', 'TRESCNT'):
+      if key not in namelist:
+         raise CpinFormatError('cpin file is missing %s' % key)
+   for key in ('PROTCNT', 'RESSTATE'):
+      namelist[key] = _as_list(namelist[key])
+   trescnt = namelist['TRESCNT']
+   if type(trescnt) is not int or trescnt < 0:
+      raise CpinFormatError('TRESCNT must be a non-negative integer; got %s' %
+                            trescnt)
+   if len(namelist['RESSTATE']) != trescnt:
+      raise CpinFormatError('RESSTATE has %d entries for %d titratable residues'
+                            % (len(namelist['RESSTATE']), trescnt))
+   if len(namelist['PROTCNT']) != len(namelist['STATENE']):
+      raise CpinFormatError('PROTCNT has %d entries, but STATENE has %d' %
+                            (len(namelist['PROTCNT']), len(namelist['STATENE'])))
+
+   for i in range(trescnt):
+      stateinf = dict()
+      for field in STATEINF_FIELDS:
+         key = 'STATEINF(%d)%%%s' % (i, field)
+         if key not in namelist:
+            raise CpinFormatError('cpin file is missing %s' % key)
+         stateinf[field] = namelist[key]
+      last_charge = (stateinf['FIRST_CHARGE'] +
+                     stateinf['NUM_ATOMS'] * stateinf['NUM_STATES'])
+      if last_charge > len(namelist['CHRGDAT']):
+         raise CpinFormatError('Charges of residue %d extend past the end of '
+                               'CHRGDAT (%d > %d)' %
+                               (i, last_charge, len(namelist['CHRGDAT'])))
+      last_state = stateinf['FIRST_STATE'] + stateinf['NUM_STATES']
+      if last_state > len(namelist['STATENE']):
+         raise CpinFormatError('States of residue %d extend past the end of '
+                               'STATENE (%d > %d)' %
+                               (i, last_state, len(namelist['STATENE'])))
+      resstate = namelist['RESSTATE'][i]
+      if type(resstate) is not int or not 0 <= resstate < stateinf['NUM_STATES']:
+         raise CpinFormatError('RESSTATE of residue %d must be in range(%d); '
+                               'got %s' % (i, stateinf['NUM_STATES'], resstate))
+
+   return namelist
@@ -0,0 +1,152 @@
+"""
+Tests of the streaming cpin namelist reader. Run with nosetests
+"""
+from cpinutils.exceptions import CpinFormatError
+from cpinutils.namelist import read_namelist, read_cpin, CPIN_ARRAYS
+import numpy as np
+import io
+import os
+import re
+
+# Directory holding the example and calibration systems
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CPIN_FILES = ([os.path.join(_ROOT, 'amber-example', 'cpin')] +
+               [os.path.join(_ROOT, 'calibration-implicit', '%s.cpin' % res)
+                for res in ('asp', 'cys', 'glu', 'his', 'lys', 'tyr')])
+
+# A small valid cpin file, exercising comments, repeat counts, d exponents,
+# several variables on one line, and quoted strings with escaped quotes
+_CPIN = u"""! Comments and text before the namelist are skipped.
+&CNSTPH
+ CHRGDAT=0.5,-0.5,2*0.0, ! repeated values
+ PROTCNT=1,0, RESSTATE=0,
+ STATEINF(0)%FIRST_ATOM=1, STATEINF(0)%FIRST_CHARGE=0,
+ STATEINF(0)%FIRST_STATE=0, STATEINF(0)%NUM_ATOMS=2,
+ STATEINF(0)%NUM_STATES=2,
+ STATENE=0.0,1.5d0, TRESCNT=1,
+ TITLE='it''s a test',
+/
+"""
+
+# Replacements in _CPIN that each make it invalid, with part of the message
+# of the CpinFormatError they raise
+_CPIN_ERRORS = [
+   (u"TITLE='it''s a test',", u"TITLE='unterminated,", 'Could not parse line'),
+   (u'TRESCNT=1,', u'TRESCNT=1x,', 'Bad value'),
+   (u'2*0.0', u'a*0.0', 'Bad repeat count'),
+   (u'RESSTATE=0,', u'RESSTATE=0, PROTCNT=1,', 'set more than once'),
+   (u'&CNSTPH\n', u'&CNSTPH\n 1,\n', 'Value without a variable name'),
+   (u'STATENE=0.0,', u"STATENE='zero',", 'must be numeric'),
+   (u'STATENE=0.0,', u'STATENE=.TRUE.,', 'must be numeric'),
+   (u'CHRGDAT=0.5,', u'CHRGDAT=T,', 'must be numeric'),
+   (u'/\n', u'&OTHER\n/\n', 'is not terminated before'),
+   (u'&CNSTPH', u'&OTHER', 'not found'),
+   (u'/\n', u'\n', 'is not terminated'),
+   (u'STATEINF(0)%NUM_STATES=2,',
+    u'STATEINF(0)%NUM_STATES=2, STATEINF(0)=1,', 'Bad STATEINF entry'),
+   (u'STATEINF(0)%NUM_STATES=2,',
+    u'STATEINF(0)%NUM_STATES=2, STATEINF(0)%LAST_ATOM=1,',
+    'Unknown STATEINF field'),
+   (u'STATEINF(0)%NUM_ATOMS=2,', u'STATEINF(0)%NUM_ATOMS=0,',
+    'must be an integer of at least 1'),
+   (u'STATEINF(0)%FIRST_CHARGE=0,', u'STATEINF(0)%FIRST_CHARGE=0.0,',
+    'must be an integer of at least 0'),
+   (u' TRESCNT=1,', u'', 'missing TRESCNT'),
+   (u'TRESCNT=1,', u'TRESCNT=-1,', 'TRESCNT must be a non-negative integer'),
+   (u'RESSTATE=0,', u'RESSTATE=0,0,', 'RESSTATE has 2 entries'),
+   (u'PROTCNT=1,0,', u'PROTCNT=1,', 'PROTCNT has 1 entries'),
+   (u'STATEINF(0)%FIRST_STATE=0,', u'',
+    'missing STATEINF(0)%FIRST_STATE'),
+   (u'STATEINF(0)%FIRST_CHARGE=0,', u'STATEINF(0)%FIRST_CHARGE=1,',
+    'extend past the end of CHRGDAT'),
+   (u'STATEINF(0)%FIRST_STATE=0,', u'STATEINF(0)%FIRST_STATE=1,',
+    'extend past the end of STATENE'),
+   (u'RESSTATE=0,', u'RESSTATE=2,', 'RESSTATE of residue 0 must be in range(2)'),
+]
+
+def _reference_namelist(filename, namelist_name):
+   """
+   Parses a namelist with the regular-expression parser that read_namelist
+   replaced in constph.py, as a reference for the files it could read
+   """
+   with open(filename, 'r') as infile:
+      contents = ''.join([line.strip() for line in infile])
+   contents = re.match('&' + namelist_name + '(.*)/', contents).group(1)
+
+   # These regexp match strings come from fortran-namelist from Stephane
+   # Chamberland (stephane.chamberland@ec.gc.ca) [LGPL].
+   value_int = re.compile(r'[+-]?[0-9]+')
+   value_real = re.compile(r'[+-]?([0-9]+\.[0-9]*|[0-9]*\.[0-9]+)')
+   value_string = re.compile(r'^[\'\"](.*)[\'\"]$')
+
+   namelist = dict()
+   while contents:
+      # Peel off the variable name, then the value, which extends to either
+      # the next variable name or the end of the namelist
+      match = re.match(r'^([^,]+)=(.+)$', contents)
+      if not match: break
+      name = match.group(1).strip()
+      contents = match.group(2).strip()
+      match = re.match(r'^([^=]+),([^,]+)=(.+)$', contents)
+      if match:
+         value = match.group(1).strip()
+         contents = match.group(2) + '=' + match.group(3)
+      else:
+         value, contents = contents, ''
+      values = []
+      for element in value.split(','):
+         if value_real.match(element):
+            element = float(element)
+         elif value_int.match(element):
+            element = int(element)
+         elif value_string.match(element):
+            element = element[1:-1]
+         if element != '':
+            values.append(element)
+      namelist[name] = values[0] if len(values) == 1 else values
+
+   return namelist
+
+def test_read_cpin_files():
+   """ Compares the distributed cpin files with the reference parser """
+   for filename in _CPIN_FILES:
+      reference = _reference_namelist(filename, 'CNSTPH')
+      for namelist, arrays in ((read_namelist(filename, 'CNSTPH'), ()),
+                               (read_cpin(filename), CPIN_ARRAYS)):
+         assert sorted(namelist) == sorted(reference), \
+               '%s: variables %s differ from %s' % (filename, sorted(namelist),
+                                                    sorted(reference))
+         for key, value in reference.items():
+            if key in arrays:
+               assert np.array_equal(namelist[key],
+                                     np.array(value, np.float64).reshape(-1)), \
+                     '%s: %s differs from the reference' % (filename, key)
+            else:
+               assert namelist[key] in (value, [value]), \
+                     '%s: %s is %s instead of %s' % (filename, key,
+                                                     namelist[key], value)
+
+def test_read_cpin_syntax():
+   """ Checks the values read from a small cpin file """
+   namelist = read_cpin(io.StringIO(_CPIN))
+   assert list(namelist['CHRGDAT']) == [0.5, -0.5, 0.0, 0.0]
+   assert list(namelist['STATENE']) == [0.0, 1.5]
+   assert namelist['PROTCNT'] == [1, 0] and namelist['RESSTATE'] == [0]
+   assert namelist['TITLE'] == "it's a test"
+   namelist = read_cpin(io.StringIO(_CPIN.replace(u'/\n', u'&END\n')))
+   assert namelist['TRESCNT'] == 1
+
+def test_read_cpin_errors():
+   """ Checks that each malformed or inconsistent cpin file is rejected """
+   for old, new, message in _CPIN_ERRORS:
+      assert old in _CPIN, 'Test cpin file does not contain %s' % old
+      try:
+         read_cpin(io.StringIO(_CPIN.replace(old, new, 1)))
+      except CpinFormatError as error:
+         assert message in str(error), \
+               'Replacing %s by %s raised "%s" instead of an error containing ' \
+               '"%s"' % (old, new, error, message)
+      else:
+         raise AssertionError('Replacing %s by %s did not raise CpinFormatError'
+                              % (old, new))
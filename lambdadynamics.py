@@ -0,0 +1,297 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Continuous constant-pH dynamics by lambda-dynamics.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import math
+
+import numpy
+
+import simtk.openmm as openmm
+import simtk.unit as units
+
+from constph import TitrationDriver, kB
+from constphutils import _strip_units
+
+#=============================================================================================
+# Lambda-dynamics titration.
+#=============================================================================================
+
+class LambdaDynamicsTitration(TitrationDriver):
+    """
+    Continuous constant-pH dynamics by lambda-dynamics, as an alternative to discrete Monte Carlo titration.
+
+    Each titratable group g with states s carries periodic coordinates theta_g_s, which give the weight of each state as
+
+    lambda_g_s = exp(c sin theta_g_s) / sum_t exp(c sin theta_g_t)
+
+    with c = theta_scale.  Since the coordinates are angles, the stationary density exp(- beta U(lambda(theta))) is normalizable and
+    every direction in theta, including a common shift of all coordinates of a group, changes the weights; the angles are wrapped into
+    [-pi, pi) after every update, so they stay bounded.  Each weight ranges between exp(-c) and exp(c) relative to the others.  Charges are interpolated between the states of the cpin tables as q = sum_s lambda_g_s q_s with
+    the global-parameter titration forces (see use_global_parameters of TitrationDriver), and the coordinates theta are integrated
+    together with the atoms by a Langevin CustomIntegrator, with forces from the energy derivatives with respect to the lambdas.
+    The reference-state terms enter as the potential - kT sum_s lambda_g_s log w_g_s, with log w_g_s the reference weights of the states.
+
+    EXAMPLES
+
+    The integrator must be used for the Context of the System:
+
+        ld_titration = LambdaDynamicsTitration(system, temperature, pH, prmtop, cpin_filename)
+        context = openmm.Context(system, ld_titration.integrator, platform)
+        ld_titration.integrator.step(nsteps)
+        states = ld_titration.getPhysicalTitrationStates()
+
+    NOTE
+
+    Titration states evolve with the integrator, so there are no discrete titration states or Monte Carlo updates.
+
+    As for global-parameter titration, only NoCutoff electrostatics are supported; an exception is raised for Systems whose
+    NonbondedForce uses a cutoff, i.e. reaction-field, Ewald, or PME electrostatics.
+
+    """
+
+    def __init__(self, system, temperature, pH, prmtop, cpin_filename, timestep=1.0*units.femtoseconds, collision_rate=5.0/units.picoseconds, theta_mass=5.0, theta_scale=5.0, debug=False):
+        """
+        Initialize a lambda-dynamics titration driver for constant pH simulation.
+
+        ARGUMENTS
+
+        system (simtk.openmm.System) - system to be titrated, containing all possible protonation sites
+        temperature (simtk.unit.Quantity compatible with simtk.unit.kelvin) - temperature to be simulated
+        pH (float) - the pH to be simulated
+        prmtop (simtk.openmm.app.AmberPrmtopFile) - parsed AMBER 'prmtop' file, or None (see TitrationDriver)
+        cpin_filename (string) - AMBER 'cpin' file defining protonation charge states and energies
+
+        OPTIONAL ARGUMENTS
+
+        timestep (simtk.unit.Quantity compatible with simtk.unit.femtoseconds) - the integration timestep (default: 1 fs)
+        collision_rate (simtk.unit.Quantity compatible with 1/simtk.unit.picoseconds) - the collision rate of atoms and lambda coordinates (default: 5/ps)
+        theta_mass (float) - mass of the theta coordinates, in kJ/mol ps**2 (default: 5.0)
+        theta_scale (float) - the factor c of sin theta in the weights, which sets how close the weights get to 0 and 1 (default: 5.0)
+        debug (boolean) - if True, will print debug information
+
+        NOTE
+
+        Each group starts with theta = pi/2 for the state given in the cpin file and -pi/2 for its other states.
+
+        """
+        # Check the electrostatics before any force is modified.
+        for force_index in range(system.getNumForces()):
+            force = system.getForce(force_index)
+            if (force.__class__.__name__ == 'NonbondedForce') and (force.getNonbondedMethod() != openmm.NonbondedForce.NoCutoff):
+                raise Exception("LambdaDynamicsTitration is only implemented for NoCutoff electrostatics; reaction-field, Ewald, and PME electrostatics are not supported.")
+
+        TitrationDriver.__init__(self, system, temperature, pH, prmtop, use_global_parameters=True, debug=debug)
+        self.cpin_filename = cpin_filename
+        initial_titration_states = self._readCpin(cpin_filename)
+
+        self.timestep = timestep
+        self.collision_rate = collision_rate
+        self.theta_mass = theta_mass
+        self.theta_scale = theta_scale
+
+        # The forces must provide derivatives with respect to the lambdas.
+        for force in self._titration_forces:
+            for index in range(force.getNumGlobalParameters()):
+                name = force.getGlobalParameterName(index)
+                if name in self._global_parameter_values:
+                    force.addEnergyParameterDerivative(name)
+
+        # Initial coordinates and weights of the states.
+        initial_thetas = list()
+        for (group, titration_state_index) in zip(self.titrationGroups, initial_titration_states):
+            thetas = - 0.5 * math.pi * numpy.ones([group['nstates']], numpy.float64)
+            thetas[titration_state_index] = 0.5 * math.pi
+            initial_thetas.append(thetas)
+            lambdas = self._computeLambdas(thetas)
+            for (state_index, name) in enumerate(group['global_parameter_names']):
+                if name is not None:
+                    self._setGlobalParameter(name, lambdas[state_index])
+
+        self.integrator = self._createIntegrator(initial_thetas)
+
+        return
+
+    def _computeLambdas(self, thetas):
+        """
+        Return the weights of the states of a group for the given coordinates.
+
+        ARGUMENTS
+
+        thetas (numpy array) - the coordinate of each state of the group
+
+        RETURNS
+
+        lambdas (numpy array) - the weight of each state
+
+        """
+        exponents = self.theta_scale * numpy.sin(thetas)
+        weights = numpy.exp(exponents - exponents.max())
+
+        return weights / weights.sum()
+
+    def _createIntegrator(self, initial_thetas):
+        """
+        Create the Langevin CustomIntegrator propagating the atoms and theta coordinates, with a velocity Verlet splitting V R O R V.
+
+        ARGUMENTS
+
+        initial_thetas (list of numpy array) - initial coordinate of each state of each group
+
+        RETURNS
+
+        integrator (simtk.openmm.CustomIntegrator) - the integrator
+
+        """
+        timestep = _strip_units(self.timestep)
+        a = math.exp(- _strip_units(self.collision_rate) * timestep)
+
+        integrator = openmm.CustomIntegrator(timestep)
+        integrator.addGlobalVariable('kT', _strip_units(kB * self.temperature))
+        integrator.addGlobalVariable('a', a)
+        integrator.addGlobalVariable('b', math.sqrt(1.0 - a**2))
+        integrator.addGlobalVariable('theta_mass', self.theta_mass)
+        integrator.addGlobalVariable('theta_scale', self.theta_scale)
+        integrator.addPerDofVariable('x1', 0)
+        for (group_index, group) in enumerate(self.titrationGroups):
+            initial_lambdas = self._computeLambdas(initial_thetas[group_index])
+            for state_index in range(group['nstates']):
+                suffix = '%d_%d' % (group_index, state_index)
+                integrator.addGlobalVariable('theta_' + suffix, initial_thetas[group_index][state_index])
+                integrator.addGlobalVariable('vtheta_' + suffix, 0.0)
+                integrator.addGlobalVariable('lambda_' + suffix, initial_lambdas[state_index])
+                integrator.addGlobalVariable('reference_' + suffix, 0.0)
+                integrator.addGlobalVariable('dudl_' + suffix, 0.0)
+            integrator.addGlobalVariable('dudl_mean_%d' % group_index, 0.0)
+        self._setReferenceEnergies(integrator)
+
+        integrator.addUpdateContextState()
+        self._addVelocityUpdate(integrator)
+        self._addPositionUpdate(integrator)
+        integrator.addComputePerDof('v', 'a*v + b*sqrt(kT/m)*gaussian')
+        integrator.addConstrainVelocities()
+        for (group_index, group) in enumerate(self.titrationGroups):
+            for state_index in range(group['nstates']):
+                name = 'vtheta_%d_%d' % (group_index, state_index)
+                integrator.addComputeGlobal(name, 'a*%s + b*sqrt(kT/theta_mass)*gaussian' % name)
+        self._addPositionUpdate(integrator)
+        self._addVelocityUpdate(integrator)
+
+        return integrator
+
+    def _addVelocityUpdate(self, integrator):
+        """
+        Add a half-step velocity update of the atoms and theta coordinates to the integrator.
+
+        The force on theta_g_s is - c cos(theta_g_s) lambda_g_s (D_g_s - sum_t lambda_g_t D_g_t), where D_g_s is the derivative of the
+        potential, including the reference-state term, with respect to lambda_g_s.
+
+        """
+        integrator.addComputePerDof('v', 'v + 0.5*dt*f/m')
+        integrator.addConstrainVelocities()
+        for (group_index, group) in enumerate(self.titrationGroups):
+            for (state_index, name) in enumerate(group['global_parameter_names']):
+                if name is not None:
+                    integrator.addComputeGlobal('dudl_%d_%d' % (group_index, state_index), 'deriv(energy, %s)' % name)
+            derivatives = [ 'lambda_%d_%d*(dudl_%d_%d + reference_%d_%d)' % ((group_index, state_index)*3) for state_index in range(group['nstates']) ]
+            integrator.addComputeGlobal('dudl_mean_%d' % group_index, '+'.join(derivatives))
+            for state_index in range(group['nstates']):
+                suffix = '%d_%d' % (group_index, state_index)
+                integrator.addComputeGlobal('vtheta_' + suffix, 'vtheta_%s - 0.5*dt*theta_scale*cos(theta_%s)*lambda_%s*(dudl_%s + reference_%s - dudl_mean_%d)/theta_mass' % (suffix, suffix, suffix, suffix, suffix, group_index))
+
+        return
+
+    def _addPositionUpdate(self, integrator):
+        """
+        Add a half-step position update of the atoms and theta coordinates to the integrator, and update the lambdas of the forces.
+
+        The theta coordinates are wrapped into [-pi, pi).
+
+        """
+        integrator.addComputePerDof('x', 'x + 0.5*dt*v')
+        integrator.addComputePerDof('x1', 'x')
+        integrator.addConstrainPositions()
+        integrator.addComputePerDof('v', 'v + (x-x1)/(0.5*dt)')
+        for (group_index, group) in enumerate(self.titrationGroups):
+            for state_index in range(group['nstates']):
+                name = 'theta_%d_%d' % (group_index, state_index)
+                integrator.addComputeGlobal(name, '%s + 0.5*dt*v%s' % (name, name))
+                integrator.addComputeGlobal(name, '%s - %r*floor((%s + %r)/%r)' % (name, 2*math.pi, name, math.pi, 2*math.pi))
+            normalization = '+'.join([ 'exp(theta_scale*sin(theta_%d_%d))' % (group_index, state_index) for state_index in range(group['nstates']) ])
+            for (state_index, name) in enumerate(group['global_parameter_names']):
+                integrator.addComputeGlobal('lambda_%d_%d' % (group_index, state_index), 'exp(theta_scale*sin(theta_%d_%d))/(%s)' % (group_index, state_index, normalization))
+                if name is not None:
+                    integrator.addComputeGlobal(name, 'lambda_%d_%d' % (group_index, state_index))
+
+        return
+
+    def _setReferenceEnergies(self, integrator):
+        """
+        Set the reference-state potential - kT log w_g_s of each group state in the integrator, for the current pH and temperature.
+
+        """
+        self._updateReferenceWeights()
+        kT = _strip_units(kB * self.temperature)
+        for (group_index, group) in enumerate(self.titrationGroups):
+            for state_index in range(group['nstates']):
+                integrator.setGlobalVariableByName('reference_%d_%d' % (group_index, state_index), - kT * group['log_reference_weights'][state_index])
+
+        return
+
+    def setpH(self, pH):
+        """
+        Change the pH to be simulated.
+
+        ARGUMENTS
+
+        pH (float) - the new pH
+
+        """
+        self.pH = pH
+        self._setReferenceEnergies(self.integrator)
+
+        return
+
+    def getLambdas(self):
+        """
+        Return the current weights of the states of all groups.
+
+        RETURNS
+
+        lambdas (list of numpy array) - lambdas[g][s] is the weight of state s of group g
+
+        """
+        return [ numpy.array([ self.integrator.getGlobalVariableByName('lambda_%d_%d' % (group_index, state_index)) for state_index in range(group['nstates']) ])
+                 for (group_index, group) in enumerate(self.titrationGroups) ]
+
+    def getPhysicalTitrationStates(self, threshold=0.8):
+        """
+        Return the state of each group whose weight exceeds a threshold, as used to count populations in lambda-dynamics.
+
+        OPTIONAL ARGUMENTS
+
+        threshold (float) - minimum weight of a physical state (default: 0.8)
+
+        RETURNS
+
+        states (list) - the state of each group, or None for groups without a state above the threshold
+
+        """
+        states = list()
+        for lambdas in self.getLambdas():
+            state_index = int(lambdas.argmax())
+            if lambdas[state_index] < threshold:
+                state_index = None
+            states.append(state_index)
+
+        return states
@@ -0,0 +1,155 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Worker processes scoring and sampling titration states in Contexts of their own, for MonteCarloTitration.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import random
+
+import numpy
+
+import simtk.openmm as openmm
+import simtk.unit as units
+
+from constphutils import _strip_units
+
+#=============================================================================================
+# Worker processes scoring candidate titration states.
+#=============================================================================================
+
+_scoring_worker = dict() # state of the scoring worker in this process, if any
+
+def _initializeScoringWorker(mc_titration, shared_positions, platform_name, platform_properties):
+    """
+    Set up a scoring worker, with a Context of its copy of the System.
+
+    ARGUMENTS
+
+    mc_titration (MonteCarloTitration) - the forked copy of the titration driver, whose System and parameter tables the worker modifies
+    shared_positions (multiprocessing.Array) - positions (in nm) followed by periodic box vectors, written by the parent process
+    platform_name (string) - name of the platform of the worker Context
+    platform_properties (dict) - platform properties of the worker Context
+
+    NOTE
+
+    Forked workers inherit the state of the random number generators of the parent, so they are reseeded from the entropy source of the
+    operating system; otherwise, all workers would draw the same sequence as each other and as the parent, correlating their updates.
+
+    """
+    random.seed()
+    numpy.random.seed()
+
+    # Workers sample titration states at fixed positions, so moves that run dynamics are disabled; the settings of all other moves
+    # are sent with each asynchronous update (see _sampleTitrationStates()).
+    mc_titration._scoring_pool = None
+    mc_titration._asynchronous_update = None
+    mc_titration.ncmc_steps = 0
+    mc_titration._ncmc_protocol = dict()
+    mc_titration._ncmc_tuning = None
+    mc_titration._selection_statistics = None
+    integrator = openmm.VerletIntegrator(1.0 * units.femtoseconds)
+    platform = openmm.Platform.getPlatformByName(platform_name)
+    context = openmm.Context(mc_titration.system, integrator, platform, platform_properties)
+
+    _scoring_worker['mc_titration'] = mc_titration
+    _scoring_worker['shared_positions'] = shared_positions
+    _scoring_worker['context'] = context
+    _scoring_worker['version'] = None
+    _scoring_worker['force_group_mask'] = mc_titration._getForceGroupMask(mc_titration.titration_force_groups)
+
+    return
+
+def _scoreTitrationStates(task):
+    """
+    Return the unit-free energies of the titration forces with all groups in each of the specified states, in the shared configuration.
+
+    ARGUMENTS
+
+    task (tuple) - (version, periodic, titration_states), where version identifies the shared configuration, periodic is True if box
+                   vectors are shared as well, and titration_states is a list of lists of the states of all groups
+
+    RETURNS
+
+    energies (list of float) - the energy, in kJ/mol, for each entry of titration_states
+
+    """
+    (version, periodic, titration_states_list) = task
+    mc_titration = _scoring_worker['mc_titration']
+    context = _scoring_worker['context']
+
+    if _scoring_worker['version'] != version:
+        natoms = mc_titration.system.getNumParticles()
+        shared = numpy.frombuffer(_scoring_worker['shared_positions'], numpy.float64)
+        if periodic:
+            box_vectors = shared[3*natoms:].reshape(3, 3)
+            context.setPeriodicBoxVectors(*[ units.Quantity(openmm.Vec3(*vector), units.nanometers) for vector in box_vectors ])
+        context.setPositions(units.Quantity(shared[:3*natoms].reshape(natoms, 3).copy(), units.nanometers))
+        _scoring_worker['version'] = version
+
+    energies = list()
+    for titration_states in titration_states_list:
+        for (titration_group_index, titration_state_index) in enumerate(titration_states):
+            mc_titration.setTitrationState(titration_group_index, titration_state_index)
+        mc_titration._updateParametersInContext(context)
+        state = context.getState(getEnergy=True, groups=_scoring_worker['force_group_mask'])
+        energies.append(_strip_units(state.getPotentialEnergy()))
+
+    return energies
+
+def _sampleTitrationStates(task):
+    """
+    Run a titration update in the worker Context at a snapshot of the configuration.
+
+    ARGUMENTS
+
+    task (tuple) - (positions, box_vectors, titration_states, settings, learning), with unit-free positions and box vectors (in nm),
+                   box_vectors None for nonperiodic systems, the initial states of all groups, the move settings of the parent driver
+                   (see MonteCarloTitration._getAsynchronousSettings()), and True if selection weights are being learned
+
+    RETURNS
+
+    titration_states (list of int) - the final states of all groups
+    statistics (dict) - the statistics accumulated by the update, with the keys 'nattempted', 'naccepted', 'work_history', 'nenumerated',
+                        'population_sums', and 'selection_statistics' (None unless learning selection weights)
+
+    """
+    (positions, box_vectors, titration_states, settings, learning) = task
+    mc_titration = _scoring_worker['mc_titration']
+    context = _scoring_worker['context']
+
+    if box_vectors is not None:
+        context.setPeriodicBoxVectors(*[ units.Quantity(openmm.Vec3(*vector), units.nanometers) for vector in box_vectors ])
+    context.setPositions(units.Quantity(positions, units.nanometers))
+    _scoring_worker['version'] = None # the shared configuration must be read again
+    mc_titration.invalidateCache()
+
+    # Apply the settings of the parent, which may have changed since the worker was forked.
+    for (name, value) in settings.items():
+        setattr(mc_titration, name, value)
+    for (titration_group_index, titration_state_index) in enumerate(titration_states):
+        mc_titration.setTitrationState(titration_group_index, titration_state_index)
+
+    mc_titration.resetStatistics()
+    mc_titration._selection_statistics = None
+    if learning:
+        mc_titration.beginSelectionWeightAdaptation()
+    mc_titration.update(context)
+
+    statistics = dict()
+    statistics['nattempted'] = mc_titration.nattempted
+    statistics['naccepted'] = mc_titration.naccepted
+    statistics['work_history'] = mc_titration.work_history
+    statistics['nenumerated'] = mc_titration.nenumerated
+    statistics['population_sums'] = mc_titration.population_sums
+    statistics['selection_statistics'] = mc_titration._selection_statistics
+
+    return (list(mc_titration.titrationStates), statistics)
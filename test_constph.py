@@ -0,0 +1,1016 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Tests of the constant pH functionality in constph.py.
+
+DESCRIPTION
+
+Energies and moves of the titration drivers are checked against OpenMM Contexts on the Reference platform, for the Amber example
+and the calibration systems distributed with constph.py.
+
+EXAMPLES
+
+Run with nosetests:
+
+    nosetests test_constph.py
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import os
+import math
+import random
+import itertools
+
+import numpy
+
+import simtk.openmm as openmm
+import simtk.unit as units
+
+import cnstphgbforces
+import cpinutils.namelist
+from constph import MonteCarloTitration, _strip_units, _logsumexp, kB
+from lambdadynamics import LambdaDynamicsTitration
+
+#=============================================================================================
+# TEST SYSTEMS
+#=============================================================================================
+
+# Test systems, named by directory for the Amber example and by residue for the calibration systems.
+_TEST_SYSTEMS = ['amber-example'] + [ 'calibration-implicit/%s' % residue for residue in ['asp', 'cys', 'glu', 'his', 'lys', 'tyr'] ]
+
+def _createTestSystem(name):
+    """
+    Create a test system from the files distributed with constph.py.
+
+    ARGUMENTS
+
+    name (string) - 'amber-example', or 'calibration-implicit/<residue>' or 'calibration-explicit/<residue>' for a calibration system
+
+    RETURNS
+
+    system (simtk.openmm.System) - the system, with OBC2 implicit solvent and no cutoff, or PME electrostatics for explicit solvent
+    prmtop (simtk.openmm.app.AmberPrmtopFile) - the parameters
+    inpcrd (simtk.openmm.app.AmberInpcrdFile) - the coordinates, and box vectors for explicit solvent
+    cpin_filename (string) - the name of the cpin file
+
+    """
+    import simtk.openmm.app as app
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+    if name == 'amber-example':
+        filenames = [ os.path.join(path, filename) for filename in ['prmtop', 'min.x', 'cpin'] ]
+    else:
+        filenames = [ path + extension for extension in ['.prmtop', '.inpcrd', '.cpin'] ]
+    prmtop = app.AmberPrmtopFile(filenames[0])
+    inpcrd = app.AmberInpcrdFile(filenames[1])
+    if name.startswith('calibration-explicit'):
+        system = prmtop.createSystem(nonbondedMethod=app.PME, nonbondedCutoff=1.0*units.nanometers, constraints=app.HBonds)
+    else:
+        system = prmtop.createSystem(implicitSolvent=app.OBC2, nonbondedMethod=app.NoCutoff, constraints=app.HBonds)
+
+    return (system, prmtop, inpcrd, filenames[2])
+
+def _createTestContext(system, inpcrd):
+    """
+    Create a Reference platform Context for a test system, at the positions (and box vectors) of its coordinate file.
+
+    """
+    integrator = openmm.LangevinIntegrator(300.0*units.kelvin, 9.1/units.picoseconds, 1.0*units.femtoseconds)
+    context = openmm.Context(system, integrator, openmm.Platform.getPlatformByName('Reference'))
+    if inpcrd.getBoxVectors() is not None:
+        context.setPeriodicBoxVectors(*inpcrd.getBoxVectors())
+    context.setPositions(inpcrd.getPositions())
+
+    return context
+
+def _getTestEnergies(driver, context):
+    """
+    Return the energies of the titration force classes of a Context, in kJ/mol.
+
+    ARGUMENTS
+
+    driver (TitrationDriver) - the titration driver of the System of the Context
+    context (simtk.openmm.Context) - the context
+
+    RETURNS
+
+    energies (dict) - energies['GB'] is the energy of the GB titration forces, and energies['Nonbonded'] the remaining potential energy,
+                      which is comparable between drivers whether or not electrostatics of titratable atoms are in Custom forces
+
+    """
+    gb_force_groups = [ force_group for (force_group, classname) in zip(driver.titration_force_groups, driver._titration_force_classes) if classname == 'GB' ]
+    total_energy = _strip_units(context.getState(getEnergy=True).getPotentialEnergy())
+    gb_energy = 0.0
+    if len(gb_force_groups) > 0:
+        gb_energy = _strip_units(context.getState(getEnergy=True, groups=driver._getForceGroupMask(gb_force_groups)).getPotentialEnergy())
+
+    return { 'GB' : gb_energy, 'Nonbonded' : total_energy - gb_energy }
+
+def _assertEnergiesEqual(energies, reference_energies, tolerance, message):
+    """
+    Raise an AssertionError if energies of the same titration force classes differ by more than a tolerance, in kJ/mol.
+
+    """
+    for classname in reference_energies:
+        if abs(energies[classname] - reference_energies[classname]) > tolerance:
+            raise AssertionError("%s: %s energy %.6f kJ/mol differs from %.6f kJ/mol by more than %.1e kJ/mol." % (message, classname, energies[classname], reference_energies[classname], tolerance))
+
+    return
+
+def _checkAnalyticEnergies(driver, context, classname, tolerance, message, ntrials=20):
+    """
+    Compare analytic energy changes for random changes in the titration states of one or more groups with those of a Context.
+
+    ARGUMENTS
+
+    driver (MonteCarloTitration) - the titration driver, evaluating the energies of the titration forces of classname analytically
+    context (simtk.openmm.Context) - the context
+    classname (string) - the titration force class, 'Nonbonded' or 'GB'
+    tolerance (float) - the largest allowed difference between analytic and Context energy changes, in kJ/mol
+    message (string) - description of the test, for errors
+
+    OPTIONAL ARGUMENTS
+
+    ntrials (int) - the number of random state changes (default: 20)
+
+    NOTE
+
+    About half of the state changes are applied to the analytic evaluators, as for accepted trials, so that both the trial energies
+    and the updates of the evaluators are checked.
+
+    """
+    ngroups = driver.getNumTitratableGroups()
+    reference_analytic_energy = driver._getAnalyticEnergy(context)
+    reference_energy = _getTestEnergies(driver, context)[classname]
+    for trial in range(ntrials):
+        for group_index in random.sample(range(ngroups), random.randint(1, min(3, ngroups))):
+            driver.setTitrationState(group_index, random.randrange(driver.getNumTitrationStates(group_index)), context)
+        delta_analytic_energy = driver._getAnalyticEnergy(context) - reference_analytic_energy
+        delta_energy = _getTestEnergies(driver, context)[classname] - reference_energy
+        if abs(delta_analytic_energy - delta_energy) > tolerance:
+            raise AssertionError("%s, states %s: analytic %s energy change %.6f kJ/mol differs from %.6f kJ/mol by more than %.1e kJ/mol." % (message, str(driver.getTitrationStates()), classname, delta_analytic_energy, delta_energy, tolerance))
+        if random.random() < 0.5:
+            driver._updateAnalyticStates()
+
+    return
+
+def _computeStatePopulations(driver, context, titration_group_indices):
+    """
+    Compute the exact populations of the joint states of some groups in the current configuration, by setting each joint state in the Context.
+
+    ARGUMENTS
+
+    driver (MonteCarloTitration) - the titration driver
+    context (simtk.openmm.Context) - the context
+    titration_group_indices (list of int) - the groups whose states are varied, with the other groups in their current states
+
+    RETURNS
+
+    candidate_states (list of tuple of int) - the joint states of the groups
+    populations (numpy array of shape [len(candidate_states)]) - the population of each joint state
+
+    """
+    driver._updateReferenceWeights()
+    initial_titration_states = driver.getTitrationStates()
+    candidate_states = list(itertools.product(*[ range(driver.getNumTitrationStates(group_index)) for group_index in titration_group_indices ]))
+    force_group_mask = driver._getForceGroupMask(driver.titration_force_groups)
+    log_P = numpy.zeros([len(candidate_states)], numpy.float64)
+    for (candidate_index, states) in enumerate(candidate_states):
+        for (group_index, state_index) in zip(titration_group_indices, states):
+            driver.setTitrationState(group_index, state_index, context)
+        log_P[candidate_index] = - driver._beta * _strip_units(context.getState(getEnergy=True, groups=force_group_mask).getPotentialEnergy()) + driver._log_reference_sum
+    for (group_index, state_index) in enumerate(initial_titration_states):
+        driver.setTitrationState(group_index, state_index, context)
+
+    return (candidate_states, numpy.exp(log_P - _logsumexp(log_P)))
+
+def _setBalancedpH(driver, context, titration_group_index):
+    """
+    Set the pH at which the protonated and deprotonated states of a group with two proton counts are equally populated in the current configuration.
+
+    """
+    driver.pH = 0.0
+    (candidate_states, populations) = _computeStatePopulations(driver, context, [titration_group_index])
+    proton_counts = numpy.array([ state['proton_count'] for state in driver.titrationGroups[titration_group_index]['titration_states'] ])
+    (low, high) = (proton_counts.min(), proton_counts.max())
+    driver.pH = (math.log(populations[proton_counts == high].sum()) - math.log(populations[proton_counts == low].sum())) / ((high - low) * math.log(10))
+
+    return driver.pH
+
+def _assertFrequenciesMatch(counts, populations, message, nsigma=5.0):
+    """
+    Raise an AssertionError if the frequencies of sampled states differ from their populations by more than nsigma standard errors, plus 0.01.
+
+    """
+    nsamples = counts.sum()
+    frequencies = counts / float(nsamples)
+    tolerances = nsigma * numpy.sqrt(populations * (1.0 - populations) / nsamples) + 0.01
+    if numpy.any(numpy.abs(frequencies - populations) > tolerances):
+        raise AssertionError("%s: state frequencies %s differ from the populations %s." % (message, str(frequencies), str(populations)))
+
+    return
+
+#=============================================================================================
+# TESTS
+#=============================================================================================
+
+def test_global_parameter_energies():
+    """
+    Compare the energies of every titration state of each group between global-parameter and per-particle parameter titration.
+
+    """
+    temperature = 300.0 * units.kelvin
+    for name in _TEST_SYSTEMS:
+        runs = list()
+        for use_global_parameters in [False, True]:
+            (system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+            driver = MonteCarloTitration(system, temperature, 7.0, prmtop, cpin_filename, use_global_parameters=use_global_parameters)
+            runs.append( (driver, _createTestContext(system, inpcrd)) )
+        for group_index in range(runs[0][0].getNumTitratableGroups()):
+            initial_state = runs[0][0].getTitrationState(group_index)
+            for state_index in range(runs[0][0].getNumTitrationStates(group_index)):
+                for (driver, context) in runs:
+                    driver.setTitrationState(group_index, state_index, context)
+                [reference_energies, energies] = [ _getTestEnergies(driver, context) for (driver, context) in runs ]
+                _assertEnergiesEqual(energies, reference_energies, 1.0e-3, "%s, group %d, state %d" % (name, group_index, state_index))
+            for (driver, context) in runs:
+                driver.setTitrationState(group_index, initial_state, context)
+
+    return
+
+def test_analytic_coulomb_energies():
+    """
+    Compare analytic Coulomb energy changes with those of the Context.
+
+    """
+    temperature = 300.0 * units.kelvin
+    random.seed(0)
+    for name in _TEST_SYSTEMS:
+        (system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+        driver = MonteCarloTitration(system, temperature, 7.0, prmtop, cpin_filename, analytic_coulomb=True)
+        context = _createTestContext(system, inpcrd)
+        _checkAnalyticEnergies(driver, context, 'Nonbonded', 1.0e-3, name)
+
+    return
+
+def test_site_interaction_energies():
+    """
+    Compare energy changes of the site-interaction model (see _buildSiteInteractionEnergies()) with those of the Context, for
+    random changes in the titration states of one or more groups.  The model is exact for NoCutoff electrostatics and GBSAOBCForce.
+
+    """
+    temperature = 300.0 * units.kelvin
+    random.seed(0)
+    for name in _TEST_SYSTEMS:
+        (system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+        driver = MonteCarloTitration(system, temperature, 7.0, prmtop, cpin_filename, site_interaction_sweeps=1)
+        context = _createTestContext(system, inpcrd)
+        if driver._reference_conditions != (driver.pH, _strip_units(driver.temperature)):
+            driver._updateReferenceWeights()
+        model = driver._getSiteInteractionModel(context, driver._getConfigurationEpoch(context))
+
+        def get_model_energy(titration_states):
+            columns = [ column + state_index for (column, state_index) in zip(model['columns'], titration_states) ]
+            log_P = model['log_weights'][columns].sum() + 0.5 * model['couplings'][numpy.ix_(columns, columns)].sum()
+            log_P -= sum([ group['log_reference_weights'][state_index] for (group, state_index) in zip(driver.titrationGroups, titration_states) ])
+            return - log_P / driver._beta
+
+        def get_energy():
+            energies = _getTestEnergies(driver, context)
+            return energies['Nonbonded'] + energies['GB']
+
+        ngroups = driver.getNumTitratableGroups()
+        reference_model_energy = get_model_energy(driver.getTitrationStates())
+        reference_energy = get_energy()
+        for trial in range(20):
+            for group_index in random.sample(range(ngroups), random.randint(1, min(3, ngroups))):
+                driver.setTitrationState(group_index, random.randrange(driver.getNumTitrationStates(group_index)), context)
+            delta_model_energy = get_model_energy(driver.getTitrationStates()) - reference_model_energy
+            delta_energy = get_energy() - reference_energy
+            if abs(delta_model_energy - delta_energy) > 1.0e-3:
+                raise AssertionError("%s, states %s: site-interaction energy change %.6f kJ/mol differs from %.6f kJ/mol by more than 1.0e-03 kJ/mol." % (name, str(driver.getTitrationStates()), delta_model_energy, delta_energy))
+
+    return
+
+def test_analytic_gb_energies():
+    """
+    Compare analytic GB energy changes with those of the Context, for GBSAOBCForce and for the OBC2 force of cnstphgbforces,
+    whose Born radii change when charges change to or from zero, with and without neglecting small Born radius changes.
+
+    """
+    temperature = 300.0 * units.kelvin
+    random.seed(0)
+    for name in _TEST_SYSTEMS:
+        for gb_model in ['GBSAOBCForce', 'cnstphgbforces']:
+            for analytic_gb_tolerance in [0.0, 0.01]:
+                (system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+                if gb_model == 'cnstphgbforces':
+                    # Replace the GBSAOBCForce by the OBC2 force excluding uncharged atoms from the Born radius integrals.
+                    [force_index] = [ index for index in range(system.getNumForces()) if system.getForce(index).__class__.__name__ == 'GBSAOBCForce' ]
+                    force = system.getForce(force_index)
+                    custom_force = cnstphgbforces.GBSAOBC2Force(solventDielectric=force.getSolventDielectric(), soluteDielectric=force.getSoluteDielectric(), SA='ACE')
+                    for atom_index in range(force.getNumParticles()):
+                        custom_force.addParticle([ _strip_units(parameter) for parameter in force.getParticleParameters(atom_index) ])
+                    system.removeForce(force_index)
+                    system.addForce(custom_force)
+                driver = MonteCarloTitration(system, temperature, 7.0, prmtop, cpin_filename, analytic_gb=True, analytic_gb_tolerance=analytic_gb_tolerance)
+                context = _createTestContext(system, inpcrd)
+                _checkAnalyticEnergies(driver, context, 'GB', 1.0e-3 + 2*analytic_gb_tolerance, "%s, %s, tolerance %.2f" % (name, gb_model, analytic_gb_tolerance))
+
+    return
+
+def test_ncmc_trial():
+    """
+    Check NCMC switching moves in explicit solvent: a self transition does no work, and a rejected move restores the titration
+    states, positions, time, and step count, and reverses the velocities.
+
+    """
+    temperature = 300.0 * units.kelvin
+    (system, prmtop, inpcrd, cpin_filename) = _createTestSystem('calibration-explicit/his')
+    driver = MonteCarloTitration(system, temperature, 6.5, prmtop, cpin_filename, ncmc_steps=5, ncmc_propagation_steps=1)
+    context = _createTestContext(system, inpcrd)
+    context.setVelocitiesToTemperature(temperature)
+
+    # Self transition.
+    initial_titration_states = driver.getTitrationStates()
+    accepted = driver._attemptNCMCTrial(context, [0], [initial_titration_states[0]], driver.ncmc_steps)
+    (initial_states, final_states, work) = driver.work_history[-1]
+    if (not accepted) or (work != 0.0) or (final_states != initial_titration_states):
+        raise AssertionError("Self transition of states %s was %s with work %f." % (str(initial_titration_states), 'accepted' if accepted else 'rejected', work))
+
+    # Rejected move, forced by a vanishing reverse proposal probability.
+    state = context.getState(getPositions=True, getVelocities=True, getEnergy=True, groups=driver._getForceGroupMask(driver.titration_force_groups))
+    positions = state.getPositions(asNumpy=True).value_in_unit(units.nanometers)
+    velocities = state.getVelocities(asNumpy=True).value_in_unit(units.nanometers/units.picoseconds)
+    titration_energy = _strip_units(state.getPotentialEnergy())
+    (initial_time, initial_step_count) = (_strip_units(state.getTime()), context.getStepCount())
+    final_state_index = (initial_titration_states[0] + 1) % driver.getNumTitrationStates(0)
+    accepted = driver._attemptNCMCTrial(context, [0], [final_state_index], driver.ncmc_steps, log_proposal_ratio=float('-inf'))
+    if accepted:
+        raise AssertionError("NCMC move with vanishing reverse proposal probability was accepted.")
+    if driver.work_history[-1][1][0] != final_state_index:
+        raise AssertionError("NCMC move did not switch to state %d." % final_state_index)
+    if driver.getTitrationStates() != initial_titration_states:
+        raise AssertionError("Rejected NCMC move left titration states %s instead of %s." % (str(driver.getTitrationStates()), str(initial_titration_states)))
+    state = context.getState(getPositions=True, getVelocities=True, getEnergy=True, groups=driver._getForceGroupMask(driver.titration_force_groups))
+    if numpy.abs(state.getPositions(asNumpy=True).value_in_unit(units.nanometers) - positions).max() > 1.0e-12:
+        raise AssertionError("Rejected NCMC move did not restore the positions.")
+    if numpy.abs(state.getVelocities(asNumpy=True).value_in_unit(units.nanometers/units.picoseconds) + velocities).max() > 1.0e-12:
+        raise AssertionError("Rejected NCMC move did not reverse the velocities.")
+    if abs(_strip_units(state.getPotentialEnergy()) - titration_energy) > 1.0e-3:
+        raise AssertionError("Rejected NCMC move did not restore the titration force parameters.")
+    if (_strip_units(state.getTime()) != initial_time) or (context.getStepCount() != initial_step_count):
+        raise AssertionError("Rejected NCMC move did not restore the time and step count.")
+
+    return
+
+def test_compiled_tables():
+    """
+    Check that the parameters written to the System for every titration state of each group match the charges of the cpin file.
+
+    """
+    temperature = 300.0 * units.kelvin
+    for name in _TEST_SYSTEMS:
+        (system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+        driver = MonteCarloTitration(system, temperature, 7.0, prmtop, cpin_filename)
+        namelist = cpinutils.namelist.read_cpin(cpin_filename)
+        forces = dict([ (system.getForce(index).__class__.__name__, system.getForce(index)) for index in range(system.getNumForces()) ])
+        (nonbonded_force, gb_force) = (forces['NonbondedForce'], forces['GBSAOBCForce'])
+        coulomb14scale = float(driver.coulomb14scale or 0.0)
+        for (group_index, group) in enumerate(driver.titrationGroups):
+            initial_state = driver.getTitrationState(group_index)
+            (first_charge, natoms) = [ namelist['STATEINF(%d)%%%s' % (group_index, field)] for field in ['FIRST_CHARGE', 'NUM_ATOMS'] ]
+            for state_index in range(group['nstates']):
+                driver.setTitrationState(group_index, state_index)
+                message = "%s, group %d, state %d" % (name, group_index, state_index)
+                expected_charges = namelist['CHRGDAT'][first_charge+natoms*state_index:first_charge+natoms*(state_index+1)]
+                for force in [nonbonded_force, gb_force]:
+                    charges = numpy.array([ _strip_units(force.getParticleParameters(atom_index)[0]) for atom_index in group['atom_indices'] ])
+                    if numpy.abs(charges - expected_charges).max() > 1.0e-12:
+                        raise AssertionError("%s: %s charges %s differ from the cpin charges %s." % (message, force.__class__.__name__, str(charges), str(expected_charges)))
+                for exception_index in group['exception_indices']:
+                    [particle1, particle2, chargeProd, sigma, epsilon] = nonbonded_force.getExceptionParameters(exception_index)
+                    [charge1, charge2] = [ _strip_units(nonbonded_force.getParticleParameters(particle)[0]) for particle in [particle1, particle2] ]
+                    if abs(_strip_units(chargeProd) - coulomb14scale * charge1 * charge2) > 1.0e-12:
+                        raise AssertionError("%s: charge product %f of exception %d differs from %f." % (message, _strip_units(chargeProd), exception_index, coulomb14scale * charge1 * charge2))
+            driver.setTitrationState(group_index, initial_state)
+
+    return
+
+def test_batched_parameter_updates():
+    """
+    Check that trials changing the states of several groups at once give the same Context energies as changing the state of each
+    group in turn with setTitrationState().
+
+    """
+    temperature = 300.0 * units.kelvin
+    for name in _TEST_SYSTEMS:
+        (system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+        driver = MonteCarloTitration(system, temperature, 7.0, prmtop, cpin_filename)
+        context = _createTestContext(system, inpcrd)
+        (reference_system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+        reference_driver = MonteCarloTitration(reference_system, temperature, 7.0, prmtop, cpin_filename)
+        reference_context = _createTestContext(reference_system, inpcrd)
+        ngroups = driver.getNumTitratableGroups()
+        for trial in range(10):
+            group_indices = random.sample(range(ngroups), random.randint(1, ngroups))
+            state_indices = [ random.randrange(driver.getNumTitrationStates(group_index)) for group_index in group_indices ]
+            driver.beginTitrationTrial()
+            for (group_index, state_index) in zip(group_indices, state_indices):
+                driver.setTitrationState(group_index, state_index)
+            driver.commitTitrationTrial(context)
+            driver.acceptTitrationTrial()
+            for (group_index, state_index) in zip(group_indices, state_indices):
+                reference_driver.setTitrationState(group_index, state_index, reference_context)
+            if driver.getTitrationStates() != reference_driver.getTitrationStates():
+                raise AssertionError("%s: batched trial left states %s instead of %s." % (name, str(driver.getTitrationStates()), str(reference_driver.getTitrationStates())))
+            _assertEnergiesEqual(_getTestEnergies(driver, context), _getTestEnergies(reference_driver, reference_context), 1.0e-6, "%s, states %s" % (name, str(driver.getTitrationStates())))
+
+    return
+
+def test_trial_rollback():
+    """
+    Check that rejecting a titration trial restores the titration states and the Context energy exactly, whether the restored
+    parameters are pushed when the trial is rejected or when the Context is next synchronized.
+
+    """
+    temperature = 300.0 * units.kelvin
+    for name in _TEST_SYSTEMS:
+        (system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+        driver = MonteCarloTitration(system, temperature, 7.0, prmtop, cpin_filename)
+        context = _createTestContext(system, inpcrd)
+        driver._updateParametersInContext(context)
+        initial_titration_states = driver.getTitrationStates()
+        initial_energy = _strip_units(context.getState(getEnergy=True).getPotentialEnergy())
+        ngroups = driver.getNumTitratableGroups()
+        for trial in range(10):
+            driver.beginTitrationTrial()
+            for group_index in random.sample(range(ngroups), random.randint(1, ngroups)):
+                driver.setTitrationState(group_index, random.randrange(driver.getNumTitrationStates(group_index)))
+            driver.commitTitrationTrial(context)
+            if trial % 2 == 0:
+                driver.rejectTitrationTrial(context)
+            else:
+                driver.rejectTitrationTrial()
+                driver._updateParametersInContext(context)
+            if driver.getTitrationStates() != initial_titration_states:
+                raise AssertionError("%s: rejected trial left states %s instead of %s." % (name, str(driver.getTitrationStates()), str(initial_titration_states)))
+            energy = _strip_units(context.getState(getEnergy=True).getPotentialEnergy())
+            if energy != initial_energy:
+                raise AssertionError("%s: rejected trial left energy %.12f kJ/mol instead of %.12f kJ/mol." % (name, energy, initial_energy))
+
+    return
+
+def test_log_reference_sum():
+    """
+    Check that the incrementally maintained sum of reference-state terms, and the cached log probability, match a full recomputation
+    as titration states, pH, and temperature change.
+
+    """
+    (system, prmtop, inpcrd, cpin_filename) = _createTestSystem('amber-example')
+    driver = MonteCarloTitration(system, 300.0*units.kelvin, 7.0, prmtop, cpin_filename)
+    context = _createTestContext(system, inpcrd)
+    epoch = driver._getConfigurationEpoch(context)
+    ngroups = driver.getNumTitratableGroups()
+    conditions = [ (7.0, 300.0), (4.0, 300.0), (4.0, 350.0), (9.5, 280.0) ]
+    for (pH, temperature) in conditions:
+        driver.pH = pH
+        driver.temperature = temperature * units.kelvin
+        for trial in range(5):
+            log_P = driver._getCurrentLogProbability(context, epoch)
+
+            # Recompute the reference-state terms from the titration states of each group.
+            beta = 1.0 / _strip_units(kB * driver.temperature)
+            log_reference_sum = 0.0
+            for (group, state_index) in zip(driver.titrationGroups, driver.getTitrationStates()):
+                titration_state = group['titration_states'][state_index]
+                log_reference_sum += - titration_state['proton_count'] * (pH - titration_state['pKref']) * math.log(10) + beta * _strip_units(titration_state['relative_energy'])
+            message = "pH %.1f, temperature %.1f K, states %s" % (pH, temperature, str(driver.getTitrationStates()))
+            if abs(driver._log_reference_sum - log_reference_sum) > 1.0e-9 * max(1.0, abs(log_reference_sum)):
+                raise AssertionError("%s: reference sum %.12f differs from %.12f." % (message, driver._log_reference_sum, log_reference_sum))
+
+            # Recompute the log probability from the energy of the titration forces.
+            driver._updateParametersInContext(context)
+            titration_energy = _strip_units(context.getState(getEnergy=True, groups=driver._getForceGroupMask(driver.titration_force_groups)).getPotentialEnergy())
+            expected_log_P = - beta * titration_energy + log_reference_sum
+            if abs(log_P - expected_log_P) > 1.0e-6 * max(1.0, abs(expected_log_P)):
+                raise AssertionError("%s: log probability %.12f differs from %.12f." % (message, log_P, expected_log_P))
+
+            for group_index in random.sample(range(ngroups), random.randint(1, ngroups)):
+                driver.setTitrationState(group_index, random.randrange(driver.getNumTitrationStates(group_index)))
+
+    return
+
+def test_configuration_epoch():
+    """
+    Check that the configuration epoch changes with the positions and box vectors of the Context, and that invalidateCache()
+    discards energies cached for the current epoch.
+
+    """
+    temperature = 300.0 * units.kelvin
+    for name in ['calibration-implicit/his', 'calibration-explicit/his']:
+        (system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+        driver = MonteCarloTitration(system, temperature, 7.0, prmtop, cpin_filename)
+        context = _createTestContext(system, inpcrd)
+        epoch = driver._getConfigurationEpoch(context)
+        if driver._getConfigurationEpoch(context) != epoch:
+            raise AssertionError("%s: epoch of an unchanged configuration changed." % name)
+
+        # Any change of the positions changes the epoch, and restoring them restores it.
+        positions = context.getState(getPositions=True).getPositions(asNumpy=True)
+        displaced_positions = positions.value_in_unit(units.nanometers).copy()
+        displaced_positions[0,0] += 1.0e-6
+        context.setPositions(displaced_positions * units.nanometers)
+        if driver._getConfigurationEpoch(context) == epoch:
+            raise AssertionError("%s: epoch did not change with the positions." % name)
+        context.setPositions(positions)
+        if driver._getConfigurationEpoch(context) != epoch:
+            raise AssertionError("%s: epoch changed when the positions were restored." % name)
+
+        # So does a change of the box vectors of a periodic system.
+        box_vectors = context.getState().getPeriodicBoxVectors()
+        if system.usesPeriodicBoundaryConditions():
+            context.setPeriodicBoxVectors(*[ vector * 1.01 for vector in box_vectors ])
+            if driver._getConfigurationEpoch(context) == epoch:
+                raise AssertionError("%s: epoch did not change with the box vectors." % name)
+            context.setPeriodicBoxVectors(*box_vectors)
+
+        # Changing parameters outside of the driver leaves cached energies stale until invalidateCache() is called.
+        log_P = driver._getCurrentLogProbability(context, epoch)
+        titratable_atoms = set([ atom_index for group in driver.titrationGroups for atom_index in group['atom_indices'] ])
+        atom_index = [ index for index in range(system.getNumParticles()) if index not in titratable_atoms ][0]
+        force = [ system.getForce(index) for index in range(system.getNumForces()) if isinstance(system.getForce(index), openmm.NonbondedForce) ][0]
+        [charge, sigma, epsilon] = force.getParticleParameters(atom_index)
+        force.setParticleParameters(atom_index, charge + 0.5*units.elementary_charge, sigma, epsilon)
+        force.updateParametersInContext(context)
+        if driver._getCurrentLogProbability(context, epoch) != log_P:
+            raise AssertionError("%s: log probability was not taken from the cache." % name)
+        driver.invalidateCache()
+        if driver.getEnergyCacheStatistics()['entries'] != 0:
+            raise AssertionError("%s: invalidateCache() left entries in the energy cache." % name)
+        if driver._getCurrentLogProbability(context, epoch) == log_P:
+            raise AssertionError("%s: log probability was not recomputed after invalidateCache()." % name)
+
+    return
+
+def test_gibbs_moves():
+    """
+    Check that Gibbs and Metropolized Gibbs moves of a group sample its states with their populations in a fixed configuration.
+
+    """
+    nsamples = 2000
+    for proposal_scheme in ['gibbs', 'metropolized-gibbs']:
+        (system, prmtop, inpcrd, cpin_filename) = _createTestSystem('calibration-implicit/his')
+        driver = MonteCarloTitration(system, 300.0*units.kelvin, 7.0, prmtop, cpin_filename, proposal_scheme=proposal_scheme)
+        context = _createTestContext(system, inpcrd)
+        _setBalancedpH(driver, context, 0)
+        (candidate_states, populations) = _computeStatePopulations(driver, context, [0])
+        epoch = driver._getConfigurationEpoch(context)
+        counts = numpy.zeros([len(candidate_states)], numpy.float64)
+        for sample in range(nsamples):
+            driver._attemptGibbsMove(context, epoch, [0])
+            counts[driver.getTitrationState(0)] += 1
+        _assertFrequenciesMatch(counts, populations, "%s moves at pH %.2f" % (proposal_scheme, driver.pH))
+
+    return
+
+def test_tautomer_moves():
+    """
+    Check that tautomer moves keep a group within its tautomer class and sample the states of the class in their population ratios,
+    and that updates mixing tautomer and protonation moves sample all states with their populations, in a fixed configuration.
+
+    """
+    nsamples = 2000
+    (system, prmtop, inpcrd, cpin_filename) = _createTestSystem('calibration-implicit/asp')
+    driver = MonteCarloTitration(system, 300.0*units.kelvin, 4.0, prmtop, cpin_filename, nattempts_per_update=1, tautomer_move_probability=0.5)
+    context = _createTestContext(system, inpcrd)
+    _setBalancedpH(driver, context, 0)
+    (candidate_states, populations) = _computeStatePopulations(driver, context, [0])
+    group = driver.titrationGroups[0]
+    tautomer_class = max(group['tautomer_classes'], key=len)
+    if len(tautomer_class) < 2:
+        raise AssertionError("Aspartate has no tautomer class with more than one state.")
+
+    # Tautomer moves alone.
+    driver.setTitrationState(0, tautomer_class[0], context)
+    epoch = driver._getConfigurationEpoch(context)
+    counts = numpy.zeros([len(candidate_states)], numpy.float64)
+    for sample in range(nsamples):
+        driver._attemptTautomerMove(context, epoch)
+        if driver.getTitrationState(0) not in tautomer_class:
+            raise AssertionError("Tautomer move changed state %d to state %d of another class." % (tautomer_class[0], driver.getTitrationState(0)))
+        counts[driver.getTitrationState(0)] += 1
+    _assertFrequenciesMatch(counts[tautomer_class], populations[tautomer_class] / populations[tautomer_class].sum(), "Tautomer moves among states %s" % str(tautomer_class))
+
+    # Updates mixing tautomer moves and protonation moves between classes.
+    counts[:] = 0
+    for sample in range(nsamples):
+        driver.update(context)
+        counts[driver.getTitrationState(0)] += 1
+    _assertFrequenciesMatch(counts, populations, "Updates with tautomer moves at pH %.2f" % driver.pH)
+
+    return
+
+def test_group_neighbors():
+    """
+    Check that the neighbors of titratable groups found with a cell list are those found by comparing the distances of all group centroids.
+
+    """
+    (system, prmtop, inpcrd, cpin_filename) = _createTestSystem('amber-example')
+    driver = MonteCarloTitration(system, 300.0*units.kelvin, 7.0, prmtop, cpin_filename)
+    context = _createTestContext(system, inpcrd)
+    initial_positions = numpy.array(inpcrd.getPositions(asNumpy=True).value_in_unit(units.nanometers), numpy.float64)
+    for trial in range(5):
+        # Scatter the atoms of the protein, at the original positions and then at random, so that groups cover many cells.
+        positions = initial_positions
+        if trial > 0:
+            positions = initial_positions * random.uniform(0.5, 3.0) + numpy.random.uniform(-5.0, 5.0, size=initial_positions.shape)
+        context.setPositions(positions * units.nanometers)
+        epoch = driver._getConfigurationEpoch(context)
+        centroids = numpy.array([ positions[group['atom_indices'],:].mean(axis=0) for group in driver.titrationGroups ])
+        distances = numpy.sqrt(((centroids[:,numpy.newaxis,:] - centroids[numpy.newaxis,:,:])**2).sum(axis=2))
+        for cutoff in [0.5, 1.0, 2.0, 5.0]:
+            driver.neighbor_cutoff = cutoff * units.nanometers
+            driver._group_neighbors = None
+            neighbors = driver._getGroupNeighbors(context, epoch)
+            for (group_index, group_neighbors) in enumerate(neighbors):
+                expected_neighbors = [ index for index in range(len(centroids)) if (index != group_index) and (distances[group_index,index] <= cutoff) ]
+                if group_neighbors != expected_neighbors:
+                    raise AssertionError("Cutoff %.1f nm, trial %d: neighbors %s of group %d differ from %s." % (cutoff, trial, str(group_neighbors), group_index, str(expected_neighbors)))
+
+    return
+
+def test_selection_weight_adaptation():
+    """
+    Check that selection weights are learned only between beginSelectionWeightAdaptation() and endSelectionWeightAdaptation(),
+    and stay fixed afterwards.
+
+    """
+    (system, prmtop, inpcrd, cpin_filename) = _createTestSystem('amber-example')
+    driver = MonteCarloTitration(system, 300.0*units.kelvin, 7.0, prmtop, cpin_filename)
+    context = _createTestContext(system, inpcrd)
+    ngroups = driver.getNumTitratableGroups()
+    driver.beginSelectionWeightAdaptation()
+    for iteration in range(20):
+        driver.update(context)
+    nattempted = driver._selection_statistics['nattempted'].sum()
+    if nattempted < 20 * driver.getNumAttemptsPerUpdate():
+        raise AssertionError("%d groups were recorded for %d attempts." % (nattempted, 20 * driver.getNumAttemptsPerUpdate()))
+    minimum_weight = 0.05
+    rates = (driver._selection_statistics['nchanged'] + 1.0) / (driver._selection_statistics['nattempted'] + 2.0)
+    expected_weights = numpy.maximum(rates, minimum_weight * rates.mean())
+    expected_weights /= expected_weights.sum()
+    weights = numpy.array(driver.endSelectionWeightAdaptation(minimum_weight=minimum_weight))
+    if (weights.shape != (ngroups,)) or (numpy.abs(weights - expected_weights).max() > 1.0e-12):
+        raise AssertionError("Learned selection weights %s differ from %s." % (str(weights), str(expected_weights)))
+
+    # Weights do not change in subsequent updates, which do not record statistics.
+    for iteration in range(20):
+        driver.update(context)
+        if driver._selection_statistics is not None:
+            raise AssertionError("Statistics were recorded after the selection weights were frozen.")
+        if not numpy.array_equal(driver.getSelectionWeights(), weights):
+            raise AssertionError("Selection weights %s changed from %s after they were frozen." % (str(driver.getSelectionWeights()), str(weights)))
+
+    return
+
+def test_ncmc_tuning():
+    """
+    Check that NCMC tuning chooses the switching length with the most accepted moves per second for each residue type, and that the
+    chosen lengths are stored in the protocol and used for subsequent moves.
+
+    """
+    temperature = 300.0 * units.kelvin
+    (system, prmtop, inpcrd, cpin_filename) = _createTestSystem('calibration-explicit/his')
+    driver = MonteCarloTitration(system, temperature, 6.5, prmtop, cpin_filename, nattempts_per_update=1)
+    context = _createTestContext(system, inpcrd)
+    context.setVelocitiesToTemperature(temperature)
+    residue_type = driver.titrationGroups[0]['type']
+
+    # Tune with moves in the Context.
+    candidate_steps = [1, 2]
+    driver.beginNCMCTuning(candidate_steps)
+    for iteration in range(4):
+        driver.update(context)
+    protocol = driver.endNCMCTuning()
+    if (protocol.keys() != [residue_type]) or (protocol[residue_type]['ncmc_steps'] not in candidate_steps):
+        raise AssertionError("Tuning moves of %s chose the protocol %s." % (residue_type, str(protocol)))
+    if driver.getNCMCProtocol() != { residue_type : protocol[residue_type]['ncmc_steps'] }:
+        raise AssertionError("Protocol %s was not stored for %s." % (str(driver.getNCMCProtocol()), residue_type))
+    if driver._getNCMCSteps([0]) != protocol[residue_type]['ncmc_steps']:
+        raise AssertionError("Moves of %s use %d NCMC steps instead of %d." % (residue_type, driver._getNCMCSteps([0]), protocol[residue_type]['ncmc_steps']))
+
+    # Choose among lengths with known acceptance and cost: (nattempted, naccepted, elapsed seconds) for each length.
+    driver.beginNCMCTuning(candidate_steps)
+    driver._ncmc_tuning['statistics'] = { residue_type : { 1 : [10, 1, 1.0], 10 : [10, 8, 2.0] }, 'OTHER' : { 1 : [10, 9, 1.0], 10 : [10, 9, 5.0] } }
+    protocol = driver.endNCMCTuning()
+    expected_protocol = { residue_type : 10, 'OTHER' : 1 }
+    if dict([ (key, choice['ncmc_steps']) for (key, choice) in protocol.iteritems() ]) != expected_protocol:
+        raise AssertionError("Tuning chose the protocol %s instead of %s." % (str(protocol), str(expected_protocol)))
+    if abs(protocol[residue_type]['accepted_per_second'] - (9.0 / 12.0) / 0.2) > 1.0e-12:
+        raise AssertionError("Tuning measured %f accepted moves per second instead of %f." % (protocol[residue_type]['accepted_per_second'], (9.0 / 12.0) / 0.2))
+    if driver.getNCMCProtocol() != expected_protocol:
+        raise AssertionError("Protocol %s was stored instead of %s." % (str(driver.getNCMCProtocol()), str(expected_protocol)))
+
+    return
+
+def test_scoring_pool():
+    """
+    Check that log probabilities scored by a pool of worker processes match those computed serially, and that Gibbs and Metropolized
+    Gibbs moves scored by the pool sample the states of a group with their populations.
+
+    """
+    temperature = 300.0 * units.kelvin
+    (system, prmtop, inpcrd, cpin_filename) = _createTestSystem('amber-example')
+    driver = MonteCarloTitration(system, temperature, 7.0, prmtop, cpin_filename, proposal_scheme='gibbs')
+    context = _createTestContext(system, inpcrd)
+    driver.startScoringPool(2, platform_name='Reference')
+    try:
+        initial_positions = context.getState(getPositions=True).getPositions(asNumpy=True)
+        for configuration in range(2):
+            if configuration > 0:
+                context.setPositions(initial_positions + numpy.random.normal(0.0, 0.01, size=initial_positions.shape) * units.nanometers)
+            epoch = driver._getConfigurationEpoch(context)
+            for titration_group_indices in [ [0], [1, 2], random.sample(range(driver.getNumTitratableGroups()), 3) ]:
+                candidate_states = list(itertools.product(*[ range(driver.getNumTitrationStates(group_index)) for group_index in titration_group_indices ]))
+                log_P = driver._scoreWithPool(context, epoch, titration_group_indices, candidate_states)
+                for (candidate_index, states) in enumerate(candidate_states):
+                    driver.beginTitrationTrial()
+                    for (group_index, state_index) in zip(titration_group_indices, states):
+                        driver.setTitrationState(group_index, state_index)
+                    expected_log_P = driver._compute_log_probability(context)
+                    driver.rejectTitrationTrial(context)
+                    if abs(log_P[candidate_index] - expected_log_P) > 1.0e-6 * max(1.0, abs(expected_log_P)):
+                        raise AssertionError("Configuration %d, groups %s in states %s: pool log probability %.9f differs from %.9f." % (configuration, str(titration_group_indices), str(states), log_P[candidate_index], expected_log_P))
+    finally:
+        driver.stopScoringPool()
+
+    nsamples = 2000
+    for proposal_scheme in ['gibbs', 'metropolized-gibbs']:
+        (system, prmtop, inpcrd, cpin_filename) = _createTestSystem('calibration-implicit/his')
+        driver = MonteCarloTitration(system, temperature, 7.0, prmtop, cpin_filename, proposal_scheme=proposal_scheme)
+        context = _createTestContext(system, inpcrd)
+        _setBalancedpH(driver, context, 0)
+        (candidate_states, populations) = _computeStatePopulations(driver, context, [0])
+        driver.startScoringPool(2, platform_name='Reference')
+        try:
+            epoch = driver._getConfigurationEpoch(context)
+            counts = numpy.zeros([len(candidate_states)], numpy.float64)
+            for sample in range(nsamples):
+                driver._attemptGibbsMove(context, epoch, [0])
+                counts[driver.getTitrationState(0)] += 1
+        finally:
+            driver.stopScoringPool()
+        _assertFrequenciesMatch(counts, populations, "%s moves scored by the pool at pH %.2f" % (proposal_scheme, driver.pH))
+
+    return
+
+def test_asynchronous_update_seeds():
+    """
+    Check that asynchronous updates run by workers forked from the same state of the random number generator of this process
+    follow different trajectories.
+
+    """
+    (system, prmtop, inpcrd, cpin_filename) = _createTestSystem('amber-example')
+    driver = MonteCarloTitration(system, 300.0*units.kelvin, 7.0, prmtop, cpin_filename, nattempts_per_update=50)
+    context = _createTestContext(system, inpcrd)
+    initial_titration_states = driver.getTitrationStates()
+    trajectories = list()
+    for trial in range(2):
+        random.seed(1)
+        driver.startScoringPool(1, platform_name='Reference', asynchronous=True)
+        try:
+            driver.resetStatistics()
+            driver.beginAsynchronousUpdate(context)
+            driver.endAsynchronousUpdate(context)
+        finally:
+            driver.stopScoringPool()
+        trajectories.append([ (initial_states, final_states) for (initial_states, final_states, work) in driver.work_history ])
+        for (group_index, state_index) in enumerate(initial_titration_states):
+            driver.setTitrationState(group_index, state_index, context)
+    if len(trajectories[0]) != driver.getNumAttemptsPerUpdate():
+        raise AssertionError("Asynchronous update recorded %d attempts instead of %d." % (len(trajectories[0]), driver.getNumAttemptsPerUpdate()))
+    if trajectories[0] == trajectories[1]:
+        raise AssertionError("Workers forked from the same random number generator state proposed identical trajectories.")
+
+    return
+
+def test_lambda_dynamics_forces():
+    """
+    Check that the forces on the theta coordinates of lambda-dynamics, computed by the integrator from the energy derivatives with
+    respect to the lambdas, match finite differences of the potential, including its reference-state term.
+
+    """
+    temperature = 300.0 * units.kelvin
+    delta = 1.0e-3 # finite difference step in theta
+    for name in ['calibration-implicit/his', 'calibration-implicit/asp', 'amber-example']:
+        (system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+        driver = LambdaDynamicsTitration(system, temperature, 7.0, prmtop, cpin_filename)
+        integrator = driver.integrator
+        context = openmm.Context(system, integrator, openmm.Platform.getPlatformByName('Reference'))
+        context.setPositions(inpcrd.getPositions())
+        context.setVelocitiesToTemperature(temperature)
+        for (group_index, group) in enumerate(driver.titrationGroups):
+            for state_index in range(group['nstates']):
+                integrator.setGlobalVariableByName('theta_%d_%d' % (group_index, state_index), random.uniform(-math.pi, math.pi))
+        # The derivatives are left in the integrator by the last half step of the velocities.
+        integrator.step(2)
+
+        def get_potential(group_index, thetas):
+            # Potential at the current positions with the lambdas of a group computed from thetas, and the other lambdas unchanged.
+            group = driver.titrationGroups[group_index]
+            lambdas = driver._computeLambdas(thetas)
+            for (state_index, parameter_name) in enumerate(group['global_parameter_names']):
+                if parameter_name is not None:
+                    context.setParameter(parameter_name, lambdas[state_index])
+            energy = _strip_units(context.getState(getEnergy=True).getPotentialEnergy())
+            return energy + sum([ lambdas[state_index] * integrator.getGlobalVariableByName('reference_%d_%d' % (group_index, state_index)) for state_index in range(group['nstates']) ])
+
+        for (group_index, group) in enumerate(driver.titrationGroups):
+            thetas = numpy.array([ integrator.getGlobalVariableByName('theta_%d_%d' % (group_index, state_index)) for state_index in range(group['nstates']) ])
+            dudl_mean = integrator.getGlobalVariableByName('dudl_mean_%d' % group_index)
+            for state_index in range(group['nstates']):
+                suffix = '%d_%d' % (group_index, state_index)
+                (theta, lambda_value, dudl, reference) = [ integrator.getGlobalVariableByName(variable + suffix) for variable in ['theta_', 'lambda_', 'dudl_', 'reference_'] ]
+                force = - driver.theta_scale * math.cos(theta) * lambda_value * (dudl + reference - dudl_mean)
+                (thetas_plus, thetas_minus) = (thetas.copy(), thetas.copy())
+                thetas_plus[state_index] += delta
+                thetas_minus[state_index] -= delta
+                expected_force = - (get_potential(group_index, thetas_plus) - get_potential(group_index, thetas_minus)) / (2.0 * delta)
+                get_potential(group_index, thetas)
+                if abs(force - expected_force) > 1.0e-4 * max(1.0, abs(expected_force)):
+                    raise AssertionError("%s, group %d, state %d: theta force %.9f differs from the finite difference %.9f." % (name, group_index, state_index, force, expected_force))
+
+    return
+
+def test_enumeration_populations():
+    """
+    Check that the Rao-Blackwellized populations accumulated by exact enumeration are normalized and match the populations computed by
+    setting each state in the Context.
+
+    """
+    temperature = 300.0 * units.kelvin
+    for name in ['calibration-implicit/his', 'calibration-implicit/asp', 'calibration-explicit/his']:
+        (system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+        driver = MonteCarloTitration(system, temperature, 7.0, prmtop, cpin_filename, enumeration_threshold=10)
+        context = _createTestContext(system, inpcrd)
+        _setBalancedpH(driver, context, 0)
+        (candidate_states, populations) = _computeStatePopulations(driver, context, [0])
+        nupdates = 5
+        for update in range(nupdates):
+            driver.update(context)
+        if (driver.nenumerated != nupdates) or (driver.nattempted != nupdates):
+            raise AssertionError("%s: %d of %d updates enumerated the states." % (name, driver.nenumerated, nupdates))
+        for (group_index, population_sum) in enumerate(driver.population_sums):
+            if abs(population_sum.sum() - nupdates) > 1.0e-9:
+                raise AssertionError("%s: population sums %s of group %d do not sum to %d." % (name, str(population_sum), group_index, nupdates))
+        estimated_populations = driver.getRaoBlackwellizedPopulations()[0]
+        if numpy.abs(estimated_populations - populations).max() > 1.0e-6:
+            raise AssertionError("%s: Rao-Blackwellized populations %s differ from %s." % (name, str(estimated_populations), str(populations)))
+
+        # Statistics are discarded on reset.
+        driver.resetStatistics()
+        if driver.getRaoBlackwellizedPopulations() is not None:
+            raise AssertionError("%s: populations were not reset." % name)
+
+    return
+
+def test_assign_most_probable_states():
+    """
+    Check that assignMostProbableTitrationStates() assigns a valid state to each group, which no change of a single group makes more
+    probable under the site-interaction model, and updates the Context to these states.
+
+    """
+    temperature = 300.0 * units.kelvin
+    for name in _TEST_SYSTEMS:
+        for pH in [2.0, 7.0, 12.0]:
+            (system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+            driver = MonteCarloTitration(system, temperature, pH, prmtop, cpin_filename)
+            context = _createTestContext(system, inpcrd)
+            titration_states = driver.assignMostProbableTitrationStates(context)
+            message = "%s at pH %.1f" % (name, pH)
+            if (len(titration_states) != driver.getNumTitratableGroups()) or (titration_states != driver.getTitrationStates()):
+                raise AssertionError("%s: assigned states %s differ from the driver states %s." % (message, str(titration_states), str(driver.getTitrationStates())))
+            for (group_index, state_index) in enumerate(titration_states):
+                if (type(state_index) is not int) or (state_index not in range(driver.getNumTitrationStates(group_index))):
+                    raise AssertionError("%s: state %s assigned to group %d is not a valid state index." % (message, str(state_index), group_index))
+
+            # The assignment is a local maximum of the model.
+            model = driver._getSiteInteractionModel(context, driver._getConfigurationEpoch(context))
+            log_P = driver._getSiteInteractionLogProbability(model, titration_states)
+            for group_index in range(driver.getNumTitratableGroups()):
+                for state_index in range(driver.getNumTitrationStates(group_index)):
+                    states = list(titration_states)
+                    states[group_index] = state_index
+                    if driver._getSiteInteractionLogProbability(model, states) > log_P + 1.0e-9 * max(1.0, abs(log_P)):
+                        raise AssertionError("%s: changing group %d to state %d makes the assigned states %s more probable." % (message, group_index, state_index, str(titration_states)))
+
+            # The Context holds the parameters of the assigned states.
+            (reference_system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+            reference_driver = MonteCarloTitration(reference_system, temperature, pH, prmtop, cpin_filename)
+            reference_context = _createTestContext(reference_system, inpcrd)
+            for (group_index, state_index) in enumerate(titration_states):
+                reference_driver.setTitrationState(group_index, state_index, reference_context)
+            _assertEnergiesEqual(_getTestEnergies(driver, context), _getTestEnergies(reference_driver, reference_context), 1.0e-6, message)
+
+    return
+
+def test_14_exceptions():
+    """
+    Check that the 1,4 exceptions of titratable groups found from the System are those identified from the 1,4 interactions of the
+    prmtop, and that the index of exceptions by particle lists all exceptions of each particle.
+
+    """
+    temperature = 300.0 * units.kelvin
+    for name in _TEST_SYSTEMS + [ 'calibration-explicit/%s' % residue for residue in ['asp', 'his'] ]:
+        (system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+        force_index = [ index for index in range(system.getNumForces()) if isinstance(system.getForce(index), openmm.NonbondedForce) ][0]
+        force = system.getForce(force_index)
+        exception_particles = [ tuple(force.getExceptionParameters(exception_index)[:2]) for exception_index in range(force.getNumExceptions()) ]
+        driver = MonteCarloTitration(system, temperature, 7.0, prmtop, cpin_filename)
+
+        # 1,4 exceptions as identified from the prmtop.
+        pairs14 = set()
+        for (atom1, atom2, chargeProd, rMin, epsilon, iScee, iScnb) in prmtop._prmtop.get14Interactions():
+            pairs14.add((atom1, atom2))
+            pairs14.add((atom2, atom1))
+        for (group_index, group) in enumerate(driver.titrationGroups):
+            atoms = set(group['atom_indices'])
+            expected_exceptions = [ exception_index for (exception_index, particles) in enumerate(exception_particles) if (particles in pairs14) and ((particles[0] in atoms) or (particles[1] in atoms)) ]
+            for (method, exception_indices) in [ ('table', group['exception_indices']), ('get14exceptions', driver.get14exceptions(system, group['atom_indices'])) ]:
+                if sorted(exception_indices) != expected_exceptions:
+                    raise AssertionError("%s, group %d: %s 1,4 exceptions %s differ from those of the prmtop %s." % (name, group_index, method, str(sorted(exception_indices)), str(expected_exceptions)))
+
+        # Index of exceptions by particle.
+        index = driver._getExceptionIndex(system, force_index)
+        particle_exceptions = [ list() for particle_index in range(system.getNumParticles()) ]
+        for (exception_index, (particle1, particle2)) in enumerate(exception_particles):
+            particle_exceptions[particle1].append(exception_index)
+            particle_exceptions[particle2].append(exception_index)
+        for (particle_index, expected_exceptions) in enumerate(particle_exceptions):
+            exception_indices = sorted(index['exceptions'][index['offsets'][particle_index]:index['offsets'][particle_index+1]])
+            if exception_indices != expected_exceptions:
+                raise AssertionError("%s: exceptions %s of particle %d differ from %s." % (name, str(exception_indices), particle_index, str(expected_exceptions)))
+
+    return
+
+def _valuesEqual(value, reference):
+    """
+    Return True if two values, which may be nested lists, tuples, or dicts of numpy arrays, are equal.
+
+    """
+    if isinstance(reference, numpy.ndarray) or isinstance(value, numpy.ndarray):
+        return numpy.array_equal(numpy.asarray(value), numpy.asarray(reference))
+    if isinstance(reference, (list, tuple)):
+        return isinstance(value, (list, tuple)) and (len(value) == len(reference)) and all([ _valuesEqual(item, reference_item) for (item, reference_item) in zip(value, reference) ])
+    if isinstance(reference, dict):
+        return isinstance(value, dict) and (sorted(value.keys()) == sorted(reference.keys())) and all([ _valuesEqual(value[key], reference[key]) for key in reference ])
+
+    return value == reference
+
+def test_bulk_group_registration():
+    """
+    Check that groups registered at once with addTitratableGroups(), as for cpin files, give the same parameter tables, atom-to-group
+    index, and energies as groups registered one at a time with addTitratableGroup().
+
+    """
+    temperature = 300.0 * units.kelvin
+    table_fields = [ 'atom_indices', 'exception_indices', 'nstates', 'type', 'charges', 'particle_parameters', 'exception_parameters', 'exception_atoms',
+                     'exception_chargeprods', 'exception_partners', 'transitions', 'tautomer_classes', 'state_classes' ]
+    for name in _TEST_SYSTEMS + ['calibration-explicit/his']:
+        (system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+        driver = MonteCarloTitration(system, temperature, 7.0, prmtop, cpin_filename)
+        context = _createTestContext(system, inpcrd)
+        driver._updateParametersInContext(context)
+
+        # Register the same groups and states one group at a time.
+        (reference_system, prmtop, inpcrd, cpin_filename) = _createTestSystem(name)
+        reference_driver = MonteCarloTitration(reference_system, temperature, 7.0, prmtop, None)
+        for group in driver.titrationGroups:
+            group_index = reference_driver.addTitratableGroup(group['atom_indices'], residue_type=group['residue_type'])
+            for titration_state in group['titration_states']:
+                reference_driver.addTitrationState(group_index, titration_state['pKref'], titration_state['relative_energy'], titration_state['charges'] * units.elementary_charge, titration_state['proton_count'])
+        for (group_index, state_index) in enumerate(driver.getTitrationStates()):
+            reference_driver.setTitrationState(group_index, state_index)
+        reference_context = _createTestContext(reference_system, inpcrd)
+        reference_driver._updateParametersInContext(reference_context)
+
+        if driver.getNumTitratableGroups() != reference_driver.getNumTitratableGroups():
+            raise AssertionError("%s: %d groups were registered in bulk and %d one at a time." % (name, driver.getNumTitratableGroups(), reference_driver.getNumTitratableGroups()))
+        for (group_index, (group, reference_group)) in enumerate(zip(driver.titrationGroups, reference_driver.titrationGroups)):
+            for field in table_fields:
+                if not _valuesEqual(group[field], reference_group[field]):
+                    raise AssertionError("%s, group %d: %s %s differs from %s for groups registered one at a time." % (name, group_index, field, str(group[field]), str(reference_group[field])))
+        atom_indices = range(system.getNumParticles())
+        if not numpy.array_equal(driver.getTitratableGroupOfAtoms(atom_indices), reference_driver.getTitratableGroupOfAtoms(atom_indices)):
+            raise AssertionError("%s: atom-to-group index differs for groups registered one at a time." % name)
+        _assertEnergiesEqual(_getTestEnergies(driver, context), _getTestEnergies(reference_driver, reference_context), 1.0e-6, name)
+
+    return
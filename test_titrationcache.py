@@ -0,0 +1,110 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Tests of the memoization of titration energies in titrationcache.py.
+
+EXAMPLES
+
+Run with nosetests:
+
+    nosetests test_titrationcache.py
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+from titrationcache import TitrationEnergyCache
+
+#=============================================================================================
+# TESTS
+#=============================================================================================
+
+# Packed titration states of equal length, and the estimated memory of an entry with such a key.
+_KEYS = [ '%08d' % index for index in range(10) ]
+_ENTRY_MEMORY = len(_KEYS[0]) + TitrationEnergyCache._entry_overhead
+
+def test_hits_and_misses():
+    """
+    Check that lookups return cached energies, and are counted as hits or misses.
+
+    """
+    cache = TitrationEnergyCache(100 * _ENTRY_MEMORY)
+    epoch = (1, 2)
+    if cache.get(epoch, _KEYS[0]) is not None:
+        raise AssertionError("Empty cache returned an energy.")
+    cache.set(epoch, _KEYS[0], -1.5)
+    cache.set(epoch, _KEYS[1], 0.0)
+    for (key, energy) in [ (_KEYS[0], -1.5), (_KEYS[1], 0.0), (_KEYS[2], None), (_KEYS[0], -1.5) ]:
+        if cache.get(epoch, key) != energy:
+            raise AssertionError("Cache returned %s for %s instead of %s." % (str(cache.get(epoch, key)), key, str(energy)))
+    statistics = cache.getStatistics()
+    expected_statistics = { 'hits' : 3, 'misses' : 2, 'hit_rate' : 0.6, 'entries' : 2, 'memory' : 2 * _ENTRY_MEMORY }
+    if statistics != expected_statistics:
+        raise AssertionError("Cache statistics %s differ from %s." % (str(statistics), str(expected_statistics)))
+
+    # Updating an entry does not change the estimated memory.
+    cache.set(epoch, _KEYS[0], 2.5)
+    if (cache.get(epoch, _KEYS[0]) != 2.5) or (cache.memory != 2 * _ENTRY_MEMORY):
+        raise AssertionError("Updating an entry left energy %s and memory %d." % (str(cache.entries[_KEYS[0]]), cache.memory))
+
+    return
+
+def test_epochs():
+    """
+    Check that entries are discarded when the cache is accessed for a new configuration epoch or cleared, while counters are kept.
+
+    """
+    cache = TitrationEnergyCache(100 * _ENTRY_MEMORY)
+    cache.set((1,), _KEYS[0], 1.0)
+    if cache.get((2,), _KEYS[0]) is not None:
+        raise AssertionError("Cache returned an energy of another configuration.")
+    if (len(cache.entries) != 0) or (cache.memory != 0):
+        raise AssertionError("Cache kept %d entries of another configuration." % len(cache.entries))
+    cache.set((1,), _KEYS[0], 1.0)
+    cache.set((2,), _KEYS[1], 2.0)
+    if (cache.get((2,), _KEYS[0]) is not None) or (cache.get((2,), _KEYS[1]) != 2.0):
+        raise AssertionError("Caching an energy of a new configuration did not discard those of the previous one.")
+    cache.clear()
+    statistics = cache.getStatistics()
+    if (statistics['entries'] != 0) or (statistics['memory'] != 0) or (statistics['hits'] != 1) or (statistics['misses'] != 2):
+        raise AssertionError("Cleared cache has statistics %s." % str(statistics))
+    if cache.get((2,), _KEYS[1]) is not None:
+        raise AssertionError("Cleared cache returned an energy.")
+
+    return
+
+def test_eviction():
+    """
+    Check that the least recently used entries are evicted to keep the estimated memory within its bound.
+
+    """
+    cache = TitrationEnergyCache(3 * _ENTRY_MEMORY)
+    epoch = (1,)
+    for key in _KEYS[:3]:
+        cache.set(epoch, key, 0.0)
+    cache.get(epoch, _KEYS[0]) # _KEYS[1] is now the least recently used entry
+    cache.set(epoch, _KEYS[3], 0.0)
+    if list(cache.entries.keys()) != [ _KEYS[2], _KEYS[0], _KEYS[3] ]:
+        raise AssertionError("Cache holds %s after eviction instead of %s." % (str(list(cache.entries.keys())), str([ _KEYS[2], _KEYS[0], _KEYS[3] ])))
+    if cache.memory != 3 * _ENTRY_MEMORY:
+        raise AssertionError("Cache estimates %d bytes for 3 entries instead of %d." % (cache.memory, 3 * _ENTRY_MEMORY))
+    for key in _KEYS:
+        cache.set(epoch, key, 0.0)
+        if cache.memory > cache.maximum_memory:
+            raise AssertionError("Cache uses %d bytes, more than its bound of %d." % (cache.memory, cache.maximum_memory))
+    if list(cache.entries.keys()) != _KEYS[-3:]:
+        raise AssertionError("Cache holds %s instead of the 3 most recent entries." % str(list(cache.entries.keys())))
+
+    # An entry larger than the bound is not kept.
+    cache = TitrationEnergyCache(_ENTRY_MEMORY - 1)
+    cache.set(epoch, _KEYS[0], 0.0)
+    if (len(cache.entries) != 0) or (cache.memory != 0):
+        raise AssertionError("Cache kept an entry larger than its bound.")
+
+    return
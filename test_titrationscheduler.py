@@ -0,0 +1,225 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Tests of the interleaving of dynamics and titration in titrationscheduler.py.
+
+DESCRIPTION
+
+The schedule is checked with a titration driver and Context that advance a fake clock by fixed costs per dynamics step and per
+titration attempt, so that the adapted numbers of steps and attempts are known exactly.
+
+EXAMPLES
+
+Run with nosetests:
+
+    nosetests test_titrationscheduler.py
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import titrationscheduler
+from titrationscheduler import TitrationScheduler
+
+#=============================================================================================
+# FAKE DRIVER AND CONTEXT
+#=============================================================================================
+
+class _FakeClock(object):
+    """
+    Clock replacing the time module of titrationscheduler, advanced explicitly by the fake driver and Context.
+
+    """
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+class _FakeIntegrator(object):
+    def __init__(self, context):
+        self.context = context
+
+    def step(self, nsteps):
+        self.context.clock.now += nsteps * self.context.step_time
+
+class _FakeContext(object):
+    """
+    Context whose dynamics steps each take step_time seconds.
+
+    """
+    def __init__(self, clock, step_time):
+        self.clock = clock
+        self.step_time = step_time
+
+    def getIntegrator(self):
+        return _FakeIntegrator(self)
+
+    def getState(self, getPositions=False):
+        return None
+
+class _FakeTitration(object):
+    """
+    Titration driver with one two-state group, whose titration attempts each take attempt_time seconds.
+
+    If alternate is True, each update changes the state of the group, so that its proton count is anticorrelated between updates;
+    otherwise the state never changes.
+
+    """
+    def __init__(self, clock, attempt_time, nattempts=4, alternate=True):
+        self.clock = clock
+        self.attempt_time = attempt_time
+        self.nattempts_per_update = nattempts
+        self.alternate = alternate
+        self.titrationGroups = [ { 'titration_states' : [ { 'proton_count' : 1 }, { 'proton_count' : 0 } ] } ]
+        self.titrationStates = [0]
+        self.updates = list() # number of attempts of each update
+
+    def getNumTitratableGroups(self):
+        return len(self.titrationGroups)
+
+    def getNumAttemptsPerUpdate(self):
+        return self.nattempts_per_update
+
+    def update(self, context, nattempts=None):
+        self.clock.now += nattempts * self.attempt_time
+        self.updates.append(nattempts)
+        if self.alternate:
+            self.titrationStates[0] = 1 - self.titrationStates[0]
+
+def _createTestScheduler(step_time=0.001, attempt_time=0.01, alternate=True, **kwargs):
+    """
+    Create a scheduler for a fake driver and Context sharing a fake clock, which replaces the time module of titrationscheduler.
+
+    RETURNS
+
+    scheduler (TitrationScheduler) - the scheduler, with keyword arguments passed to its constructor
+    context (_FakeContext) - the context
+
+    """
+    clock = _FakeClock()
+    titrationscheduler.time = clock
+    context = _FakeContext(clock, step_time)
+    scheduler = TitrationScheduler(_FakeTitration(clock, attempt_time, alternate=alternate), **kwargs)
+
+    return (scheduler, context)
+
+def _restoreClock():
+    import time
+    titrationscheduler.time = time
+
+#=============================================================================================
+# TESTS
+#=============================================================================================
+
+def test_adapt_steps():
+    """
+    Check that the number of dynamics steps per cycle makes titration take the requested fraction of time, within the allowed range.
+
+    """
+    try:
+        (scheduler, context) = _createTestScheduler(titration_time_fraction=0.1, window=1000)
+        scheduler.step(context)
+        # 4 attempts of 0.01 s should take 10% of the cycle, with 0.9 * 0.04 s / 0.001 s = 360 steps of dynamics.
+        if scheduler.nsteps != 360:
+            raise AssertionError("Scheduler chose %d steps per cycle instead of 360." % scheduler.nsteps)
+        scheduler.step(context)
+        (md_time, titration_time) = (scheduler.md_time, scheduler.titration_time)
+        scheduler.step(context)
+        fraction = (scheduler.titration_time - titration_time) / (scheduler.md_time - md_time + scheduler.titration_time - titration_time)
+        if abs(fraction - 0.1) > 1.0e-9:
+            raise AssertionError("Titration took %.6f of the time of a cycle instead of 0.1." % fraction)
+
+        # Dynamics becoming more expensive reduces the number of steps.
+        context.step_time = 0.01
+        for cycle in range(20):
+            scheduler.step(context)
+        if not (36 <= scheduler.nsteps < 360):
+            raise AssertionError("Scheduler chose %d steps per cycle after dynamics became ten times as expensive." % scheduler.nsteps)
+
+        # The number of steps is bounded.
+        (scheduler, context) = _createTestScheduler(titration_time_fraction=0.1, window=1000, minimum_steps=400)
+        scheduler.step(context)
+        if scheduler.nsteps != 400:
+            raise AssertionError("Scheduler chose %d steps per cycle instead of the minimum of 400." % scheduler.nsteps)
+        (scheduler, context) = _createTestScheduler(titration_time_fraction=0.1, window=1000, maximum_steps=100)
+        scheduler.step(context)
+        if scheduler.nsteps != 100:
+            raise AssertionError("Scheduler chose %d steps per cycle instead of the maximum of 100." % scheduler.nsteps)
+    finally:
+        _restoreClock()
+
+    return
+
+def test_adapt_attempts():
+    """
+    Check that the number of attempts per update follows the number of decorrelated samples per second.
+
+    NOTE
+
+    The proton count of the fake driver is anticorrelated between updates whatever the number of attempts, so that each update is a
+    decorrelated sample, and cycles take longer with more attempts.  Adaptation first increases the number of attempts, then reverses
+    and decreases it to one.
+
+    """
+    try:
+        (scheduler, context) = _createTestScheduler(window=2)
+        nattempts = list()
+        for cycle in range(12):
+            scheduler.step(context)
+            if cycle % 2 == 1:
+                nattempts.append(scheduler.nattempts)
+        if nattempts != [6, 4, 3, 2, 1, 1]:
+            raise AssertionError("Attempts per update were adapted as %s instead of %s." % (str(nattempts), str([6, 4, 3, 2, 1, 1])))
+        if scheduler.mc_titration.updates != [4, 4, 6, 6, 4, 4, 3, 3, 2, 2, 1, 1]:
+            raise AssertionError("Updates used %s attempts." % str(scheduler.mc_titration.updates))
+        if scheduler.mc_titration.getNumAttemptsPerUpdate() != 4:
+            raise AssertionError("Scheduler changed the number of attempts per update of the driver.")
+
+        # Proton counts that never change carry no information, and leave the number of attempts unchanged.
+        (scheduler, context) = _createTestScheduler(window=2, alternate=False)
+        for cycle in range(6):
+            scheduler.step(context)
+        if scheduler.nattempts != 4:
+            raise AssertionError("Scheduler adapted the number of attempts to %d without changes of proton counts." % scheduler.nattempts)
+    finally:
+        _restoreClock()
+
+    return
+
+def test_end_adaptation():
+    """
+    Check that the number of attempts per update is frozen by endAdaptation() or after adaptation_cycles cycles, while the number
+    of dynamics steps still follows the measured costs.
+
+    """
+    try:
+        for adaptation_cycles in [None, 4]:
+            (scheduler, context) = _createTestScheduler(window=2, adaptation_cycles=adaptation_cycles)
+            for cycle in range(4):
+                scheduler.step(context)
+            if adaptation_cycles is None:
+                if scheduler.endAdaptation() != 4:
+                    raise AssertionError("endAdaptation() did not return the number of attempts per update.")
+            for cycle in range(20):
+                scheduler.step(context)
+                if scheduler.nattempts != 4:
+                    raise AssertionError("Attempts per update changed to %d after adaptation ended (adaptation_cycles %s)." % (scheduler.nattempts, str(adaptation_cycles)))
+            if (len(scheduler._window_proton_counts) > 0) or (len(scheduler._window_times) > 0):
+                raise AssertionError("Scheduler recorded proton counts after adaptation ended.")
+
+            context.step_time = 0.002
+            scheduler.step(context)
+            scheduler.step(context)
+            if scheduler.nsteps >= 360:
+                raise AssertionError("Steps per cycle did not follow the cost of dynamics after adaptation ended.")
+    finally:
+        _restoreClock()
+
+    return
@@ -0,0 +1,121 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Memoization of titration energies of visited protonation states.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import collections
+
+#=============================================================================================
+# Memoization of titration energies.
+#=============================================================================================
+
+class TitrationEnergyCache(object):
+    """
+    Least-recently-used cache of titration energies of visited protonation states, for a single configuration.
+
+    Keys are packed titration state vectors.  The cache is emptied whenever it is accessed for a new configuration epoch,
+    and the least recently used entries are evicted to keep the estimated memory use below a bound.
+
+    """
+
+    _entry_overhead = 120 # estimated memory, in bytes, of an entry beyond its key and value
+
+    def __init__(self, maximum_memory):
+        """
+        Initialize an empty cache.
+
+        ARGUMENTS
+
+        maximum_memory (int) - bound on the estimated memory use, in bytes
+
+        """
+        self.maximum_memory = maximum_memory
+        self.epoch = None
+        self.entries = collections.OrderedDict()
+        self.memory = 0
+        self.nhits = 0
+        self.nmisses = 0
+
+        return
+
+    def clear(self):
+        """
+        Remove all entries.
+
+        """
+        self.epoch = None
+        self.entries.clear()
+        self.memory = 0
+
+        return
+
+    def get(self, epoch, key):
+        """
+        Return the energy cached for a protonation state in the specified configuration, or None if not cached.
+
+        ARGUMENTS
+
+        epoch (tuple) - the configuration epoch
+        key (string) - the packed titration states
+
+        """
+        if epoch != self.epoch:
+            self.clear()
+            self.epoch = epoch
+        energy = self.entries.pop(key, None)
+        if energy is None:
+            self.nmisses += 1
+            return None
+
+        self.nhits += 1
+        self.entries[key] = energy # mark as most recently used
+
+        return energy
+
+    def set(self, epoch, key, energy):
+        """
+        Cache the energy of a protonation state in the specified configuration.
+
+        ARGUMENTS
+
+        epoch (tuple) - the configuration epoch
+        key (string) - the packed titration states
+        energy (float) - the unit-free energy
+
+        """
+        if epoch != self.epoch:
+            self.clear()
+            self.epoch = epoch
+        if key in self.entries:
+            del self.entries[key]
+        else:
+            self.memory += len(key) + self._entry_overhead
+        self.entries[key] = energy
+
+        while (self.memory > self.maximum_memory) and (len(self.entries) > 0):
+            (key, energy) = self.entries.popitem(last=False)
+            self.memory -= len(key) + self._entry_overhead
+
+        return
+
+    def getStatistics(self):
+        """
+        Return a dict with the numbers of 'hits', 'misses' and 'entries', the 'hit_rate', and the estimated 'memory' use in bytes.
+
+        """
+        nlookups = self.nhits + self.nmisses
+        hit_rate = 0.0
+        if nlookups > 0:
+            hit_rate = float(self.nhits) / float(nlookups)
+
+        return { 'hits' : self.nhits, 'misses' : self.nmisses, 'hit_rate' : hit_rate, 'entries' : len(self.entries), 'memory' : self.memory }
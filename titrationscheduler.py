@@ -0,0 +1,217 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Interleaving of dynamics and titration within a wall-clock budget.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import time
+
+import numpy
+
+#=============================================================================================
+# Interleaving of dynamics and titration.
+#=============================================================================================
+
+class TitrationScheduler(object):
+    """
+    Interleave dynamics with titration updates, choosing the number of titration attempts per update and the number of dynamics
+    steps between updates.
+
+    The measured costs of a dynamics step and of a titration attempt determine the number of dynamics steps for which titration
+    takes the requested fraction of wall-clock time.  The number of attempts per update is adapted every few cycles, in the direction
+    that increases the number of decorrelated protonation-state samples per second, estimated from the lag-one autocorrelation of
+    the proton counts of all groups.
+
+    NOTE
+
+    Since the number of attempts depends on the history of the proton counts, updates do not strictly preserve detailed balance while
+    it is adapted; endAdaptation() (or adaptation_cycles) freezes it, which should be done at the end of equilibration.
+    The number of dynamics steps continues to follow the measured costs, which do not depend on the protonation states.
+
+    The adapted number of attempts is passed to each update, and the number of attempts per update of the driver is left unchanged.
+
+    """
+
+    def __init__(self, mc_titration, titration_time_fraction=0.1, nsteps=500, window=20, minimum_steps=1, maximum_steps=100000, maximum_attempts=None, adaptation_cycles=None, debug=False):
+        """
+        Initialize a scheduler.
+
+        ARGUMENTS
+
+        mc_titration (MonteCarloTitration) - the titration driver
+
+        OPTIONAL ARGUMENTS
+
+        titration_time_fraction (float) - fraction of wall-clock time to spend on titration (default: 0.1)
+        nsteps (int) - number of dynamics steps per cycle until costs have been measured (default: 500)
+        window (int) - number of cycles between adaptations of the number of attempts per update (default: 20)
+        minimum_steps (int) - minimum number of dynamics steps per cycle (default: 1)
+        maximum_steps (int) - maximum number of dynamics steps per cycle (default: 100000)
+        maximum_attempts (int) - maximum number of titration attempts per update; if None, ten times the number of groups (default: None)
+        adaptation_cycles (int) - if specified, the number of attempts per update is frozen after this many cycles, as by endAdaptation();
+                                  otherwise it is adapted until endAdaptation() is called (default: None)
+        debug (boolean) - if True, will print debug information
+
+        """
+        if not (0.0 < titration_time_fraction < 1.0):
+            raise Exception("Titration time fraction must be between 0 and 1.")
+
+        self.mc_titration = mc_titration
+        self.titration_time_fraction = titration_time_fraction
+        self.nsteps = nsteps
+        self.window = window
+        self.minimum_steps = minimum_steps
+        self.maximum_steps = maximum_steps
+        self.maximum_attempts = maximum_attempts
+        if maximum_attempts is None:
+            self.maximum_attempts = 10 * mc_titration.getNumTitratableGroups()
+        self.adaptation_cycles = adaptation_cycles
+        self.debug = debug
+
+        self.nattempts = mc_titration.getNumAttemptsPerUpdate()
+
+        # Accumulated costs.
+        self.ncycles = 0
+        self.md_time = 0.0
+        self.md_steps = 0
+        self.titration_time = 0.0
+        self.titration_attempts = 0
+
+        # Proton counts and durations of the cycles in the current adaptation window.
+        self._window_proton_counts = [ self._getProtonCounts() ]
+        self._window_times = list()
+        self._previous_efficiency = None
+        self._direction = 1 # +1 to increase the number of attempts at the next adaptation, -1 to decrease it
+        self._factor = 1.5 # multiplicative change of the number of attempts per adaptation
+        self._adapting = True # False once the number of attempts has been frozen
+
+        return
+
+    def _getProtonCounts(self):
+        """
+        Return the proton count of each titratable group in its current state.
+
+        """
+        mc_titration = self.mc_titration
+        return [ group['titration_states'][state_index]['proton_count'] for (group, state_index) in zip(mc_titration.titrationGroups, mc_titration.titrationStates) ]
+
+    def step(self, context):
+        """
+        Run one cycle of dynamics followed by a titration update, then adapt the schedule.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the context to propagate and titrate
+
+        """
+        initial_time = time.time()
+        context.getIntegrator().step(self.nsteps)
+        # Wait for dynamics to finish, so that its cost is not attributed to titration.
+        context.getState(getPositions=True)
+        md_time = time.time() - initial_time
+
+        initial_time = time.time()
+        self.mc_titration.update(context, nattempts=self.nattempts)
+        titration_time = time.time() - initial_time
+
+        self.ncycles += 1
+        self.md_time += md_time
+        self.md_steps += self.nsteps
+        self.titration_time += titration_time
+        self.titration_attempts += self.nattempts
+
+        if self._adapting:
+            self._window_proton_counts.append(self._getProtonCounts())
+            self._window_times.append(md_time + titration_time)
+            if len(self._window_times) >= self.window:
+                self._adaptAttempts()
+            if (self.adaptation_cycles is not None) and (self.ncycles >= self.adaptation_cycles):
+                self.endAdaptation()
+        self._adaptSteps()
+
+        return
+
+    def endAdaptation(self):
+        """
+        Stop adapting the number of titration attempts per update, and freeze it at its current value.
+
+        RETURNS
+
+        nattempts (int) - the frozen number of attempts per update
+
+        """
+        self._adapting = False
+        self._window_proton_counts = list()
+        self._window_times = list()
+
+        return self.nattempts
+
+    def _adaptAttempts(self):
+        """
+        Change the number of titration attempts per update in the direction that increased decorrelated samples per second.
+
+        """
+        proton_counts = numpy.array(self._window_proton_counts, numpy.float64)
+        cycle_time = numpy.mean(self._window_times)
+        self._window_proton_counts = [ self._window_proton_counts[-1] ]
+        self._window_times = list()
+
+        # Pooled lag-one autocorrelation of the proton counts; groups that did not change carry no information.
+        fluctuations = proton_counts - proton_counts.mean(axis=0)
+        variance = (fluctuations[:-1,:]**2).sum()
+        if variance == 0.0:
+            return
+        correlation = min(max((fluctuations[:-1,:] * fluctuations[1:,:]).sum() / variance, 0.0), 0.99)
+
+        # Decorrelated samples per second, with the statistical inefficiency of a first-order autoregressive process.
+        statistical_inefficiency = (1.0 + correlation) / (1.0 - correlation)
+        efficiency = 1.0 / (statistical_inefficiency * cycle_time)
+        if (self._previous_efficiency is not None) and (efficiency < self._previous_efficiency):
+            self._direction = -self._direction
+        self._previous_efficiency = efficiency
+
+        nattempts = int(round(self.nattempts * self._factor**self._direction))
+        if nattempts == self.nattempts:
+            nattempts += self._direction
+        self.nattempts = min(max(nattempts, 1), self.maximum_attempts)
+
+        if self.debug:
+            print "   scheduler: autocorrelation %.3f | %.3f samples per second | %d attempts per update" % (correlation, efficiency, self.nattempts)
+
+        return
+
+    def _adaptSteps(self):
+        """
+        Choose the number of dynamics steps per cycle so that titration takes the requested fraction of wall-clock time.
+
+        """
+        if (self.md_steps == 0) or (self.titration_attempts == 0) or (self.md_time <= 0.0):
+            return
+
+        md_step_time = self.md_time / self.md_steps
+        attempt_time = self.titration_time / self.titration_attempts
+        fraction = self.titration_time_fraction
+        nsteps = int(round(self.nattempts * attempt_time * (1.0 - fraction) / (fraction * md_step_time)))
+        self.nsteps = min(max(nsteps, self.minimum_steps), self.maximum_steps)
+
+        return
+
+    def getTitrationTimeFraction(self):
+        """
+        Return the measured fraction of wall-clock time spent on titration.
+
+        """
+        total_time = self.md_time + self.titration_time
+        if total_time == 0.0:
+            return 0.0
+
+        return self.titration_time / total_time